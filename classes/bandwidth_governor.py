@@ -0,0 +1,148 @@
+"""
+Classes for sharing the download bandwidth between the running downloads.
+"""
+import asyncio
+import time
+
+# Burst allowed to a bucket, at least one full request of upload.getFile
+MIN_BUCKET_CAPACITY = 512 * 1024
+
+
+class TokenBucket:
+    """
+    Token bucket, measured in bytes unless a {capacity} is given, a rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate: float = 0, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity or 0.0
+        self.last_time = time.monotonic()
+
+    def refill(self):
+        """
+        Add the tokens accumulated since the last refill.
+        """
+        now = time.monotonic()
+        if self.rate > 0:
+            capacity = self.capacity if self.capacity is not None else max(self.rate, MIN_BUCKET_CAPACITY)
+            self.tokens = min(capacity, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    def set_rate(self, rate: float):
+        """
+        Change the rate of the bucket keeping the tokens already accumulated.
+        """
+        self.refill()
+        self.rate = rate
+
+    def reserve(self, amount: int) -> float:
+        """
+        Take {amount} tokens, the bucket can go in debt.
+        :return: seconds to wait before the tokens are really available
+        """
+        if self.rate <= 0:
+            return 0
+        self.refill()
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class BandwidthGovernor:
+    """
+    Global bandwidth budget (bytes/sec) split between the active downloads by weight,
+    with optional caps for a single download and for all the downloads of a chat.
+    A limit of 0 means unlimited.
+    """
+
+    def __init__(self, global_rate: int = 0, download_rate: int = 0, chat_rate: int = 0,
+                 pinned_weight: int = 2):
+        self.global_rate = global_rate
+        self.download_rate = download_rate
+        self.chat_rate = chat_rate
+        self.pinned_weight = max(1, pinned_weight)
+        self.downloads = {}
+        self.chat_buckets = {}
+
+    def register(self, key, chat=None, pinned: bool = False):
+        """
+        Register a download, its share of the global budget is proportional to its weight.
+        :param key: download identifier
+        :param chat: chat of the download, used for the per chat limit
+        :param pinned: pinned downloads get {pinned_weight} shares
+        """
+        self.downloads[key] = {
+            'chat': chat,
+            'weight': self.pinned_weight if pinned else 1,
+            'bucket': TokenBucket(),
+        }
+        if chat not in self.chat_buckets:
+            self.chat_buckets[chat] = TokenBucket()
+        self.rebalance()
+
+    def unregister(self, key):
+        """
+        Remove a download and give its share back to the others.
+        """
+        download = self.downloads.pop(key, None)
+        if download is None:
+            return
+        if all(item['chat'] != download['chat'] for item in self.downloads.values()):
+            self.chat_buckets.pop(download['chat'], None)
+        self.rebalance()
+
+    def set_pinned(self, key, pinned: bool):
+        """
+        Update the weight of a running download.
+        """
+        if key in self.downloads:
+            self.downloads[key]['weight'] = self.pinned_weight if pinned else 1
+            self.rebalance()
+
+    def set_limits(self, global_rate: int | None = None, download_rate: int | None = None,
+                   chat_rate: int | None = None):
+        """
+        Change the limits at runtime, None keeps the current value.
+        """
+        if global_rate is not None:
+            self.global_rate = max(0, global_rate)
+        if download_rate is not None:
+            self.download_rate = max(0, download_rate)
+        if chat_rate is not None:
+            self.chat_rate = max(0, chat_rate)
+        self.rebalance()
+
+    def get_download_rate(self, key) -> float:
+        """
+        Get the current rate of a download, 0 if unlimited.
+        """
+        download = self.downloads.get(key)
+        return download['bucket'].rate if download is not None else 0
+
+    def rebalance(self):
+        """
+        Recalculate the rate of every bucket.
+        """
+        total_weight = sum(item['weight'] for item in self.downloads.values())
+        for download in self.downloads.values():
+            rates = []
+            if self.global_rate > 0:
+                rates.append(self.global_rate * download['weight'] / total_weight)
+            if self.download_rate > 0:
+                rates.append(self.download_rate)
+            download['bucket'].set_rate(min(rates) if rates else 0)
+        for bucket in self.chat_buckets.values():
+            bucket.set_rate(self.chat_rate)
+
+    async def consume(self, key, amount: int):
+        """
+        Account {amount} bytes received by a download, waiting if it is over budget.
+        """
+        download = self.downloads.get(key)
+        if download is None:
+            return
+        wait_time = max(
+            download['bucket'].reserve(amount),
+            self.chat_buckets[download['chat']].reserve(amount))
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
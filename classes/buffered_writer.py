@@ -0,0 +1,186 @@
+"""
+Write-behind writer for the downloaded chunks.
+"""
+import asyncio
+import collections
+import errno
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Maximum number of buffers passed to a single vectored write
+MAX_WRITE_VECTORS = 512
+
+
+class BufferedFileWriter:
+    """
+    Chunks are queued by the event loop and written at their offset by a worker thread,
+    contiguous chunks are coalesced in a single vectored write.
+    When the queued bytes exceed {max_pending} the writers wait, so the network side
+    slows down when the disk falls behind.
+    """
+
+    def __init__(self, file_path: str, max_pending: int = 32 * 1024 * 1024,
+                 max_batch: int = 8 * 1024 * 1024):
+        self.file_path = file_path
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self.fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer')
+        self.buffer = None
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.space_available = asyncio.Event()
+        self.space_available.set()
+        self.flush_task = None
+        self.error = None
+
+    async def write(self, offset: int, data, on_written=None):
+        """
+        Queue {data} to be written at {offset}.
+        :param offset:
+        :param data:
+        :param on_written: called on the event loop once the data is on the file
+        """
+        self.raise_error()
+        while self.pending_bytes >= self.max_pending:
+            self.space_available.clear()
+            await self.space_available.wait()
+            self.raise_error()
+        self.pending.append((offset, data, on_written))
+        self.pending_bytes += len(data)
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_pending())
+
+    async def flush_pending(self):
+        """
+        Hand the queued chunks to the worker thread, in batches of at most {max_batch} bytes.
+        """
+        loop = asyncio.get_running_loop()
+        while self.pending and self.error is None:
+            batch = []
+            batch_size = 0
+            while self.pending and (not batch or batch_size + len(self.pending[0][1]) <= self.max_batch):
+                item = self.pending.popleft()
+                batch.append(item)
+                batch_size += len(item[1])
+            try:
+                await loop.run_in_executor(self.executor, self.write_batch, batch)
+            except OSError as e:
+                self.error = e
+            self.pending_bytes -= batch_size
+            self.space_available.set()
+            if self.error is None:
+                for offset, data, on_written in batch:
+                    if on_written is not None:
+                        on_written(offset, len(data))
+
+    def write_batch(self, batch: list):
+        """
+        Write a batch of chunks, runs on the worker thread.
+        """
+        runs = []
+        for offset, data, _ in sorted(batch, key=lambda item: item[0]):
+            if runs and runs[-1][0] + runs[-1][1] == offset and len(runs[-1][2]) < MAX_WRITE_VECTORS:
+                runs[-1][1] += len(data)
+                runs[-1][2].append(data)
+            else:
+                runs.append([offset, len(data), [data]])
+
+        for offset, _, buffers in runs:
+            if hasattr(os, 'pwritev'):
+                self.write_vectored(offset, buffers)
+            else:
+                self.write_coalesced(offset, buffers)
+
+    def write_vectored(self, offset: int, buffers: list):
+        """
+        Write contiguous buffers with a single system call, retrying on partial writes.
+        """
+        views = [memoryview(data) for data in buffers]
+        while views:
+            written = os.pwritev(self.fd, views, offset)
+            offset += written
+            while views and written >= len(views[0]):
+                written -= len(views[0])
+                views.pop(0)
+            if views and written > 0:
+                views[0] = views[0][written:]
+
+    def write_coalesced(self, offset: int, buffers: list):
+        """
+        Copy contiguous buffers in a reused buffer and write it at once,
+        for the platforms without pwritev.
+        """
+        size = sum(len(data) for data in buffers)
+        if self.buffer is None or len(self.buffer) < size:
+            self.buffer = bytearray(max(size, self.max_batch))
+        view = memoryview(self.buffer)
+        position = 0
+        for data in buffers:
+            view[position:position + len(data)] = data
+            position += len(data)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        written = 0
+        while written < size:
+            written += os.write(self.fd, view[written:size])
+
+    def raise_error(self):
+        """
+        Raise the error of the worker thread, if any.
+        """
+        if self.error is not None:
+            raise self.error
+
+    async def preallocate(self, size: int):
+        """
+        Reserve the blocks of the whole file, so a full disk fails here and not in the middle of
+        the download and the file isn't fragmented. Where the platform or the filesystem can't
+        allocate, the size is only set and the file stays sparse.
+        """
+        await self.flush()
+        await self.run_in_thread(self.allocate, size)
+
+    def allocate(self, size: int):
+        """
+        Allocate the file up to {size}, runs on the worker thread.
+        """
+        if hasattr(os, 'posix_fallocate') and size > 0:
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+        # posix_fallocate never shrinks the file
+        os.ftruncate(self.fd, size)
+
+    async def run_in_thread(self, func, *args):
+        """
+        Run {func} on the worker thread, after the writes already handed to it.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def sync(self):
+        """
+        Write the queued chunks and flush the file to the storage device.
+        """
+        await self.flush()
+        await self.run_in_thread(os.fsync, self.fd)
+
+    async def flush(self):
+        """
+        Wait until every queued chunk is written.
+        """
+        while self.flush_task is not None and not self.flush_task.done():
+            await self.flush_task
+        self.raise_error()
+
+    async def close(self):
+        """
+        Write the queued chunks and close the file.
+        """
+        try:
+            await self.flush()
+        finally:
+            self.pending.clear()
+            self.executor.shutdown(wait=True)
+            os.close(self.fd)
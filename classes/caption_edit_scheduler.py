@@ -0,0 +1,104 @@
+"""
+Scheduler of the edits of the reference messages.
+"""
+import asyncio
+import time
+
+from classes.bandwidth_governor import TokenBucket
+
+
+class CaptionEditScheduler:
+    """
+    Every change of a caption updates the text waiting to be sent for that message,
+    the pending text is sent at most once every {interval} seconds per message and
+    the edits of all the messages share a global edits/sec budget.
+    """
+
+    def __init__(self, caption_mirror, interval: float = 3, edits_per_second: float = 1):
+        self.caption_mirror = caption_mirror
+        self.interval = interval
+        self.budget = TokenBucket(edits_per_second, capacity=max(1.0, edits_per_second))
+        self.pending = {}
+        self.last_edit_time = {}
+        self.tasks = {}
+
+    async def get_text(self, message_id: int) -> str | None:
+        """
+        Get the latest text of a message, including the changes not yet sent.
+        """
+        if message_id in self.pending:
+            return self.pending[message_id]
+        return await self.caption_mirror.get_text(message_id)
+
+    def schedule(self, message_id: int, text: str) -> None:
+        """
+        Replace the text waiting to be sent for a message.
+        """
+        self.pending[message_id] = text
+        task = self.tasks.get(message_id)
+        if task is None or task.done():
+            self.tasks[message_id] = asyncio.create_task(self.flush_message(message_id))
+
+    async def flush_message(self, message_id: int, wait_interval: bool = True) -> None:
+        """
+        Send the pending text of a message respecting the interval and the global budget.
+        """
+        while message_id in self.pending:
+            if wait_interval:
+                delay = self.last_edit_time.get(message_id, 0) + self.interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            delay = self.budget.reserve(1)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text = self.pending.pop(message_id, None)
+            if text is None or text == self.caption_mirror.texts.get(message_id):
+                continue
+            self.last_edit_time[message_id] = time.monotonic()
+            await self.send(message_id, text)
+
+    async def send(self, message_id: int, text: str) -> None:
+        """
+        Edit the message and mirror the text returned by Telegram.
+        On a flood wait the text is sent again after the wait, unless a newer one replaced it.
+        """
+        from telethon.errors import FloodWaitError, MessageNotModifiedError, MessageIdInvalidError, RPCError
+        from func.main import client
+        from run import LOG_IN_PERSONAL_CHAT, PERSONAL_CHAT_ID
+
+        if LOG_IN_PERSONAL_CHAT is not True:
+            return
+        try:
+            message = await client.edit_message(PERSONAL_CHAT_ID, message_id, text)
+            self.caption_mirror.update(message)
+        except MessageIdInvalidError:
+            self.forget(message_id)
+        except FloodWaitError as er:
+            print(f"Edit of message {message_id} delayed by a flood wait of {er.seconds} seconds")
+            self.pending.setdefault(message_id, text)
+            await asyncio.sleep(er.seconds)
+        except (MessageNotModifiedError, PermissionError) as er:
+            print(er.message)
+        except RPCError as er:
+            print(f"Error editing message {message_id}: {er}")
+
+    def forget(self, message_id: int) -> None:
+        """
+        Drop the pending text of a deleted message.
+        """
+        self.pending.pop(message_id, None)
+        self.last_edit_time.pop(message_id, None)
+        self.caption_mirror.forget(message_id)
+        task = self.tasks.pop(message_id, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+
+    async def flush_all(self) -> None:
+        """
+        Send every pending text now, e.g. before disconnecting.
+        """
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks = {}
+        for message_id in list(self.pending):
+            await self.flush_message(message_id, wait_interval=False)
@@ -0,0 +1,53 @@
+"""
+In-process copy of the captions of the reference messages.
+"""
+
+
+class CaptionMirror:
+    """
+    Keeps the text of every reference message, updated by our own edits and by the
+    MessageEdited events, so editing a caption doesn't need to fetch it first.
+    """
+
+    def __init__(self):
+        self.texts = {}
+
+    async def get_text(self, message_id: int) -> str | None:
+        """
+        Get the text of a reference message, fetched only the first time.
+        :param message_id:
+        :return: None if the message doesn't exist
+        """
+        if message_id in self.texts:
+            return self.texts[message_id]
+
+        from func.main import client
+        from run import PERSONAL_CHAT_ID
+        message = await client.get_messages(PERSONAL_CHAT_ID, ids=message_id)
+        if message is None:
+            return None
+        self.update(message)
+        return message.text
+
+    def update(self, message) -> None:
+        """
+        Store the text of a message.
+        :param message:
+        """
+        if message is not None:
+            self.texts[message.id] = message.text
+
+    def update_if_known(self, message) -> None:
+        """
+        Store the text of a message only if it is already mirrored, used for the edit events.
+        :param message:
+        """
+        if message is not None and message.id in self.texts:
+            self.update(message)
+
+    def forget(self, message_id: int) -> None:
+        """
+        Remove a message, e.g. when it is deleted.
+        :param message_id:
+        """
+        self.texts.pop(message_id, None)
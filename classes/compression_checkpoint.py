@@ -0,0 +1,105 @@
+"""
+Checkpoints of a compression, to resume it after an interruption.
+"""
+import json
+import os
+from pathlib import Path
+
+# File with the parts of a compression
+CHECKPOINT_FILE_NAME = 'checkpoint.json'
+
+
+def load_work_file(path: Path, source: list, crf: int) -> dict | None:
+    """
+    Load the saved state of a compression, None if missing or made for another file or CRF.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('source') != source or data.get('crf') != crf:
+        return None
+    return data
+
+
+class CompressionCheckpoint:
+    """
+    The parts of a compression saved in its folder. Every run of ffmpeg encodes a new part
+    starting where the previous ones end, the encoded time of the running part is recorded
+    as it advances: a part cut by an interruption is kept up to its last checkpoint.
+    A part encoded to the end of the video is recorded as None.
+    """
+
+    def __init__(self, parts_dir: Path, source: list, crf: int, parts: list | None = None):
+        self.parts_dir = parts_dir
+        self.source = source
+        self.crf = crf
+        self.parts = parts or []
+
+    @classmethod
+    def load(cls, parts_dir: Path, source: list, crf: int):
+        """
+        Load the checkpoint of a previous run, None if missing or made for another file or CRF.
+        """
+        data = load_work_file(parts_dir / CHECKPOINT_FILE_NAME, source, crf)
+        if data is None:
+            return None
+        checkpoint = cls(parts_dir, source, crf, data['parts'])
+        if not all(checkpoint.get_part_path(index).exists() for index in range(len(checkpoint.parts))):
+            return None
+        return checkpoint
+
+    def save(self):
+        """
+        Atomically replace the checkpoint file.
+        """
+        checkpoint_path = self.parts_dir / CHECKPOINT_FILE_NAME
+        temp_path = f"{checkpoint_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'source': self.source, 'crf': self.crf, 'parts': self.parts}, f)
+        os.replace(temp_path, checkpoint_path)
+
+    def get_part_path(self, index: int) -> Path:
+        """
+        Get the file of a part, Matroska stays readable when ffmpeg is killed.
+        """
+        return self.parts_dir / f"part_{index:05d}.mkv"
+
+    def get_encoded(self) -> float:
+        """
+        Get the encoded time, where the next part starts.
+        """
+        return sum(encoded for encoded in self.parts if encoded is not None)
+
+    def is_complete(self) -> bool:
+        """
+        Check if the last part reached the end of the video.
+        """
+        return bool(self.parts) and self.parts[-1] is None
+
+    def add_part(self) -> int:
+        """
+        Record a new part, a previous part cut before its first checkpoint is replaced.
+        """
+        if self.parts and self.parts[-1] == 0:
+            self.parts.pop()
+            self.get_part_path(len(self.parts)).unlink(missing_ok=True)
+        self.parts.append(0)
+        self.save()
+        return len(self.parts) - 1
+
+    def update(self, index: int, encoded: float | None):
+        """
+        Record the encoded time of a part, None when it reached the end of the video.
+        """
+        self.parts[index] = encoded if encoded is None else max(0.0, encoded)
+        self.save()
+
+    def get_concat_entries(self) -> list:
+        """
+        Get the parts to join: (file, time where the part is cut, None to keep it whole).
+        """
+        return [
+            (self.get_part_path(index), encoded) for index, encoded in enumerate(self.parts) if encoded != 0
+        ]
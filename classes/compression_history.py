@@ -0,0 +1,75 @@
+"""
+History of the compression predictions and of their actual results.
+"""
+import json
+import os
+import statistics
+
+# Records kept in the history file
+MAX_RECORDS = 200
+# Recent records used to calibrate a prediction
+CALIBRATION_RECORDS = 20
+
+
+class CompressionHistory:
+    """
+    Persistent list of the completed compressions: the output size and the encode time predicted
+    from the sample slices next to the actual ones. The median error of the recent records
+    calibrates the next predictions, the encode time separately for the segmented mode.
+    """
+
+    def __init__(self, history_path: str):
+        self.history_path = history_path
+        self.records = []
+        self.loaded = False
+
+    def load(self):
+        """
+        Load the history from disk, once.
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.exists(self.history_path):
+            return
+        try:
+            with open(self.history_path, 'r', encoding='utf-8') as f:
+                self.records = json.load(f).get('records', [])
+        except (OSError, ValueError) as e:
+            print(f"Error on loading compression history {self.history_path}: {e}")
+
+    def save(self):
+        """
+        Atomically replace the history file.
+        """
+        os.makedirs(os.path.dirname(self.history_path), exist_ok=True)
+        temp_path = f"{self.history_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'records': self.records}, f)
+        os.replace(temp_path, self.history_path)
+
+    def add(self, record: dict):
+        """
+        Add a completed compression, the oldest records are dropped.
+        """
+        self.load()
+        self.records = (self.records + [record])[-MAX_RECORDS:]
+        self.save()
+
+    def get_calibration(self, segmented: bool) -> tuple:
+        """
+        Get the factors correcting the raw predictions: the median of actual / predicted
+        on the recent records, 1 without history.
+        :return: (size factor, time factor)
+        """
+        self.load()
+        size_factors = [
+            record['actual_ratio'] / record['raw_ratio'] for record in self.records
+            if record['raw_ratio'] > 0
+        ][-CALIBRATION_RECORDS:]
+        time_factors = [
+            record['actual_seconds'] / record['raw_seconds'] for record in self.records
+            if record['segmented'] == segmented and record['raw_seconds'] > 0
+        ][-CALIBRATION_RECORDS:]
+        return (statistics.median(size_factors) if size_factors else 1.0,
+                statistics.median(time_factors) if time_factors else 1.0)
@@ -0,0 +1,153 @@
+"""
+Queue of the videos waiting for the compression.
+"""
+import asyncio
+import collections
+
+
+class CompressionQueue:
+    """
+    FIFO of the downloaded videos to compress, processed by its own workers so a download
+    slot is freed as soon as the file is on disk, while the encoders use the CPU.
+    The transcoders of the videos compressed while downloading are kept here until a worker
+    waits for their last bytes, so the download doesn't wait for the encoder.
+    """
+
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self.queue = collections.deque()
+        self.pending = {}
+        self.running = {}
+        self.progress = {}
+        self.streams = {}
+        self.paused = False
+        self.wakeup = asyncio.Event()
+        # Set when no compression is running
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.tasks = []
+        self.run = None
+        self.on_failure = None
+
+    def start(self, run, on_failure=None):
+        """
+        Start the workers.
+        :param run: async callable compressing a video, returns False if the compression failed
+        :param on_failure: called with a failed video once it is no longer in the queue
+        """
+        self.run = run
+        self.on_failure = on_failure
+        self.tasks = [task for task in self.tasks if not task.done()]
+        while len(self.tasks) < self.workers:
+            self.tasks.append(asyncio.create_task(self.worker()))
+
+    async def stop(self):
+        """
+        Stop the workers and the running compressions.
+        """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        for video_id in list(self.streams):
+            await self.discard_stream(video_id)
+
+    def submit(self, video) -> bool:
+        """
+        Queue a video, unless it is already queued or compressing.
+        """
+        if self.is_pending(video.video_id):
+            return False
+        self.pending[video.video_id] = video
+        self.queue.append(video.video_id)
+        self.wakeup.set()
+        return True
+
+    def is_pending(self, video_id) -> bool:
+        """
+        Check if a video is queued or compressing.
+        """
+        return video_id in self.pending or video_id in self.running
+
+    async def remove(self, video_id):
+        """
+        Remove a queued video, e.g. when it is deleted.
+        """
+        self.pending.pop(video_id, None)
+        await self.discard_stream(video_id)
+
+    def add_stream(self, video_id, transcoder):
+        """
+        Keep the transcoder of a downloaded video until its compression.
+        """
+        self.streams[video_id] = transcoder
+
+    def take_stream(self, video_id):
+        """
+        Get and forget the transcoder of a video, None if it wasn't compressed while downloading.
+        """
+        return self.streams.pop(video_id, None)
+
+    async def discard_stream(self, video_id):
+        """
+        Stop the transcoder of a video, if any, e.g. when the video is deleted or downloaded again.
+        """
+        transcoder = self.take_stream(video_id)
+        if transcoder is not None:
+            await transcoder.cancel()
+
+    def pause(self):
+        """
+        Stop starting the queued compressions, the running ones go on.
+        """
+        self.paused = True
+
+    def resume(self):
+        """
+        Start again the queued compressions.
+        """
+        self.paused = False
+        self.wakeup.set()
+
+    async def wait_idle(self):
+        """
+        Wait until no compression is running.
+        """
+        await self.idle.wait()
+
+    def set_progress(self, video_id, percent: float, fps: float, speed: float):
+        """
+        Store the last progress of a running compression: percentage, frames per second and
+        speed as a multiple of the real time.
+        """
+        self.progress[video_id] = (percent, fps, speed)
+
+    def get_position(self, video_id) -> int | None:
+        """
+        Get the position of a queued video, starting from 1.
+        """
+        queued = [item for item in self.queue if item in self.pending]
+        return queued.index(video_id) + 1 if video_id in queued else None
+
+    async def worker(self):
+        """
+        Compress the queued videos one at a time.
+        """
+        while True:
+            while not self.queue or self.paused:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            video = self.pending.pop(self.queue.popleft(), None)
+            if video is None:
+                continue
+            self.running[video.video_id] = video
+            self.idle.clear()
+            try:
+                succeeded = await self.run(video)
+            finally:
+                self.running.pop(video.video_id, None)
+                self.progress.pop(video.video_id, None)
+                if not self.running:
+                    self.idle.set()
+            if succeeded is False and self.on_failure is not None:
+                self.on_failure(video)
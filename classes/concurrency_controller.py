@@ -0,0 +1,147 @@
+"""
+Adaptive limit of the simultaneous downloads.
+"""
+import asyncio
+import collections
+import contextlib
+import time
+
+from telethon.client.downloads import MIN_CHUNK_SIZE, MAX_CHUNK_SIZE
+
+
+class ConcurrencyController:
+    """
+    AIMD controller of the downloads: a flood wait halves the simultaneous downloads and the
+    request size and pauses every download until it expires, while the API is healthy the
+    request size is doubled back and then one more download is allowed every
+    {increase_interval} seconds, up to {max_limit}.
+    Slots are granted in request order, so the queue priority is kept.
+    """
+
+    def __init__(self, max_limit: int, increase_interval: float = 60):
+        self.max_limit = max(1, max_limit)
+        self.limit = self.max_limit
+        self.active = 0
+        self.request_size = MAX_CHUNK_SIZE
+        self.increase_interval = increase_interval
+        self.pause_until = 0.0
+        self.last_change_time = time.monotonic()
+        self.flood_count = 0
+        self.waiters = collections.deque()
+        self.pause_timer = None
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """
+        Hold a download slot for the duration of the block.
+        """
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self):
+        """
+        Wait for a free slot and for the end of the flood pause.
+        """
+        if not self.waiters and self.active < self.limit and self.pause_time() == 0:
+            self.active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.wake_waiters()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                self.waiters.remove(waiter)
+            raise
+
+    def release(self):
+        """
+        Free a slot.
+        """
+        self.active -= 1
+        self.wake_waiters()
+
+    def wake_waiters(self):
+        """
+        Grant the free slots to the oldest waiters, unless paused.
+        """
+        if self.waiters and self.pause_time() > 0:
+            if self.pause_timer is None:
+                self.pause_timer = asyncio.get_running_loop().call_later(self.pause_time(), self.end_pause)
+            return
+        while self.waiters and self.active < self.limit and self.pause_time() == 0:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def end_pause(self):
+        """
+        Wake the waiters at the end of the flood pause.
+        """
+        self.pause_timer = None
+        self.wake_waiters()
+
+    def pause_time(self) -> float:
+        """
+        Get the seconds left of the flood pause.
+        """
+        return max(0.0, self.pause_until - time.monotonic())
+
+    async def wait_pause(self):
+        """
+        Wait until the flood pause is over.
+        """
+        while self.pause_time() > 0:
+            await asyncio.sleep(self.pause_time())
+
+    def get_request_size(self, request_size: int) -> int:
+        """
+        Limit a request size to the current one.
+        """
+        return min(request_size, self.request_size)
+
+    def on_flood(self, seconds: float, request_size: int):
+        """
+        Multiplicative decrease after a flood wait.
+        :param seconds: seconds requested by Telegram
+        :param request_size: request size in use when the flood wait happened
+        """
+        now = time.monotonic()
+        self.flood_count += 1
+        self.limit = max(1, self.limit // 2)
+        self.request_size = max(MIN_CHUNK_SIZE, min(self.request_size, request_size) // 2)
+        self.pause_until = max(self.pause_until, now + seconds)
+        self.last_change_time = max(now, self.pause_until)
+        if self.pause_timer is not None:
+            self.pause_timer.cancel()
+            self.pause_timer = None
+        self.wake_waiters()
+
+    def on_success(self):
+        """
+        Additive increase, called for every chunk received.
+        """
+        now = time.monotonic()
+        if now - self.last_change_time < self.increase_interval:
+            return
+        if self.request_size < MAX_CHUNK_SIZE:
+            self.request_size *= 2
+        elif self.limit < self.max_limit:
+            self.limit += 1
+            self.wake_waiters()
+        self.last_change_time = now
+
+    def set_max_limit(self, max_limit: int):
+        """
+        Change the maximum number of simultaneous downloads.
+        """
+        self.max_limit = max(1, max_limit)
+        self.limit = min(self.limit, self.max_limit)
+        self.wake_waiters()
@@ -6,12 +6,13 @@ class CustomFloodError(Exception):
     """
     CustomFloodError class
     """
-    def __init__(self, message, *args):
+    def __init__(self, message, *args, seconds=None):
         """
         Initialize the CustomFloodError
         """
         super().__init__(message, *args)
         self.message = message
+        self.seconds = seconds
 
     def __str__(self):
         """
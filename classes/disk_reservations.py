@@ -0,0 +1,92 @@
+"""
+Ledger of the disk space reserved by the downloads in progress.
+"""
+import os
+import shutil
+
+
+def get_existing_path(path: str) -> str:
+    """
+    Get the path or its nearest existing parent, e.g. for a folder not created yet.
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def get_device(path: str) -> int:
+    """
+    Get the filesystem of a path.
+    """
+    return os.stat(get_existing_path(path)).st_dev
+
+
+class DiskReservations:
+    """
+    Space reserved on every filesystem (by st_dev) by the admitted downloads: the bytes still
+    to write of the temp file, the estimated compressed file and the copy to the completed
+    folder when it is on another filesystem. A download is admitted only if its space fits
+    in the free space minus the space reserved by the others, the written bytes are
+    consumed from the reservation as they land on disk.
+    """
+
+    def __init__(self):
+        self.reservations = {}
+        self.download_devices = {}
+
+    def get_reserved(self, device: int, exclude=None) -> int:
+        """
+        Get the space reserved on a filesystem, without the reservation of {exclude}.
+        """
+        return sum(
+            devices.get(device, 0) for key, devices in self.reservations.items() if key != exclude
+        )
+
+    def reserve(self, key, requirements: list, threshold_percentage: int) -> str | None:
+        """
+        Reserve the space of a download if it fits on every filesystem.
+        :param key:
+        :param requirements: list of (path, bytes), the first one is the temp file
+        :param threshold_percentage: the maximum used percentage of a filesystem
+        :return: None if reserved, otherwise the path that doesn't fit
+        """
+        devices = {}
+        paths = {}
+        for path, size in requirements:
+            device = get_device(path)
+            devices[device] = devices.get(device, 0) + max(0, size)
+            paths.setdefault(device, path)
+        for device, size in devices.items():
+            reserved = self.get_reserved(device, key)
+            # A download too large even for an empty ledger is admitted, the disk space limit stops it
+            if reserved > 0 and not self.fits(paths[device], size + reserved, threshold_percentage):
+                return paths[device]
+        self.reservations[key] = devices
+        self.download_devices[key] = get_device(requirements[0][0])
+        return None
+
+    @staticmethod
+    def fits(path: str, size: int, threshold_percentage: int) -> bool:
+        """
+        Check if {size} bytes can be written on the filesystem of a path within the threshold.
+        """
+        total, _, free = shutil.disk_usage(get_existing_path(path))
+        remaining_space = free - size
+        return remaining_space > 0 and remaining_space / total * 100 > 100 - threshold_percentage
+
+    def consume(self, key, amount: int):
+        """
+        Reduce a reservation by the bytes written in the temp file.
+        """
+        devices = self.reservations.get(key)
+        device = self.download_devices.get(key)
+        if devices is not None and device in devices:
+            devices[device] = max(0, devices[device] - amount)
+
+    def release(self, key):
+        """
+        Release the space of a download, completed or stopped.
+        """
+        self.reservations.pop(key, None)
+        self.download_devices.pop(key, None)
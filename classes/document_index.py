@@ -0,0 +1,102 @@
+"""
+Index of the Telegram documents already acquired, used to skip the duplicates.
+"""
+import json
+import os
+
+
+def get_document_key(document) -> str | None:
+    """
+    Get the identity of a Telegram document: id, access hash and size.
+    """
+    if document is None or getattr(document, 'id', None) is None:
+        return None
+    return f"{document.id}:{document.access_hash}:{document.size}"
+
+
+class DocumentIndex:
+    """
+    Persistent map from the document key to the first video acquired with that document and,
+    once downloaded, its completed file. With the content hash enabled the completed files are
+    also indexed by sha256, so identical files uploaded as different documents are linked.
+    """
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self.documents = {}
+        self.hashes = {}
+        self.loaded = False
+
+    def load(self):
+        """
+        Load the index from disk, once.
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error on loading document index {self.index_path}: {e}")
+            return
+        self.documents = data.get('documents', {})
+        self.hashes = data.get('hashes', {})
+
+    def save(self):
+        """
+        Atomically replace the index file.
+        """
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'documents': self.documents, 'hashes': self.hashes}, f)
+        os.replace(temp_path, self.index_path)
+
+    def get(self, document_key: str | None) -> dict | None:
+        """
+        Get the entry of a document.
+        """
+        self.load()
+        return self.documents.get(document_key) if document_key is not None else None
+
+    def add(self, document_key: str | None, video_id: int):
+        """
+        Register the first video of a document.
+        """
+        self.load()
+        if document_key is None or document_key in self.documents:
+            return
+        self.documents[document_key] = {'video_id': video_id, 'completed_path': None}
+        self.save()
+
+    def set_completed(self, document_key: str | None, completed_path: str, content_hash: str | None = None):
+        """
+        Store the completed file of a document and, optionally, its content hash.
+        """
+        self.load()
+        if document_key is not None and document_key in self.documents:
+            self.documents[document_key]['completed_path'] = completed_path
+        if content_hash is not None:
+            self.hashes.setdefault(content_hash, completed_path)
+        self.save()
+
+    def get_path_by_hash(self, content_hash: str) -> str | None:
+        """
+        Get the completed file with the same content, if it still exists.
+        """
+        self.load()
+        path = self.hashes.get(content_hash)
+        return path if path is not None and os.path.exists(path) else None
+
+    def remove(self, document_key: str | None, video_id: int):
+        """
+        Remove a document owned by a video, e.g. when the video is deleted before completion.
+        """
+        self.load()
+        entry = self.documents.get(document_key)
+        if entry is not None and entry['video_id'] == video_id and entry['completed_path'] is None:
+            del self.documents[document_key]
+            self.save()
@@ -0,0 +1,246 @@
+"""
+Event-driven queue of the downloads.
+"""
+import asyncio
+import heapq
+import itertools
+
+from classes.queue_policy import QueuePolicy
+
+# Seconds before an unfinished video goes back in the queue
+REQUEUE_DELAY = 30
+# Seconds before the videos not admitted are tried again, if no download frees its space first
+ADMISSION_RETRY_DELAY = 60
+
+
+class DownloadScheduler:
+    """
+    Priority queue of the videos to download (pinned first, then in the order of the policy),
+    fed by the acquisition, command and deletion events instead of rescanning the videos_data folder.
+    The dispatcher takes a slot of the concurrency controller and starts the first video
+    of the queue as soon as a slot is free. A video not admitted (e.g. no disk space yet) is
+    delayed and queued again when a download ends.
+    """
+
+    def __init__(self, policy: QueuePolicy | None = None):
+        self.policy = policy or QueuePolicy()
+        self.heap = []
+        self.queued = {}
+        self.sequences = {}
+        self.running = {}
+        self.delayed = {}
+        self.delay_timer = None
+        self.admit = None
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.dispatcher = None
+        self.on_idle = None
+
+    def get_priority(self, video) -> tuple:
+        """
+        Get the sort key of a video.
+        """
+        return not video.pinned, *self.policy.get_key(video)
+
+    def set_policy(self, policy: QueuePolicy):
+        """
+        Change the ordering policy and sort again the queued videos.
+        """
+        self.policy = policy
+        self.heap = []
+        for video in sorted(self.queued.values(), key=lambda item: item.video_id):
+            self.policy.on_enqueue(video)
+            self.push(video)
+
+    def start(self, on_idle=None, admit=None):
+        """
+        Start the dispatcher.
+        :param on_idle: called when the queue is empty and no download is running
+        :param admit: called with the first video of the queue, False delays it
+        """
+        self.on_idle = on_idle
+        self.admit = admit
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+
+    async def stop(self):
+        """
+        Stop the dispatcher and the running downloads.
+        """
+        if self.delay_timer is not None:
+            self.delay_timer.cancel()
+        tasks = list(self.running.values())
+        if self.dispatcher is not None:
+            tasks.append(self.dispatcher)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def load(self, videos: list):
+        """
+        Queue the videos not yet completed.
+        :param videos: list of (file name, ObjectData)
+        """
+        for _, video in videos:
+            if video is not None and not video.completed:
+                self.enqueue(video)
+
+    def enqueue(self, video):
+        """
+        Add a video to the queue, unless it is already queued or running.
+        """
+        if video.video_id in self.queued or video.video_id in self.running or video.video_id in self.delayed:
+            return
+        self.queued[video.video_id] = video
+        self.policy.on_enqueue(video)
+        self.push(video)
+
+    def push(self, video):
+        """
+        Push a video in the heap, the old entries of the same video are skipped on pop.
+        """
+        sequence = next(self.counter)
+        self.sequences[video.video_id] = sequence
+        heapq.heappush(self.heap, (self.get_priority(video), sequence, video))
+        self.wakeup.set()
+
+    def is_current(self, sequence: int, video) -> bool:
+        """
+        Check if a heap entry is the last one pushed for a queued video.
+        """
+        return self.queued.get(video.video_id) is video and self.sequences.get(video.video_id) == sequence
+
+    def pop(self):
+        """
+        Get the first admitted video of the queue, None if there is none.
+        """
+        while self.heap:
+            priority, sequence, video = heapq.heappop(self.heap)
+            if not self.is_current(sequence, video):
+                continue
+            del self.queued[video.video_id]
+            del self.sequences[video.video_id]
+            if self.admit is not None and self.admit(video) is False:
+                self.delay(video)
+                continue
+            self.policy.on_pop(video, priority[1:])
+            return video
+        return None
+
+    def delay(self, video):
+        """
+        Keep a video out of the queue until a download ends or ADMISSION_RETRY_DELAY passes.
+        """
+        self.delayed[video.video_id] = video
+        if self.delay_timer is None:
+            self.delay_timer = asyncio.get_running_loop().call_later(
+                ADMISSION_RETRY_DELAY, self.resume_delayed)
+
+    def resume_delayed(self):
+        """
+        Queue again the delayed videos.
+        """
+        if self.delay_timer is not None:
+            self.delay_timer.cancel()
+            self.delay_timer = None
+        delayed, self.delayed = self.delayed, {}
+        for video in delayed.values():
+            self.enqueue(video)
+
+    def get_head(self, count: int) -> list:
+        """
+        Get the first {count} queued videos.
+        """
+        entries = [
+            video for _, sequence, video in heapq.nsmallest(count * 2, self.heap)
+            if self.is_current(sequence, video)
+        ]
+        return entries[:count]
+
+    def remove(self, video_id):
+        """
+        Remove a video from the queue and stop its download, e.g. when it is deleted.
+        """
+        self.queued.pop(video_id, None)
+        self.sequences.pop(video_id, None)
+        self.delayed.pop(video_id, None)
+        task = self.running.get(video_id)
+        if task is not None:
+            task.cancel()
+
+    def set_pinned(self, video_id, pinned: bool):
+        """
+        Move a queued video after a pin change.
+        """
+        video = self.queued.get(video_id)
+        if video is not None and video.pinned != pinned:
+            video.pinned = pinned
+            self.push(video)
+
+    def set_deadline(self, video_id, deadline: float | None):
+        """
+        Move a queued video after a deadline change.
+        """
+        video = self.queued.get(video_id)
+        if video is not None and video.deadline != deadline:
+            video.deadline = deadline
+            self.push(video)
+
+    def is_idle(self) -> bool:
+        """
+        Check if the queue is empty and no download is running or delayed.
+        """
+        return not self.queued and not self.running and not self.delayed
+
+    def is_ready(self) -> bool:
+        """
+        Check if a download can start.
+        """
+        from func.main import operation_status
+        return bool(self.queued) and operation_status.start_download is True \
+            and operation_status.quit_program is not True
+
+    async def dispatch(self):
+        """
+        Start the queued downloads as the slots of the concurrency controller free up.
+        """
+        from func.main import concurrency_controller
+        while True:
+            while not self.is_ready():
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            await concurrency_controller.acquire()
+            # The queue can change while waiting the slot, the first video is taken only now
+            video = self.pop() if self.is_ready() else None
+            if video is None:
+                concurrency_controller.release()
+                continue
+            self.running[video.video_id] = asyncio.create_task(self.run_video(video))
+
+    async def run_video(self, video):
+        """
+        Download a video holding a slot, an unfinished video goes back in the queue.
+        """
+        from func.main import concurrency_controller, process_video_download
+        try:
+            await process_video_download(video)
+        finally:
+            concurrency_controller.release()
+            self.running.pop(video.video_id, None)
+            self.requeue_later(video)
+            # The space or the resources of this download are free now
+            self.resume_delayed()
+            if self.is_idle() and self.on_idle is not None:
+                await self.on_idle()
+
+    def requeue_later(self, video):
+        """
+        Queue again after REQUEUE_DELAY seconds a video still to complete.
+        """
+        from func.main import compression_queue
+        from func.telegram_client import get_video_data_by_message_id_reference
+        video_data = get_video_data_by_message_id_reference(video.message_id_reference)
+        # A video waiting for the compression is already downloaded
+        if video_data is None or video_data.completed or compression_queue.is_pending(video.video_id):
+            return
+        asyncio.get_running_loop().call_later(REQUEUE_DELAY, self.enqueue, video_data)
@@ -0,0 +1,21 @@
+"""
+DownloadStallError class
+
+"""
+class DownloadStallError(Exception):
+    """
+    Raised when a download stream receives no data for the stall timeout
+    """
+    def __init__(self, message, *args, offset=None):
+        """
+        Initialize the DownloadStallError
+        """
+        super().__init__(message, *args)
+        self.message = message
+        self.offset = offset
+
+    def __str__(self):
+        """
+        Return the string representation of the DownloadStallError
+        """
+        return f"DownloadStallError: {self.message}"
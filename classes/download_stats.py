@@ -0,0 +1,141 @@
+"""
+Progress statistics of the running downloads.
+"""
+import time
+
+# Seconds between two samples of the speed
+SPEED_SAMPLE_INTERVAL = 1
+# Weight of the last sample in the average speed
+SPEED_SMOOTHING = 0.3
+
+
+class DownloadStats:
+    """
+    Progress of a single download: bytes, smoothed speed (EWMA) and time since the last byte.
+    """
+
+    def __init__(self, key, file_size: int, initial_bytes: int = 0):
+        now = time.monotonic()
+        self.key = key
+        self.file_size = file_size
+        self.bytes_done = initial_bytes
+        self.session_bytes = 0
+        self.speed = 0.0
+        self.start_time = now
+        self.last_byte_time = now
+        self.last_sample_time = now
+        self.last_sample_bytes = initial_bytes
+        self.last_report_time = now
+        self.stalls = 0
+
+    def add_bytes(self, amount: int):
+        """
+        Account {amount} bytes received, the speed is sampled every SPEED_SAMPLE_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        self.bytes_done += amount
+        self.session_bytes += amount
+        self.last_byte_time = now
+        elapsed = now - self.last_sample_time
+        if elapsed >= SPEED_SAMPLE_INTERVAL:
+            sample = (self.bytes_done - self.last_sample_bytes) / elapsed
+            self.speed = sample if self.speed == 0 else \
+                SPEED_SMOOTHING * sample + (1 - SPEED_SMOOTHING) * self.speed
+            self.last_sample_time = now
+            self.last_sample_bytes = self.bytes_done
+
+    def percent(self) -> float:
+        """
+        Get the completed percentage.
+        """
+        return self.bytes_done / self.file_size * 100 if self.file_size > 0 else 0
+
+    def time_remaining(self) -> float:
+        """
+        Get the estimated seconds to complete the download, inf if unknown.
+        """
+        if self.speed <= 0:
+            return float('inf')
+        return max(0, self.file_size - self.bytes_done) / self.speed
+
+    def stall_time(self) -> float:
+        """
+        Get the seconds since the last byte was received.
+        """
+        return time.monotonic() - self.last_byte_time
+
+    def should_report(self, interval: float) -> bool:
+        """
+        Check if at least {interval} seconds passed since the last report, and start a new one.
+        """
+        now = time.monotonic()
+        if now - self.last_report_time < interval:
+            return False
+        self.last_report_time = now
+        return True
+
+
+class DownloadStatsRegistry:
+    """
+    Statistics of the running downloads, by key.
+    """
+
+    def __init__(self):
+        self.downloads = {}
+        self.groups = {}
+        self.group_speeds = {}
+        self.stall_count = 0
+
+    def start(self, key, file_size: int, initial_bytes: int = 0, group=None) -> DownloadStats:
+        """
+        Create the statistics of a download.
+        :param group: the speed of the download is averaged with the others of the group, e.g. the chat
+        """
+        stats = DownloadStats(key, file_size, initial_bytes)
+        self.downloads[key] = stats
+        self.groups[key] = group
+        return stats
+
+    def stop(self, key):
+        """
+        Remove a download, its last speed is averaged in the speed of its group.
+        """
+        stats = self.downloads.pop(key, None)
+        group = self.groups.pop(key, None)
+        if stats is None or group is None or stats.speed <= 0:
+            return
+        group_speed = self.group_speeds.get(group)
+        self.group_speeds[group] = stats.speed if group_speed is None else \
+            SPEED_SMOOTHING * stats.speed + (1 - SPEED_SMOOTHING) * group_speed
+
+    def add_stall(self, key):
+        """
+        Count a stalled stream of a download.
+        """
+        self.stall_count += 1
+        stats = self.downloads.get(key)
+        if stats is not None:
+            stats.stalls += 1
+
+    def get_expected_speed(self, group) -> float:
+        """
+        Get the expected speed of a download of a group: the average of the group, otherwise
+        the average of all the groups, 1 if nothing was measured yet.
+        """
+        if group in self.group_speeds:
+            return self.group_speeds[group]
+        if self.group_speeds:
+            return sum(self.group_speeds.values()) / len(self.group_speeds)
+        return 1
+
+    def get(self, key) -> DownloadStats | None:
+        """
+        Get the statistics of a download, None if it is not running.
+        """
+        return self.downloads.get(key)
+
+    def total_speed(self) -> float:
+        """
+        Get the sum of the speeds of the running downloads.
+        """
+        return sum(stats.speed for stats in self.downloads.values())
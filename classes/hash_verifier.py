@@ -0,0 +1,149 @@
+"""
+Verification of the downloaded data with the hashes of Telegram.
+"""
+import asyncio
+import hashlib
+
+# Maximum number of blocks hashed at the same time
+MAX_VERIFY_JOBS = 4
+
+
+def sha256(data) -> bytes:
+    """
+    Get the sha256 digest of {data}, runs on a worker thread.
+    """
+    return hashlib.sha256(data).digest()
+
+
+class HashVerifier:
+    """
+    The chunks of a download are collected in the blocks of upload.getFileHashes, every
+    complete block is hashed on a worker thread while the download goes on and it is written
+    only if it matches, the ranges of the blocks not matching are kept to be fetched again.
+    The hashes are requested one batch ahead of the blocks being verified.
+    """
+
+    def __init__(self, fetch_hashes, file_size: int, write):
+        """
+        :param fetch_hashes: async callable returning the FileHash list starting at an offset
+        :param file_size:
+        :param write: async callable writing a verified block, (offset, data)
+        """
+        self.fetch_hashes = fetch_hashes
+        self.file_size = file_size
+        self.write = write
+        self.hashes = {}
+        self.block_size = None
+        self.blocks = {}
+        self.failed = []
+        self.jobs = set()
+        self.job_slots = asyncio.Semaphore(MAX_VERIFY_JOBS)
+        self.hash_lock = asyncio.Lock()
+        self.lookahead = None
+        self.error = None
+
+    async def start(self):
+        """
+        Load the first batch of hashes, it defines the block size.
+        """
+        await self.load_hashes(0)
+        if self.block_size is None:
+            raise ValueError('upload.getFileHashes returned no hash')
+
+    async def load_hashes(self, offset: int):
+        """
+        Load the batch of hashes starting at {offset} and request the next one in background.
+        """
+        async with self.hash_lock:
+            if offset in self.hashes:
+                return
+            for file_hash in await self.fetch_hashes(offset):
+                self.hashes[file_hash.offset] = file_hash
+                if self.block_size is None:
+                    self.block_size = file_hash.limit
+        if not self.hashes:
+            return
+        last_hash = self.hashes[max(self.hashes)]
+        next_offset = last_hash.offset + last_hash.limit
+        if next_offset < self.file_size and next_offset not in self.hashes \
+                and (self.lookahead is None or self.lookahead.done()):
+            self.lookahead = asyncio.create_task(self.load_hashes(next_offset))
+
+    def get_block_length(self, block_offset: int) -> int:
+        """
+        Get the length of a block, the last one can be shorter.
+        """
+        return min(self.block_size, self.file_size - block_offset)
+
+    async def submit(self, offset: int, data: bytes):
+        """
+        Add a downloaded chunk, the blocks it completes are verified in background.
+        """
+        self.raise_error()
+        end = offset + len(data)
+        position = offset
+        while position < end:
+            block_offset = position - position % self.block_size
+            part_end = min(block_offset + self.block_size, end)
+            parts = self.blocks.setdefault(block_offset, {})
+            parts[position] = data[position - offset:part_end - offset]
+            position = part_end
+            if sum(len(part) for part in parts.values()) >= self.get_block_length(block_offset):
+                del self.blocks[block_offset]
+                await self.job_slots.acquire()
+                job = asyncio.create_task(self.verify(block_offset, parts))
+                self.jobs.add(job)
+                job.add_done_callback(self.jobs.discard)
+
+    async def verify(self, block_offset: int, parts: dict):
+        """
+        Hash a block and write it if it matches.
+        """
+        try:
+            data = b''.join(parts[part_offset] for part_offset in sorted(parts))
+            if block_offset not in self.hashes:
+                await self.load_hashes(block_offset)
+            expected = self.hashes.get(block_offset)
+            digest = await asyncio.to_thread(sha256, data)
+            if expected is None or digest != expected.hash:
+                print(f"Hash mismatch in the range {block_offset}-{block_offset + len(data)}")
+                self.failed.append([block_offset, block_offset + len(data)])
+            else:
+                await self.write(block_offset, data)
+        except Exception as e:  # pylint: disable=broad-except
+            self.error = e
+        finally:
+            self.job_slots.release()
+
+    def raise_error(self):
+        """
+        Raise the error of a verification, if any.
+        """
+        if self.error is not None:
+            raise self.error
+
+    async def drain(self):
+        """
+        Wait for the blocks being verified.
+        """
+        while self.jobs:
+            await asyncio.gather(*self.jobs, return_exceptions=True)
+        self.raise_error()
+
+    def take_failed(self) -> list:
+        """
+        Get and clear the ranges that failed the verification.
+        """
+        failed, self.failed = self.failed, []
+        return failed
+
+    async def close(self):
+        """
+        Wait for the running verifications and stop the hash requests,
+        the incomplete blocks are dropped and will be downloaded again.
+        """
+        await asyncio.gather(*self.jobs, return_exceptions=True)
+        if self.lookahead is not None:
+            self.lookahead.cancel()
+            await asyncio.gather(self.lookahead, return_exceptions=True)
+        self.blocks = {}
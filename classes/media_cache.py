@@ -0,0 +1,124 @@
+"""
+Cache of the media handles of the queued videos.
+"""
+import asyncio
+import time
+
+# Seconds after which the file reference of a media is considered stale
+MEDIA_MAX_AGE = 3600
+# Seconds before the staleness at which the refresher fetches the media again
+MEDIA_REFRESH_MARGIN = 600
+# Seconds between two runs of the refresher
+MEDIA_REFRESH_INTERVAL = 60
+
+
+class MediaCache:
+    """
+    Media of the videos keyed by document id, with the time the file reference was fetched.
+    The media is fetched again only when it is stale or its file reference expired,
+    a background refresher keeps fresh the media of the videos at the head of the queue.
+    """
+
+    def __init__(self, max_age: float = MEDIA_MAX_AGE):
+        self.max_age = max_age
+        self.entries = {}
+        self.documents = {}
+        self.refresher = None
+
+    def store(self, video, media, fetch_time: float | None = None):
+        """
+        Store the media of a video.
+        :param fetch_time: the monotonic time the message of the media was fetched, now if None,
+                           e.g. the time of a prefetched message
+        """
+        document = getattr(media, 'document', None)
+        if document is None:
+            return
+        self.entries[document.id] = (time.monotonic() if fetch_time is None else fetch_time, media)
+        self.documents[video.video_id] = document.id
+
+    def get_age(self, video) -> float | None:
+        """
+        Get the seconds since the media of a video was fetched, None if not cached.
+        """
+        entry = self.entries.get(self.documents.get(video.video_id))
+        return time.monotonic() - entry[0] if entry is not None else None
+
+    def get_cached(self, video):
+        """
+        Get the media of a video if cached and not stale.
+        """
+        age = self.get_age(video)
+        if age is None or age > self.max_age:
+            return None
+        return self.entries[self.documents[video.video_id]][1]
+
+    def get_dc_ids(self) -> set:
+        """
+        Get the data centers of the cached media.
+        """
+        return {media.document.dc_id for _, media in self.entries.values()}
+
+    def invalidate(self, video):
+        """
+        Drop the media of a video, e.g. when its file reference expired.
+        """
+        document_id = self.documents.pop(video.video_id, None)
+        self.entries.pop(document_id, None)
+
+    async def fetch(self, video):
+        """
+        Fetch the message of the video (the source message for the protected chats).
+        :return: the media, None if the message doesn't exist anymore
+        """
+        from func.main import client
+        from run import PERSONAL_CHAT_ID
+        if video.is_forward_chat_protected is True:
+            message = await client.get_messages(video.chat_name, ids=video.video_id)
+        else:
+            message = await client.get_messages(PERSONAL_CHAT_ID, ids=video.message_id_reference)
+        if message is None or message.media is None:
+            self.invalidate(video)
+            return None
+        self.store(video, message.media)
+        return message.media
+
+    async def get_media(self, video):
+        """
+        Get the media of a video, fetched only if missing or stale.
+        """
+        media = self.get_cached(video)
+        if media is not None:
+            return media
+        return await self.fetch(video)
+
+    def start_refresher(self, get_videos):
+        """
+        Start the background refresher.
+        :param get_videos: callable returning the videos to keep fresh
+        """
+        if self.refresher is None or self.refresher.done():
+            self.refresher = asyncio.create_task(self.refresh_loop(get_videos))
+
+    async def stop_refresher(self):
+        """
+        Stop the background refresher.
+        """
+        if self.refresher is not None:
+            self.refresher.cancel()
+            await asyncio.gather(self.refresher, return_exceptions=True)
+
+    async def refresh_loop(self, get_videos):
+        """
+        Fetch again the media close to be stale.
+        """
+        while True:
+            await asyncio.sleep(MEDIA_REFRESH_INTERVAL)
+            for video in get_videos():
+                age = self.get_age(video)
+                if age is None or age < self.max_age - MEDIA_REFRESH_MARGIN:
+                    continue
+                try:
+                    await self.fetch(video)
+                except Exception as e:  # pylint: disable=broad-except
+                    print(f"Error on refreshing the media of {video.video_id}: {e}")
@@ -0,0 +1,67 @@
+"""
+Bulk fetch of the messages needed to prepare the download queue.
+"""
+import time
+
+# Maximum number of ids of a single messages.getMessages request
+MESSAGES_PER_REQUEST = 100
+# Seconds after which a prefetched message is considered stale
+PREFETCH_MAX_AGE = 3600
+
+
+class MessagePrefetch:
+    """
+    Messages fetched in chunks of MESSAGES_PER_REQUEST ids, every message is taken once by the
+    queue preparation instead of being requested alone.
+    """
+
+    def __init__(self):
+        self.messages = {}
+
+    async def fetch(self, chat, ids: list):
+        """
+        Fetch the messages {ids} of {chat}, the missing ones are stored as None.
+        The stale messages are dropped.
+        """
+        from func.main import client
+        self.messages = {
+            key: value for key, value in self.messages.items()
+            if time.monotonic() - value[0] <= PREFETCH_MAX_AGE
+        }
+        ids = list(dict.fromkeys(message_id for message_id in ids if message_id is not None))
+        for index in range(0, len(ids), MESSAGES_PER_REQUEST):
+            chunk = ids[index:index + MESSAGES_PER_REQUEST]
+            messages = await client.get_messages(chat, ids=chunk)
+            now = time.monotonic()
+            for message_id, message in zip(chunk, messages):
+                self.messages[(chat, message_id)] = (now, message)
+
+    def peek(self, chat, message_id) -> tuple:
+        """
+        Get a prefetched message without taking it.
+        :return: (fetch time, message), (None, None) if missing
+        """
+        return self.messages.get((chat, message_id), (None, None))
+
+    def take(self, chat, message_id) -> tuple:
+        """
+        Take a prefetched message.
+        :return: (True, message or None if it doesn't exist) or (False, None) if it must be fetched
+        """
+        fetch_time, message = self.messages.pop((chat, message_id), (None, None))
+        if fetch_time is None or time.monotonic() - fetch_time > PREFETCH_MAX_AGE:
+            return False, None
+        return True, message
+
+    async def get_message(self, chat, message_id) -> tuple:
+        """
+        Get a message, prefetched if available.
+        :return: (the monotonic time the message was fetched, message or None if it doesn't exist)
+        """
+        fetch_time = self.messages.get((chat, message_id), (None, None))[0]
+        found, message = self.take(chat, message_id)
+        if found:
+            return fetch_time, message
+        from func.main import client
+        fetch_time = time.monotonic()
+        return fetch_time, await client.get_messages(chat, ids=message_id)
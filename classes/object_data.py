@@ -29,6 +29,8 @@ class ObjectData:
         self.file_name = None
         self.file_path = None
         self.pinned = False
+        self.document_key = None
+        self.deadline = None
         for key, value in kwargs.items():
             setattr(self, key, value)
 
@@ -0,0 +1,87 @@
+"""
+Persistent cache of the ffprobe results.
+"""
+import json
+import os
+import threading
+
+
+def get_file_identity(path: str) -> list | None:
+    """
+    Identify the version of a file: size and modification time, None if missing.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class ProbeCache:
+    """
+    Persistent map from the path of a file to the values probed on it (e.g. the streams,
+    the keyframes), valid while the size and the modification time of the file don't change.
+    The files no longer existing are dropped when the cache is loaded.
+    Used from worker threads, the probes run outside the event loop.
+    """
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self.entries = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the cache from disk, once.
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f).get('entries', {})
+        except (OSError, ValueError) as e:
+            print(f"Error on loading probe cache {self.cache_path}: {e}")
+            return
+        self.entries = {path: entry for path, entry in entries.items() if os.path.exists(path)}
+
+    def save(self):
+        """
+        Atomically replace the cache file.
+        """
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        temp_path = f"{self.cache_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'entries': self.entries}, f)
+        os.replace(temp_path, self.cache_path)
+
+    def get(self, path, key: str):
+        """
+        Get a value probed on a file, None if not probed or if the file changed since.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            self.load()
+            entry = self.entries.get(path)
+            if entry is None or entry['identity'] != get_file_identity(path):
+                return None
+            return entry['values'].get(key)
+
+    def set(self, path, key: str, value):
+        """
+        Store a value probed on a file, the values of a previous version of the file are dropped.
+        """
+        path = os.path.abspath(path)
+        identity = get_file_identity(path)
+        if identity is None:
+            return
+        with self.lock:
+            self.load()
+            entry = self.entries.get(path)
+            if entry is None or entry['identity'] != identity:
+                entry = self.entries[path] = {'identity': identity, 'values': {}}
+            entry['values'][key] = value
+            self.save()
@@ -0,0 +1,107 @@
+"""
+Ordering policies of the download queue.
+"""
+
+
+def get_video_size(video) -> int:
+    """
+    Get the size of the document of a video, from the media or from the document key.
+    """
+    document = getattr(getattr(video, 'video_media', None), 'document', None)
+    if document is not None:
+        return document.size
+    if video.document_key is not None:
+        return int(video.document_key.rsplit(':', 1)[-1])
+    return 0
+
+
+class QueuePolicy:
+    """
+    Base policy, the sort key of a video is computed when it is pushed in the queue,
+    the pinned videos always come first regardless of the policy.
+    """
+    name = 'fifo'
+
+    def on_enqueue(self, video):
+        """
+        Called once when a video enters the queue, before it is pushed.
+        """
+
+    def get_key(self, video) -> tuple:
+        """
+        Get the sort key of a video, the lowest is downloaded first.
+        """
+        return (video.video_id,)
+
+    def on_pop(self, video, key: tuple):
+        """
+        Called when a video leaves the queue to be downloaded.
+        """
+
+
+class SmallestFirstPolicy(QueuePolicy):
+    """
+    The smallest documents first.
+    """
+    name = 'smallest'
+
+    def get_key(self, video) -> tuple:
+        return get_video_size(video), video.video_id
+
+
+class ShortestTimePolicy(QueuePolicy):
+    """
+    The documents with the shortest estimated download time first, from the speed
+    measured on the previous downloads of the same chat.
+    """
+    name = 'shortest_time'
+
+    def get_key(self, video) -> tuple:
+        from func.main import download_stats
+        return get_video_size(video) / download_stats.get_expected_speed(video.chat_id), video.video_id
+
+
+class RoundRobinPolicy(QueuePolicy):
+    """
+    One video per chat in turn: every video gets the round after the last one of its chat
+    and after the round being downloaded, so a chat with many videos doesn't starve the others.
+    """
+    name = 'round_robin'
+
+    def __init__(self):
+        self.current_round = 0
+        self.last_rounds = {}
+
+    def on_enqueue(self, video):
+        video.queue_round = max(self.last_rounds.get(video.chat_id, 0), self.current_round) + 1
+        self.last_rounds[video.chat_id] = video.queue_round
+
+    def get_key(self, video) -> tuple:
+        return video.queue_round, video.video_id
+
+    def on_pop(self, video, key: tuple):
+        self.current_round = max(self.current_round, key[0])
+
+
+class DeadlinePolicy(QueuePolicy):
+    """
+    The earliest deadline first, the videos without a deadline after them in arrival order.
+    """
+    name = 'deadline'
+
+    def get_key(self, video) -> tuple:
+        deadline = video.deadline
+        return deadline is None, deadline or 0, video.video_id
+
+
+QUEUE_POLICIES = {
+    policy.name: policy for policy in
+    (QueuePolicy, SmallestFirstPolicy, ShortestTimePolicy, RoundRobinPolicy, DeadlinePolicy)
+}
+
+
+def create_queue_policy(name: str) -> QueuePolicy:
+    """
+    Create a policy by name, the default one (fifo) if the name is unknown.
+    """
+    return QUEUE_POLICIES.get(name, QueuePolicy)()
@@ -0,0 +1,143 @@
+"""
+Journal of the byte ranges durably written in a partial download.
+"""
+import asyncio
+import json
+import os
+import time
+
+FSYNC_POLICY_ALWAYS = 'always'
+FSYNC_POLICY_INTERVAL = 'interval'
+FSYNC_POLICY_NEVER = 'never'
+
+FSYNC_POLICIES = [FSYNC_POLICY_ALWAYS, FSYNC_POLICY_INTERVAL, FSYNC_POLICY_NEVER]
+
+
+def merge_ranges(ranges: list) -> list:
+    """
+    Sort and merge overlapping or adjacent [start, end) ranges.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class RangeJournal:
+    """
+    Sidecar file of a preallocated partial download, it lists the ranges already on disk.
+    Written ranges are first kept in memory and stored in the journal on commit, after the
+    data file is synced as requested by the fsync policy, so the journal never lists
+    bytes that could be lost.
+    """
+
+    def __init__(self, journal_path: str, file_size: int, ranges: list | None = None,
+                 fsync_policy: str = FSYNC_POLICY_INTERVAL, fsync_interval: float = 5):
+        self.journal_path = journal_path
+        self.file_size = file_size
+        self.ranges = merge_ranges(ranges or [])
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.pending = []
+        self.last_commit_time = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def load_ranges(journal_path: str, file_size: int) -> list | None:
+        """
+        Load the ranges of a journal, None if it is missing or belongs to another file.
+        """
+        if not os.path.exists(journal_path):
+            return None
+        try:
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error on loading journal {journal_path}: {e}")
+            return None
+        if data.get('file_size') != file_size:
+            return None
+        return data.get('ranges', [])
+
+    def mark_written(self, offset: int, length: int):
+        """
+        Register a range written in the file but not yet committed.
+        """
+        self.pending.append([offset, offset + length])
+
+    def should_commit(self) -> bool:
+        """
+        Check if the written ranges must be committed now.
+        """
+        if not self.pending:
+            return False
+        if self.fsync_policy == FSYNC_POLICY_ALWAYS:
+            return True
+        return time.monotonic() - self.last_commit_time >= self.fsync_interval
+
+    async def commit(self, writer, final: bool = False):
+        """
+        Sync the data file (unless the policy is never) and store the written ranges.
+        :param writer: BufferedFileWriter of the data file
+        :param final: commit at the end of a download
+        """
+        self.last_commit_time = time.monotonic()
+        async with self.lock:
+            await writer.flush()
+            # Ranges are removed from pending only once synced, a cancelled commit keeps them
+            count = len(self.pending)
+            if count == 0 and not final:
+                return
+            if self.fsync_policy != FSYNC_POLICY_NEVER:
+                await writer.sync()
+            self.ranges = merge_ranges(self.ranges + self.pending[:count])
+            del self.pending[:count]
+            await writer.run_in_thread(self.save)
+
+    def save(self):
+        """
+        Atomically replace the journal file.
+        """
+        temp_path = f"{self.journal_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'file_size': self.file_size, 'ranges': self.ranges}, f)
+            if self.fsync_policy != FSYNC_POLICY_NEVER:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, self.journal_path)
+
+    def remove(self):
+        """
+        Remove the journal file.
+        """
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def missing_ranges(self) -> list:
+        """
+        Get the ranges still to download.
+        """
+        missing = []
+        position = 0
+        for start, end in self.ranges:
+            if start > position:
+                missing.append([position, start])
+            position = max(position, end)
+        if position < self.file_size:
+            missing.append([position, self.file_size])
+        return missing
+
+    def written_bytes(self) -> int:
+        """
+        Get the bytes committed in the journal.
+        """
+        return sum(end - start for start, end in self.ranges)
+
+    def is_complete(self) -> bool:
+        """
+        Check if every byte of the file is committed.
+        """
+        return not self.missing_ranges()
@@ -0,0 +1,185 @@
+"""
+Pool of the connections to the data centers of the media.
+"""
+import asyncio
+import contextlib
+import random
+
+from telethon.errors import TimedOutError
+from telethon.tl.functions import PingRequest
+from telethon.tl.functions.upload import GetFileRequest
+from telethon.client.downloads import MIN_CHUNK_SIZE
+
+from classes.download_stall_error import DownloadStallError
+
+# Seconds between two pings of an idle connection
+KEEPALIVE_INTERVAL = 60
+
+
+class SenderPool:
+    """
+    Up to {size} authorized connections for every data center other than the home one,
+    opened in advance for the data centers of the queued documents and kept alive with
+    pings, so a download doesn't wait for the authorization export on its first chunk.
+    Every request goes to the connection of the data center with fewer users, a connection
+    not answering within the stall timeout is replaced by a new one.
+    """
+
+    def __init__(self, client, size: int = 2):
+        self.client = client
+        self.size = size
+        self.senders = {}
+        self.usage = {}
+        self.requests = {}
+        self.replaced = 0
+        self.lock = asyncio.Lock()
+        self.keepalive = None
+        self.warm_task = None
+
+    def is_enabled(self, dc_id) -> bool:
+        """
+        Check if the pool is used for a data center, the home one uses the main connection.
+        """
+        return self.size > 0 and dc_id is not None and dc_id != self.client.session.dc_id
+
+    async def connect(self, dc_id: int):
+        """
+        Open the missing connections of a data center.
+        """
+        # pylint: disable=protected-access
+        async with self.lock:
+            senders = self.senders.setdefault(dc_id, [])
+            while len(senders) < self.size:
+                sender = await self.client._create_exported_sender(dc_id)
+                sender.dc_id = dc_id
+                senders.append(sender)
+                self.usage[sender] = 0
+                self.requests[sender] = 0
+
+    async def warm(self, dc_ids):
+        """
+        Connect in advance to the data centers of the queued documents.
+        """
+        for dc_id in set(dc_ids):
+            if not self.is_enabled(dc_id):
+                continue
+            try:
+                await self.connect(dc_id)
+            except Exception as e:  # pylint: disable=broad-except
+                print(f"Error on connecting to DC {dc_id}: {e}")
+        if self.keepalive is None or self.keepalive.done():
+            self.keepalive = asyncio.create_task(self.keepalive_loop())
+
+    @contextlib.asynccontextmanager
+    async def sender(self, dc_id: int):
+        """
+        Use the least used connection of a data center for the duration of the block.
+        """
+        await self.connect(dc_id)
+        sender = min(self.senders[dc_id], key=lambda item: self.usage[item])
+        self.usage[sender] += 1
+        try:
+            yield sender
+        finally:
+            self.usage[sender] -= 1
+            if self.usage[sender] == 0 and sender not in self.senders.get(dc_id, []):
+                # Replaced while in use
+                del self.usage[sender]
+                del self.requests[sender]
+
+    async def replace(self, dc_id: int, sender):
+        """
+        Disconnect a connection not answering and open a new one in its place.
+        """
+        # pylint: disable=protected-access
+        async with self.lock:
+            senders = self.senders.get(dc_id, [])
+            if sender not in senders:
+                return
+            senders.remove(sender)
+            self.replaced += 1
+        try:
+            await sender.disconnect()
+        except Exception as e:  # pylint: disable=broad-except
+            print(f"Error on disconnecting from DC {dc_id}: {e}")
+        await self.connect(dc_id)
+
+    async def call(self, sender, request):
+        """
+        Send a request on a pool connection, retrying once on timeout.
+        """
+        # pylint: disable=protected-access
+        self.requests[sender] += 1
+        try:
+            return await self.client._call(sender, request)
+        except TimedOutError:
+            return await self.client._call(sender, request)
+
+    async def iter_file(self, dc_id: int, location, offset: int, end: int, request_size: int,
+                        stall_timeout: float = 0):
+        """
+        Download the range [offset, end) of a file on a pool connection,
+        as iter_download does with the borrowed sender.
+        :param stall_timeout: seconds without answer before the connection is replaced
+                              and DownloadStallError raised, 0 waits forever
+        """
+        async with self.sender(dc_id) as sender:
+            while offset < end:
+                # upload.getFile needs an offset multiple of the limit
+                limit = request_size
+                while limit > MIN_CHUNK_SIZE and offset % limit != 0:
+                    limit //= 2
+                request = GetFileRequest(location, offset=offset, limit=limit)
+                try:
+                    result = await asyncio.wait_for(self.call(sender, request), stall_timeout or None)
+                except asyncio.TimeoutError as e:
+                    await self.replace(dc_id, sender)
+                    raise DownloadStallError(f"DC {dc_id} stalled at {offset}", offset=offset) from e
+                if not result.bytes:
+                    return
+                yield result.bytes
+                if len(result.bytes) < limit:
+                    return
+                offset += len(result.bytes)
+
+    async def keepalive_loop(self):
+        """
+        Ping the idle connections.
+        """
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            for senders in list(self.senders.values()):
+                for sender in senders:
+                    if self.usage[sender] > 0:
+                        continue
+                    try:
+                        await self.call(sender, PingRequest(random.getrandbits(63)))
+                    except Exception as e:  # pylint: disable=broad-except
+                        print(f"Error on pinging DC {sender.dc_id}: {e}")
+
+    def get_status(self) -> dict:
+        """
+        Get, for every data center, the connections, the ones in use and the requests sent.
+        """
+        return {
+            dc_id: (len(senders),
+                    sum(1 for sender in senders if self.usage[sender] > 0),
+                    sum(self.requests[sender] for sender in senders))
+            for dc_id, senders in self.senders.items()
+        }
+
+    async def close(self):
+        """
+        Disconnect every connection.
+        """
+        # The warm up can still be connecting and start the keepalive
+        if self.warm_task is not None:
+            self.warm_task.cancel()
+            await asyncio.gather(self.warm_task, return_exceptions=True)
+        if self.keepalive is not None:
+            self.keepalive.cancel()
+            await asyncio.gather(self.keepalive, return_exceptions=True)
+        for senders in self.senders.values():
+            for sender in senders:
+                await sender.disconnect()
+        self.senders = {}
@@ -0,0 +1,292 @@
+"""
+Compression of a video while it is downloaded.
+"""
+import asyncio
+import collections
+import os
+import struct
+
+# Maximum bytes of in-order chunks kept in memory for ffmpeg, the others are read back from the file
+MAX_BUFFER_BYTES = 64 * 1024 * 1024
+# Bytes read from the file at once when the chunks are not in memory
+READ_SIZE = 1024 * 1024
+# Magic number of the Matroska/WebM files
+MATROSKA_MAGIC = b'\x1a\x45\xdf\xa3'
+
+
+def read_range(file_path: str, offset: int, length: int) -> bytes:
+    """
+    Read {length} bytes at {offset}, runs on a worker thread.
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+class StreamTranscoder:
+    """
+    Feeds the downloaded bytes, in order, to the stdin of ffmpeg while the download goes on.
+    The chunks arriving in order are passed from memory, the ones downloaded ahead by the other
+    streams are read back from the temp file when ffmpeg reaches them.
+    Only the files readable from a pipe are streamed: Matroska and MP4 with the moov box before
+    the media data, the fragmented MP4, the moov-at-end MP4 and the other containers are left
+    to the compression after the download.
+    A slot of the encode budget is held from the start until the transcoder finishes or is cancelled.
+    """
+
+    def __init__(self, input_path: str, output_path: str, file_size: int, encoder_args: list,
+                 written: list | None = None, slot: asyncio.Semaphore | None = None):
+        """
+        :param input_path: the temp file being downloaded
+        :param output_path:
+        :param file_size:
+        :param encoder_args: the ffmpeg arguments of the encoder
+        :param written: the ranges already on the temp file, e.g. from the journal of a resumed download
+        :param slot: the encode budget, already acquired, released once when the transcoder ends
+        """
+        self.input_path = input_path
+        self.slot = slot
+        # Held while the input file is read, so it isn't moved in the middle of a read
+        self.read_lock = asyncio.Lock()
+        self.output_path = output_path
+        self.file_size = file_size
+        self.encoder_args = encoder_args
+        self.buffer = collections.deque()
+        self.buffer_bytes = 0
+        self.buffer_end = 0
+        self.fed = 0
+        self.written = [list(item) for item in written or []]
+        self.finished = False
+        self.streamable = None
+        self.process = None
+        self.feeder = None
+        self.stderr_reader = None
+        self.error_lines = collections.deque(maxlen=20)
+        self.changed = asyncio.Event()
+
+    def start(self):
+        """
+        Start waiting for the first bytes.
+        """
+        self.feeder = asyncio.create_task(self.feed())
+
+    def get_written_end(self) -> int:
+        """
+        Get the end of the bytes on the file without holes from the start.
+        """
+        return self.written[0][1] if self.written and self.written[0][0] == 0 else 0
+
+    def mark_written(self, offset: int, length: int):
+        """
+        Register a range written on the file.
+        """
+        self.written.append([offset, offset + length])
+        self.written.sort()
+        merged = [self.written[0]]
+        for start, end in self.written[1:]:
+            if start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.written = merged
+        self.changed.set()
+
+    def offer(self, offset: int, data: bytes):
+        """
+        Keep a downloaded chunk in memory if it is the next one for ffmpeg.
+        """
+        if offset != self.buffer_end or self.buffer_bytes >= MAX_BUFFER_BYTES or self.streamable is False:
+            return
+        self.buffer.append(data)
+        self.buffer_bytes += len(data)
+        self.buffer_end += len(data)
+        self.changed.set()
+
+    async def read_header(self, offset: int, length: int) -> bytes | None:
+        """
+        Read a header from the file, None if it isn't downloaded yet.
+        """
+        if offset + length > self.get_written_end():
+            return None
+        return await self.read_input(offset, length)
+
+    async def detect_streamable(self) -> bool | None:
+        """
+        Check the container, None if more bytes are needed.
+        """
+        magic = await self.read_header(0, 8)
+        if magic is None:
+            return None
+        if magic[:4] == MATROSKA_MAGIC:
+            return True
+        if magic[4:8] != b'ftyp':
+            return False
+        return await self.detect_streamable_mp4()
+
+    async def detect_streamable_mp4(self) -> bool | None:
+        """
+        Walk the top level boxes of an MP4: streamable if moov comes before mdat and there is no moof.
+        """
+        position = 0
+        moov_seen = False
+        while position + 8 <= self.file_size:
+            header = await self.read_header(position, 16 if position + 16 <= self.file_size else 8)
+            if header is None:
+                return None
+            size, box_type = struct.unpack('>I4s', header[:8])
+            if size == 1 and len(header) == 16:
+                size = struct.unpack('>Q', header[8:16])[0]
+            if box_type == b'moof' or (box_type == b'mdat' and not moov_seen):
+                return False
+            if box_type == b'mdat':
+                return True
+            moov_seen = moov_seen or box_type == b'moov'
+            if size < 8:
+                return False
+            position += size
+        return False
+
+    async def feed(self):
+        """
+        Start ffmpeg once the container is known to be streamable and write the bytes in order.
+        """
+        try:
+            while self.streamable is None:
+                self.streamable = await self.detect_streamable()
+                if self.streamable is None:
+                    if self.finished:
+                        return
+                    await self.wait_changed()
+            if self.streamable is False:
+                self.buffer.clear()
+                return
+            await self.start_process()
+            while self.fed < self.file_size:
+                data = await self.next_data()
+                if data is None:
+                    if self.finished:
+                        return
+                    await self.wait_changed()
+                    continue
+                self.process.stdin.write(data)
+                await self.process.stdin.drain()
+                self.fed += len(data)
+            self.process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg exited, the return code tells why
+            pass
+
+    async def wait_changed(self):
+        """
+        Wait for new bytes or the end of the download.
+        """
+        self.changed.clear()
+        await self.changed.wait()
+
+    async def next_data(self) -> bytes | None:
+        """
+        Get the next bytes for ffmpeg, from memory or from the file, None if not downloaded yet.
+        """
+        if self.buffer:
+            data = self.buffer.popleft()
+            self.buffer_bytes -= len(data)
+            return data
+        # The chunks not kept in memory are read back, the ones following the read are kept again
+        available = self.get_written_end() - self.fed
+        if available <= 0:
+            return None
+        length = min(available, READ_SIZE)
+        self.buffer_end = self.fed + length
+        return await self.read_input(self.fed, length)
+
+    async def read_input(self, offset: int, length: int) -> bytes:
+        """
+        Read {length} bytes of the input file at {offset}.
+        """
+        async with self.read_lock:
+            return await asyncio.to_thread(read_range, self.input_path, offset, length)
+
+    async def move_input(self, path: str):
+        """
+        Rename the input file, e.g. the completed temp file, and keep reading it from the new path.
+        """
+        async with self.read_lock:
+            os.rename(self.input_path, path)
+            self.input_path = path
+
+    async def start_process(self):
+        """
+        Start ffmpeg reading from stdin.
+        """
+        self.process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-y', '-loglevel', 'error', '-i', 'pipe:0',
+            # As the compression after the download: the first video encoded, the audio copied
+            '-map', '0:v:0', '-map', '0:a?', '-map_metadata', '0', *self.encoder_args, '-c:a', 'copy',
+            self.output_path,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        self.stderr_reader = asyncio.create_task(self.read_errors())
+
+    async def read_errors(self):
+        """
+        Keep the last lines of the errors of ffmpeg.
+        """
+        async for line in self.process.stderr:
+            self.error_lines.append(line.decode('utf-8', errors='replace').rstrip())
+
+    async def finish(self) -> bool:
+        """
+        Wait for the last bytes to be encoded after the download completed.
+        :return: True if the output file is complete, False if the file isn't streamable or ffmpeg failed
+        """
+        self.finished = True
+        self.changed.set()
+        try:
+            try:
+                await self.feeder
+            except OSError as e:
+                print(f"Streaming compression failed: {e}")
+            if self.process is None:
+                return False
+            if self.fed < self.file_size:
+                await self.cancel()
+                return False
+            return_code = await self.process.wait()
+            await self.stderr_reader
+            if return_code != 0:
+                print(f"Streaming compression failed ({return_code}): {' '.join(self.error_lines)}")
+            if return_code != 0 or not os.path.exists(self.output_path):
+                self.remove_output()
+                return False
+            return True
+        finally:
+            self.release_slot()
+
+    async def cancel(self):
+        """
+        Stop ffmpeg and remove the partial output, e.g. when the download is interrupted.
+        """
+        if self.feeder is not None:
+            self.feeder.cancel()
+            await asyncio.gather(self.feeder, return_exceptions=True)
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        if self.stderr_reader is not None:
+            await asyncio.gather(self.stderr_reader, return_exceptions=True)
+        self.remove_output()
+        self.release_slot()
+
+    def release_slot(self):
+        """
+        Give back the slot of the encode budget, once.
+        """
+        if self.slot is not None:
+            self.slot.release()
+            self.slot = None
+
+    def remove_output(self):
+        """
+        Remove the output file.
+        """
+        if self.process is not None and os.path.exists(self.output_path):
+            os.remove(self.output_path)
@@ -0,0 +1,86 @@
+"""
+Encoder tuning profile measured on this machine.
+"""
+import json
+import os
+import time
+
+
+class TuningProfile:
+    """
+    Results of the encoder benchmark: for every preset, CRF and threads of an encode the
+    frames per second, the output size against the input and the CPU seconds spent for every
+    second of video. The compression picks from them the preset meeting the throughput target.
+    """
+
+    def __init__(self, profile_path: str):
+        self.profile_path = profile_path
+        self.results = []
+        self.created = None
+        self.task = None
+        self.load()
+
+    def load(self):
+        """
+        Load the saved profile, none if the benchmark never ran.
+        """
+        try:
+            with open(self.profile_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.results = data.get('results', [])
+        self.created = data.get('created')
+
+    def save(self, results: list):
+        """
+        Replace the results and atomically write the profile.
+        """
+        self.results = results
+        self.created = time.time()
+        os.makedirs(os.path.dirname(self.profile_path), exist_ok=True)
+        temp_path = f"{self.profile_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'created': self.created, 'results': self.results}, f, indent=2)
+        os.replace(temp_path, self.profile_path)
+
+    def is_running(self) -> bool:
+        """
+        Check if a benchmark is running.
+        """
+        return self.task is not None and not self.task.done()
+
+    def get_results(self, crf: int, threads: int) -> list:
+        """
+        Get the results measured with the CRF and the threads nearest to the requested ones.
+        """
+        if not self.results:
+            return []
+        nearest_threads = min(
+            {item['threads'] for item in self.results}, key=lambda item: abs(item - threads))
+        results = [item for item in self.results if item['threads'] == nearest_threads]
+        nearest_crf = min({item['crf'] for item in results}, key=lambda item: abs(item - crf))
+        return [item for item in results if item['crf'] == nearest_crf]
+
+    def choose_preset(self, crf: int, threads: int, target_fps: float) -> str | None:
+        """
+        Choose the preset with the smallest output among the ones encoding at least {target_fps},
+        the fastest one if none is fast enough.
+        :return: the preset, None without results
+        """
+        results = self.get_results(crf, threads)
+        if not results:
+            return None
+        fast_enough = [item for item in results if item['fps'] >= target_fps]
+        if not fast_enough:
+            return max(results, key=lambda item: item['fps'])['preset']
+        return min(fast_enough, key=lambda item: item['size_ratio'])['preset']
+
+    def get_size_ratio(self, crf: int, threads: int, preset: str) -> float | None:
+        """
+        Get the measured output size against the input of a preset, None if not measured.
+        """
+        for item in self.get_results(crf, threads):
+            if item['preset'] == preset:
+                return item['size_ratio']
+        return None
@@ -0,0 +1,82 @@
+"""
+Command bandwidth
+"""
+from func.main import bandwidth_governor, configuration, download_stats
+from func.messages import t
+from func.telegram_client import edit_service_message
+from func.utils import format_bytes
+
+
+async def run(  # pylint: disable=unused-argument
+        command: str,
+        subcommand: str,
+        text_input: str,
+        extra_args=None,
+        is_personal_chat=False,
+        callback=None):
+    """
+    Run the command
+    :param command:
+    :param subcommand:
+    :param text_input:
+    :param extra_args:
+    :param is_personal_chat:
+    :param callback:
+    :return:
+    """
+    source_message = extra_args.get('source_message')
+    if text_input == '':
+        await show(source_message)
+        return
+
+    try:
+        limit_kb = max(0, int(text_input))
+    except ValueError:
+        await edit_service_message(source_message, t('bandwidth_invalid_value', text_input))
+        return
+
+    if subcommand == 'download':
+        configuration.bandwidth_limit_download_kb = limit_kb
+        bandwidth_governor.set_limits(download_rate=limit_kb * 1024)
+    elif subcommand == 'chat':
+        configuration.bandwidth_limit_chat_kb = limit_kb
+        bandwidth_governor.set_limits(chat_rate=limit_kb * 1024)
+    else:
+        configuration.bandwidth_limit_kb = limit_kb
+        bandwidth_governor.set_limits(global_rate=limit_kb * 1024)
+    await show(source_message)
+
+
+def format_rate(rate: float) -> str:
+    """
+    Format a rate in bytes/sec, 0 is unlimited
+    :param rate:
+    :return:
+    """
+    return f"{format_bytes(int(rate))}/s" if rate > 0 else t('bandwidth_unlimited')
+
+
+def format_download(key) -> str:
+    """
+    Format the rate limit and the measured speed of a download
+    :param key:
+    :return:
+    """
+    stats = download_stats.get(key)
+    speed = stats.speed if stats is not None else 0
+    return f"- {key}: {format_rate(bandwidth_governor.get_download_rate(key))} ({format_bytes(int(speed))}/s)"
+
+
+async def show(source_message):
+    """
+    Show the bandwidth limits, the rate and the measured speed of every active download
+    :param source_message:
+    :return:
+    """
+    downloads_text = "\n".join(format_download(key) for key in bandwidth_governor.downloads)
+    await edit_service_message(source_message, t(
+        'bandwidth_status',
+        format_rate(bandwidth_governor.global_rate),
+        format_rate(bandwidth_governor.download_rate),
+        format_rate(bandwidth_governor.chat_rate),
+        downloads_text or '-'), 30)
@@ -0,0 +1,92 @@
+"""
+Command benchmark
+"""
+import asyncio
+import os
+from pathlib import Path
+
+from func.compression import get_encode_threads
+from func.encoder_tuning import (BENCHMARK_FILES, BENCHMARK_PRESETS, find_sample_files, get_benchmark_crfs,
+                                 get_benchmark_threads, run_benchmark)
+from func.main import configuration, tuning_profile
+from func.messages import t
+from func.telegram_client import edit_service_message
+
+
+async def run(  # pylint: disable=unused-argument
+        command: str,
+        subcommand: str,
+        text_input: str,
+        extra_args=None,
+        is_personal_chat=False,
+        callback=None):
+    """
+    Run the command
+    :param command:
+    :param subcommand:
+    :param text_input:
+    :param extra_args:
+    :param is_personal_chat:
+    :param callback:
+    :return:
+    """
+    source_message = extra_args.get('source_message')
+    if tuning_profile.is_running():
+        await edit_service_message(source_message, t('benchmark_running'))
+        return
+    folders = [configuration.download_folder, configuration.completed_folder]
+    files = await asyncio.to_thread(find_sample_files, folders, BENCHMARK_FILES)
+    if not files:
+        await edit_service_message(source_message, t('benchmark_no_files', ', '.join(folders)))
+        return
+    # The benchmark takes a while, the other commands are handled meanwhile
+    tuning_profile.task = asyncio.create_task(benchmark(source_message, files))
+
+
+async def benchmark(source_message, files: list):
+    """
+    Run the benchmark, save the tuning profile and show the results
+    :param source_message:
+    :param files:
+    :return:
+    """
+    async def show_progress(done, total, preset, crf, threads):
+        await source_message.edit(t('benchmark_progress', done, total, preset, crf, threads))
+
+    output_file = Path(os.path.dirname(tuning_profile.profile_path)) / 'benchmark_sample.mkv'
+    try:
+        results = await run_benchmark(
+            files,
+            get_benchmark_crfs(configuration.compression_ratio),
+            BENCHMARK_PRESETS,
+            get_benchmark_threads(configuration),
+            output_file,
+            show_progress)
+    except Exception as e:  # pylint: disable=broad-except
+        await edit_service_message(source_message, t('benchmark_failed', e), 60)
+        return
+    if not results:
+        await edit_service_message(source_message, t(
+            'benchmark_no_files', f"{configuration.download_folder}, {configuration.completed_folder}"))
+        return
+    tuning_profile.save(results)
+    await show(source_message)
+
+
+async def show(source_message):
+    """
+    Show the results measured with the configured CRF and threads
+    :param source_message:
+    :return:
+    """
+    threads = get_encode_threads(configuration)
+    results_text = "\n".join(
+        t('benchmark_result_line', item['preset'], f"{item['fps']:.1f}", f"{item['speed']:.2f}",
+          f"{item['size_ratio'] * 100:.0f}", f"{item['cpu_time']:.1f}")
+        for item in tuning_profile.get_results(configuration.compression_ratio, threads)
+    )
+    preset = tuning_profile.choose_preset(
+        configuration.compression_ratio, threads, configuration.compression_target_fps)
+    await edit_service_message(source_message, t(
+        'benchmark_result', configuration.compression_ratio, threads, results_text,
+        configuration.compression_target_fps, preset), 300)
@@ -1,6 +1,8 @@
 """
 Command download
 """
+import time
+from datetime import datetime
 from typing import Union
 
 from telethon.tl.patched import Message
@@ -9,7 +11,7 @@ from telethon.tl.types import MessageMediaDocument
 from classes.object_data import ObjectData
 from classes.string_builder import LINE_FOR_PINNED_VIDEO, TYPE_COMPLETED, TYPE_ACQUIRED, \
     TYPE_DOWNLOADING, TYPE_DELETED, ACQUIRED_TYPES
-from func.main import configuration
+from func.main import configuration, bandwidth_governor, download_scheduler
 from func.messages import t
 from func.telegram_client import edit_service_message, fetch_all_messages
 from func.utils import save_video_data, add_line_to_text, get_video_status_label
@@ -48,6 +50,11 @@ async def run(  # pylint: disable=unused-argument
             extra_args.get('source_message'),
             extra_args.get('reply_message'),
             subcommand == 'pin' or command == 'pin')
+    elif subcommand == 'deadline' or command == 'deadline':
+        await set_deadline(
+            extra_args.get('source_message'),
+            extra_args.get('reply_message'),
+            text_input)
     elif subcommand == 'clean' or command == 'clean':
         await clean_downloads(
             extra_args.get('source_message'),
@@ -71,7 +78,7 @@ async def start(message, callback):
     :return:
     """
     await edit_service_message(message, t('download_enabled'))
-    callback()
+    await callback()
 
 
 async def stop(message, callback):
@@ -128,12 +135,37 @@ async def set_pinned_message(source_message, video_object: ObjectData, pinned: b
     else:
         await edit_service_message(source_message, t('unpinned_message', video_object.video_name))
     save_video_data({"pinned": pinned}, video_object, ["pinned"])
+    bandwidth_governor.set_pinned(video_object.video_id, pinned)
+    download_scheduler.set_pinned(video_object.video_id, pinned)
     await add_line_to_text(
         video_object.message_id_reference,
         str(pinned),
         LINE_FOR_PINNED_VIDEO, True)
 
 
+async def set_deadline(source_message, video_object: ObjectData, text: str):
+    """
+    :param source_message:
+    :param video_object:
+    :param text: hours from now, 0 removes the deadline
+    :return:
+    """
+    try:
+        hours = float(text)
+    except ValueError:
+        await edit_service_message(source_message, t('deadline_invalid_value', text))
+        return
+
+    deadline = time.time() + hours * 3600 if hours > 0 else None
+    if deadline is None:
+        await edit_service_message(source_message, t('deadline_removed', video_object.video_name))
+    else:
+        deadline_text = datetime.fromtimestamp(deadline).strftime('%Y-%m-%d %H:%M')
+        await edit_service_message(source_message, t('deadline_set', video_object.video_name, deadline_text))
+    save_video_data({"deadline": deadline}, video_object, ["deadline"])
+    download_scheduler.set_deadline(video_object.video_id, deadline)
+
+
 async def clean_downloads(source_message: Union[Message, MessageMediaDocument]):
     """
     Clear completed downloads from the chat.
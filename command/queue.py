@@ -0,0 +1,59 @@
+"""
+Command queue
+"""
+from classes.queue_policy import QUEUE_POLICIES, create_queue_policy
+from func.main import configuration, download_scheduler
+from func.messages import t
+from func.telegram_client import edit_service_message
+
+# Number of queued videos shown
+QUEUE_HEAD_SIZE = 10
+
+
+async def run(  # pylint: disable=unused-argument
+        command: str,
+        subcommand: str,
+        text_input: str,
+        extra_args=None,
+        is_personal_chat=False,
+        callback=None):
+    """
+    Run the command
+    :param command:
+    :param subcommand:
+    :param text_input:
+    :param extra_args:
+    :param is_personal_chat:
+    :param callback:
+    :return:
+    """
+    source_message = extra_args.get('source_message')
+    if subcommand == 'policy' and text_input != '':
+        policy_name = text_input.strip().lower()
+        if policy_name not in QUEUE_POLICIES:
+            await edit_service_message(
+                source_message, t('queue_policy_invalid', policy_name, ', '.join(QUEUE_POLICIES)))
+            return
+        configuration.download_queue_policy = policy_name
+        download_scheduler.set_policy(create_queue_policy(policy_name))
+    await show(source_message)
+
+
+async def show(source_message):
+    """
+    Show the policy and the first videos of the queue
+    :param source_message:
+    :return:
+    """
+    queue_text = "\n".join(
+        f"{position}. {video.video_name or video.file_name}"
+        for position, video in enumerate(download_scheduler.get_head(QUEUE_HEAD_SIZE), 1)
+    )
+    status_text = t(
+        'queue_status',
+        download_scheduler.policy.name,
+        ', '.join(QUEUE_POLICIES),
+        len(download_scheduler.queued),
+        queue_text or '-')
+    delayed_text = t('queue_delayed', len(download_scheduler.delayed))
+    await edit_service_message(source_message, f"{status_text}\n{delayed_text}", 30)
@@ -1,8 +1,13 @@
 """
 Command status
 """
-from func.main import configuration
+from pathlib import Path
+
+from func.main import configuration, concurrency_controller, sender_pool, download_stats, compression_queue
+from func.media_probe import get_cached_info
+from func.messages import t
 from func.telegram_client import edit_service_message
+from func.utils import format_bytes
 
 async def run(  # pylint: disable=unused-argument
         command: str,
@@ -30,4 +35,44 @@ async def run(  # pylint: disable=unused-argument
         for key, value in config_dict.items()
         if key not in exclude_keys
     )
-    await edit_service_message(source_message, config_text, 100)
+    concurrency_text = t(
+        'status_concurrency',
+        concurrency_controller.active,
+        concurrency_controller.limit,
+        concurrency_controller.max_limit,
+        format_bytes(concurrency_controller.request_size),
+        concurrency_controller.flood_count,
+        int(concurrency_controller.pause_time()))
+    sender_pool_text = t('status_sender_pool', "\n".join(
+        t('status_sender_pool_dc', dc_id, in_use, connections, requests)
+        for dc_id, (connections, in_use, requests) in sorted(sender_pool.get_status().items())
+    ) or t('status_sender_pool_empty'))
+    stalls_text = t('status_stalls', download_stats.stall_count, sender_pool.replaced,
+                    configuration.download_stall_timeout)
+    compression_text = t(
+        'status_compression',
+        len(compression_queue.running),
+        compression_queue.workers,
+        len(compression_queue.pending),
+        "\n".join(format_compression(video_id, video)
+                  for video_id, video in compression_queue.running.items()))
+    await edit_service_message(source_message, "\n\n".join(
+        [config_text, concurrency_text, sender_pool_text, stalls_text, compression_text]), 100)
+
+
+def format_compression(video_id, video) -> str:
+    """
+    Format the progress of a running compression
+    :param video_id:
+    :param video:
+    :return:
+    """
+    percent, fps, speed = compression_queue.progress.get(video_id, (0, 0, 0))
+    video_text = t('status_compression_video',
+                   video.video_name or video.file_name, f"{percent:.1f}", f"{fps:.1f}", f"{speed:.2f}")
+    # Only the cached values, the status never runs ffprobe
+    info = get_cached_info(Path(str(video.file_path)))
+    if info is None:
+        return video_text
+    return video_text + t('status_compression_media', info['video_codec'], info['width'], info['height'],
+                          f"{info['bit_rate'] / 1000000:.1f}")
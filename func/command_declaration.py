@@ -7,7 +7,7 @@ from func.utils import add_line_to_text, save_video_data, get_inlist_video_objec
     validate_and_check_path
 
 
-async def command_declaration():
+async def command_declaration():  # pylint: disable=too-many-statements
     """
     Command declaration
     """
@@ -17,10 +17,13 @@ async def command_declaration():
         from func.main import operation_status
         operation_status.quit_program = True
 
-    def set_download_start():
-        from func.main import operation_status
+    async def set_download_start():
+        from func.main import operation_status, load_download_queue, download_scheduler
         operation_status.start_download = True
         operation_status.interrupt = False
+        await load_download_queue()
+        # The videos already queued are not pushed again, so the dispatch is woken here
+        download_scheduler.wakeup.set()
 
     def set_download_stop():
         from func.main import operation_status
@@ -104,6 +107,13 @@ async def command_declaration():
             'needs_reply': True
         },
     )
+    command_handler.add_command(
+        ["download:deadline", "dl:deadline", "deadline"],
+        t('command_download_deadline'),
+        args={
+            'needs_reply': True
+        },
+    )
     command_handler.add_command(["download:clean", "clean"], t('command_download_clean'))
     command_handler.add_command("rules:show", t('command_rules_show'))
     command_handler.add_command("rules:edit", t('command_rules_edit'))
@@ -130,6 +140,12 @@ async def command_declaration():
         ["download:count", "dl:count", "count"],
         t('command_count'),
     )
+    command_handler.add_command("queue", t('command_queue'))
+    command_handler.add_command("queue:policy", t('command_queue_policy'))
+    command_handler.add_command(["bandwidth", "bw"], t('command_bandwidth'))
+    command_handler.add_command(["bandwidth:download", "bw:download"], t('command_bandwidth_download'))
+    command_handler.add_command(["bandwidth:chat", "bw:chat"], t('command_bandwidth_chat'))
+    command_handler.add_command("benchmark", t('command_benchmark'))
     command_handler.add_command(
         [ "download:settarget", "dl:settarget", "settarget"],
         t('command_download_settarget'),
@@ -3,13 +3,15 @@ Module for compressing video files using ffmpeg.
 
 """
 import asyncio
-import subprocess
+import collections
+import shutil
 import os
 import time
 
 from pathlib import Path
 from typing import Union, Callable, Awaitable
 
+from classes.compression_checkpoint import CompressionCheckpoint
 from func.messages import t
 
 COMPRESSION_STATE_NOT_COMPRESSED = 0
@@ -19,6 +21,21 @@ COMPRESSION_STATE_COMPRESSION_FAILED_NOT_OUTPUT_FILE = 3
 COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE = 4
 COMPRESSION_STATE_COMPRESSION_FAILED_BAD_TRASH_FILE = 5
 
+# Seconds without encoded time advancing before the compression is considered stuck
+COMPRESSION_STALL_TIMEOUT = 300
+# Seconds between the checkpoints of the encoded time of a part
+CHECKPOINT_INTERVAL = 10
+# Maximum milliseconds of a Matroska cluster of a part, the encoded frames reach the file within it
+PART_CLUSTER_TIME_MS = 1000
+# Seconds subtracted from a checkpoint, the frames still in the cluster being written
+PART_FLUSH_MARGIN = 2
+# File listing the parts for the concat demuxer
+CONCAT_FILE_NAME = 'concat.txt'
+# Preset of the encoder without a throughput target or a tuning profile
+DEFAULT_PRESET = 'slow'
+# Threads of an encode used to size the compression workers when compression_threads is not set
+DEFAULT_ENCODE_THREADS = 4
+
 
 def is_valid_input_file(input_file: Path, min_size_mb: int) -> bool:
     """Check if input file exists and is large enough to be compressed."""
@@ -59,10 +76,16 @@ def should_compress(file_size_mb: float, crf: int) -> bool:
 
 def compression_ratio(crf: int) -> float:
     """
-    Calculate the compression ratio.
+    Calculate the compression ratio, the one measured by the encoder benchmark if available.
     :param crf:
     :return:
     """
+    from func.main import configuration, tuning_profile
+    threads = get_encode_threads(configuration)
+    measured_ratio = tuning_profile.get_size_ratio(crf, threads, get_preset(crf, threads))
+    if measured_ratio is not None:
+        return measured_ratio
+
     if crf <= 18:
         compression_factor = 1.2
     elif crf <= 23:
@@ -75,6 +98,67 @@ def compression_ratio(crf: int) -> float:
     return compression_factor
 
 
+def get_compression_workers(config) -> int:
+    """
+    Get the number of simultaneous compressions, by default the cores divided by the threads of an encode.
+    :param config:
+    :return:
+    """
+    if config.compression_workers > 0:
+        return config.compression_workers
+    return max(1, (os.cpu_count() or 1) // (config.compression_threads or DEFAULT_ENCODE_THREADS))
+
+
+def get_encode_threads(config) -> int:
+    """
+    Get the threads of an encode, all the cores when compression_threads is not set.
+    :param config:
+    :return:
+    """
+    return config.compression_threads or os.cpu_count() or 1
+
+
+def get_preset(crf: int, threads: int) -> str:
+    """
+    Get the x265 preset: with a throughput target, the one of the tuning profile compressing the most
+    while encoding at least compression_target_fps frames per second.
+    :param crf:
+    :param threads:
+    :return:
+    """
+    from func.main import configuration, tuning_profile
+    if configuration.compression_target_fps > 0:
+        return tuning_profile.choose_preset(crf, threads, configuration.compression_target_fps) or DEFAULT_PRESET
+    return DEFAULT_PRESET
+
+
+def build_encoder_args(crf: int, preset: str, threads: int = 0) -> list:
+    """
+    Build the ffmpeg arguments of the H.265 encoder.
+    :param crf:
+    :param preset:
+    :param threads: the threads of the encode, 0 to let ffmpeg choose
+    :return:
+    """
+    args = ['-vcodec', 'libx265', '-crf', str(crf), '-preset', preset, '-tune', 'zerolatency']
+    if threads > 0:
+        # Every encode uses its own share of the cores
+        args += ['-x265-params', f'pools={threads}']
+    return args
+
+
+def get_encoder_args(crf: int, threads: int = 0) -> list:
+    """
+    Get the ffmpeg arguments of the H.265 encoder.
+    :param crf:
+    :param threads: the threads of the encode, by default compression_threads
+    :return:
+    """
+    from func.main import configuration
+    threads = threads or configuration.compression_threads
+    return build_encoder_args(crf, get_preset(crf, threads or get_encode_threads(configuration)), threads)
+
+
 def compression_ratio_calc(file_size_mb: float, crf: int) -> float:
     """
     Calculate the compression ratio.
@@ -97,6 +181,21 @@ def get_file_size(file_path: Path) -> float:
 
     return file_path.stat().st_size
 
+
+def get_parts_dir(output_file: Path) -> Path:
+    """
+    Get the folder of the parts of a compression, next to the compressed file.
+    """
+    return output_file.with_name(output_file.name + '.parts')
+
+
+def get_source_key(input_file: Path) -> list:
+    """
+    Identify the version of the input file, the work of a previous run is reused only for the same file.
+    """
+    stat = input_file.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
 # pylint: disable=all
 async def compress_video_h265(
         input_file: Path,
@@ -104,8 +203,8 @@ async def compress_video_h265(
         crf: int = 28,
         min_size_mb: int = 50,
         callback:
-        (Union[Callable[[float, float, float], None],
-        Callable[[float, float, float], Awaitable[None]]])
+        (Union[Callable[[float, float, float, float, float], None],
+        Callable[[float, float, float, float, float], Awaitable[None]]])
         | None = None
 ) -> (
         COMPRESSION_STATE_COMPRESSION_FAILED |
@@ -117,102 +216,60 @@ async def compress_video_h265(
 ):
     """
     Compress a video file from H.264 to H.265 using ffmpeg.
+    The progress is read from the -progress output of ffmpeg: the encoded time against the
+    duration of the video, the callback receives (progress, current size, remaining time, fps, speed).
     """
 
     # Pre-compression checks
     if not is_valid_input_file(input_file, min_size_mb):
         return COMPRESSION_STATE_NOT_COMPRESSED
 
-    # File size and compression check
-    file_size_mb = input_file.stat().st_size / (1024 * 1024)
-    if not should_compress(file_size_mb, crf):
-        return COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE
-
-    # Ensure output path is writable
-    #if not remove_existing_output(output_file):
-    #    return COMPRESSION_STATE_COMPRESSION_FAILED_BAD_TRASH_FILE
+    from func.compression_predictor import check_compression, record_compression
+    from func.main import configuration, encode_slots
 
+    # The parts of an interrupted compression are continued, otherwise the result is predicted first.
+    # Every encode takes a slot of the budget shared with the segments and the streaming compressions
+    parts_dir = get_parts_dir(output_file)
     try:
-        start_time = time.time()  # Start time
-
-        # Calculate the estimated size of the compressed file
         file_size = get_file_size(input_file)
-        estimated_size = compression_ratio_calc(file_size, crf)
-
-        # Retrieve the current size of the compressed file
-        current_size = get_file_size(output_file)
-
-        # Determine the resumption point
-        if current_size > 0:
-            time_offset = calculate_offset(current_size, estimated_size, output_file)
-            print(f"Resuming compression from {time_offset:.2f} seconds...")
-        else:
-            time_offset = 0
-
-        process_completed = False
-
-        # Start the ffmpeg process
-        process = (
-            subprocess.Popen(
-                [
-                    'ffmpeg', '-y', '-i', str(input_file),
-                    '-ss', str(time_offset),
-                    '-vcodec', 'libx265', '-crf', str(crf),
-                    '-preset', 'slow', '-tune', 'zerolatency',
-                    str(output_file)
-                ],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
-        )
-
-        last_value_is_same = 0
-        last_value = get_file_size(output_file)
-
-        # Progress monitoring
-        while True:
-            output = await asyncio.to_thread(process.stderr.read, 4096)
-            output = output.decode('utf-8') if output else ''
-            if output:
-                # Get the current size of the file
-                current_size = get_file_size(output_file)
-                progress = (current_size / estimated_size) * 100
-                remaining_time_value = (time.time() - start_time) / (progress / 100) if progress > 0 else 0
-
-                if last_value_is_same >= 30:
-                    raise InterruptedError('Last value is same')
-
-                if last_value == current_size:
-                    last_value_is_same += 1
-                else:
-                    last_value = current_size
-                    last_value_is_same = 0
-
-                # Callback to update status
-                if callback:
-                    if asyncio.iscoroutinefunction(callback):
-                        await callback(
-                            progress,
-                            current_size,
-                            remaining_time_value)
-                    else:
-                        callback(
-                            progress,
-                            current_size,
-                            remaining_time_value)
-
-                print(
-                    f"\rProgress: {progress:.2f}%, Size: {current_size:.2f} MB, Remaining Time: {remaining_time_value:.2f}s",
-                    end='', flush=True)
-
-                if current_size >= file_size:
-                    return COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE
-
-            if process.poll() is not None:
-                process_completed = True
-                break
+        duration = await asyncio.to_thread(get_video_duration, input_file)
+        source = get_source_key(input_file)
+        checkpoint = CompressionCheckpoint.load(parts_dir, source, crf)
+        prediction = None
+        if checkpoint is None:
+            async with encode_slots:
+                compress, prediction = await check_compression(
+                    input_file, output_file, crf, configuration.compression_threads, False)
+            if not compress:
+                return COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE
+            shutil.rmtree(parts_dir, ignore_errors=True)
+            parts_dir.mkdir(parents=True)
+            checkpoint = CompressionCheckpoint(parts_dir, source, crf)
+        elif checkpoint.get_encoded() > 0:
+            print(f"Resuming compression from {checkpoint.get_encoded():.2f} seconds...")
+
+        started = time.monotonic()
+        if not checkpoint.is_complete():
+            async with encode_slots:
+                compressing_state = await encode_part(input_file, checkpoint, crf, duration, callback)
+            if compressing_state == COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE:
+                shutil.rmtree(parts_dir, ignore_errors=True)
+            if compressing_state is not None:
+                return compressing_state
+
+        return_code, error_lines = await concat_video(
+            checkpoint.get_concat_entries(), parts_dir / CONCAT_FILE_NAME, input_file, output_file)
+        if return_code != 0:
+            print(f"ffmpeg concat exited with {return_code}: {' '.join(error_lines)}")
+            return COMPRESSION_STATE_COMPRESSION_FAILED
 
         # Verify the final file
-        if output_file.exists() and output_file.stat().st_size > 0 and process_completed:
+        if output_file.exists() and output_file.stat().st_size > 0:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+            record_compression(prediction, file_size, output_file.stat().st_size, time.monotonic() - started)
+            if output_file.stat().st_size >= file_size:
+                output_file.unlink()
+                return COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE
             print(f"Compression successfully completed! File saved: {output_file}")
             return COMPRESSION_STATE_COMPRESSED
 
@@ -220,39 +277,185 @@ async def compress_video_h265(
         return COMPRESSION_STATE_COMPRESSION_FAILED_NOT_OUTPUT_FILE
 
     except Exception as e:
+        # The parts are kept for the next attempt
         print(f"Error during compression: {e}")
         return COMPRESSION_STATE_COMPRESSION_FAILED
 
-def get_video_duration(input_file: Path) -> float:
+
+async def encode_part(input_file: Path, checkpoint: CompressionCheckpoint, crf: int, duration: float, callback):
     """
-    Get the total duration of a video file in seconds using ffprobe.
-    :param input_file: Input video file
-    :return: Duration in seconds
+    Encode a new part from the end of the previous ones to the end of the video.
+    Seeking before -i jumps to the start of the part without decoding what comes before, -n never overwrites
+    the work of a previous run. The part is written in small clusters flushed at every packet, so the frames
+    before a checkpoint are on disk when ffmpeg is killed. Only the video is encoded, the audio is copied from
+    the input when the parts are joined.
+    :return: None when the part reached the end, otherwise the compression state
     """
+    start = checkpoint.get_encoded()
+    index = checkpoint.add_part()
+    file_size = get_file_size(input_file)
+    previous_size = sum(get_file_size(checkpoint.get_part_path(item)) for item in range(index))
+    last_checkpoint = {'time': time.monotonic(), 'encoded': 0}
+
+    async def on_progress(progress_data):
+        part_time = get_out_time(progress_data)
+        out_time = start + part_time
+        fps = parse_float(progress_data.get('fps'))
+        speed = parse_float(progress_data.get('speed', '').rstrip('x'))
+        current_size = previous_size + parse_float(progress_data.get('total_size'))
+        progress = min(100.0, out_time / duration * 100) if duration > 0 else 0
+        remaining_time_value = (duration - out_time) / speed if speed > 0 and duration > 0 else 0
+        last_checkpoint['encoded'] = part_time - PART_FLUSH_MARGIN
+        if time.monotonic() - last_checkpoint['time'] >= CHECKPOINT_INTERVAL:
+            last_checkpoint['time'] = time.monotonic()
+            checkpoint.update(index, last_checkpoint['encoded'])
+        await notify_progress(callback, progress, current_size, remaining_time_value, fps, speed)
+        # Stop as soon as the output is larger than the input
+        return current_size >= file_size
+
+    return_code = None
     try:
-        result = subprocess.run(
-            ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'format=duration',
-             '-of', 'default=noprint_wrappers=1:nokey=1', str(input_file)],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
-        )
-        duration = float(result.stdout.decode().strip())
-        return duration
-    except Exception as e:
-        print(f"Error retrieving video duration: {e}")
+        return_code, error_lines = await run_ffmpeg(
+            ['-n', '-ss', f"{start:.6f}", '-i', str(input_file), '-map', '0:v:0', '-an', '-sn',
+             *get_encoder_args(crf), '-cluster_time_limit', str(PART_CLUSTER_TIME_MS), '-flush_packets', '1',
+             str(checkpoint.get_part_path(index))],
+            on_progress)
+    finally:
+        checkpoint.update(index, None if return_code == 0 else last_checkpoint['encoded'])
+    if return_code is None:
+        return COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE
+    if return_code != 0:
+        print(f"ffmpeg exited with {return_code}: {' '.join(error_lines)}")
+        return COMPRESSION_STATE_COMPRESSION_FAILED
+    return None
+
+
+async def concat_video(entries: list, concat_path: Path, input_file: Path, output_file: Path) -> tuple:
+    """
+    Join encoded video files without encoding them again, with the audio of the input.
+    :param entries: list of (file, time where the file is cut or None to keep it whole)
+    :param concat_path: the list file for the concat demuxer
+    :param input_file:
+    :param output_file:
+    :return: (return code, the last lines of the errors)
+    """
+    with open(concat_path, 'w', encoding='utf-8') as f:
+        for path, outpoint in entries:
+            f.write(f"file '{path.name}'\n")
+            if outpoint is not None:
+                f.write(f"outpoint {outpoint:.6f}\n")
+    return await run_ffmpeg(
+        ['-y', '-f', 'concat', '-safe', '0', '-i', str(concat_path), '-i', str(input_file),
+         '-map', '0:v', '-map', '1:a?', '-map_metadata', '1', '-c', 'copy', str(output_file)])
+
+
+async def notify_progress(callback, progress, current_size, remaining_time_value, fps, speed):
+    """
+    Pass the progress of a compression to the callback, sync or async, and print it.
+    """
+    if callback:
+        if asyncio.iscoroutinefunction(callback):
+            await callback(progress, current_size, remaining_time_value, fps, speed)
+        else:
+            callback(progress, current_size, remaining_time_value, fps, speed)
+
+    print(
+        f"\rProgress: {progress:.2f}%, Size: {current_size:.0f} B, {fps:.1f} fps, {speed:.2f}x, "
+        f"Remaining Time: {remaining_time_value:.2f}s",
+        end='', flush=True)
+
+
+async def run_ffmpeg(args: list, on_progress=None) -> tuple:
+    """
+    Run ffmpeg reading its -progress output, written on stdout as blocks of key=value lines.
+    on_progress is awaited with every complete block and stops ffmpeg returning True, an
+    InterruptedError is raised when the encoded time doesn't advance, or ffmpeg writes nothing,
+    for COMPRESSION_STALL_TIMEOUT.
+    :param args: the ffmpeg arguments after the global options
+    :param on_progress:
+    :return: (return code, None if stopped by on_progress, the last lines of the errors)
+    """
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-nostats', '-loglevel', 'error', '-progress', 'pipe:1', *args,
+        stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    error_lines = collections.deque(maxlen=20)
+    stderr_reader = asyncio.create_task(read_lines(process.stderr, error_lines))
+    try:
+        progress_data = {}
+        last_out_time = 0
+        last_advance_time = time.monotonic()
+        while True:
+            try:
+                line = await asyncio.wait_for(process.stdout.readline(), COMPRESSION_STALL_TIMEOUT)
+            except asyncio.TimeoutError as e:
+                raise InterruptedError('ffmpeg is not writing its progress') from e
+            if not line:
+                break
+            key, _, value = line.decode('utf-8', errors='replace').strip().partition('=')
+            progress_data[key] = value
+            if key != 'progress':
+                continue
+
+            # A block of values is complete
+            out_time = get_out_time(progress_data)
+            if out_time > last_out_time:
+                last_out_time = out_time
+                last_advance_time = time.monotonic()
+            elif time.monotonic() - last_advance_time >= COMPRESSION_STALL_TIMEOUT:
+                raise InterruptedError('Encoded time is not advancing')
+
+            if on_progress is not None and await on_progress(progress_data):
+                return None, list(error_lines)
+            if value == 'end':
+                break
+
+        return_code = await process.wait()
+        await stderr_reader
+        return return_code, list(error_lines)
+    finally:
+        # Stopped early (exceeded size, error or cancelled)
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        await asyncio.gather(stderr_reader, return_exceptions=True)
+
+
+async def read_lines(stream, lines):
+    """
+    Keep the last lines of a stream, e.g. the errors of ffmpeg.
+    :param stream:
+    :param lines: deque with a maximum length
+    """
+    async for line in stream:
+        lines.append(line.decode('utf-8', errors='replace').rstrip())
+
+
+def parse_float(value) -> float:
+    """
+    Parse a value of the ffmpeg progress, 0 if missing or N/A.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
         return 0
 
-def calculate_offset(current_size, estimated_size, input_file):
+
+def get_out_time(progress_data: dict) -> float:
     """
-    Calculate the time offset (in seconds) based on the current compressed size.
-    :param current_size: Current size of the compressed file
-    :param estimated_size: Estimated size of the compressed file
+    Get the encoded time in seconds from a block of the ffmpeg progress.
+    out_time_ms is in microseconds as out_time_us, older ffmpeg versions only have the former.
+    """
+    return parse_float(progress_data.get('out_time_us') or progress_data.get('out_time_ms')) / 1000000
+
+def get_video_duration(input_file: Path) -> float:
+    """
+    Get the total duration of a video file in seconds, probed once and cached by file.
     :param input_file: Input video file
-    :return: Time offset (in seconds)
+    :return: Duration in seconds, 0 if the file can't be probed
     """
-    total_duration = get_video_duration(Path(input_file))
-    if estimated_size == 0:
-        return 0
-    return (current_size / estimated_size) * total_duration
+    from func.media_probe import probe_video
+    info = probe_video(input_file)
+    return info['duration'] if info is not None else 0
 
 def progress_calc(output_file: Path, estimated_size: float) -> float:
     """ Calculate the progress of the compression. """
@@ -0,0 +1,117 @@
+"""
+Module for predicting the result of a compression from a few short slices of the video.
+
+"""
+import asyncio
+import time
+from pathlib import Path
+
+from func.compression import get_encode_threads, get_file_size, get_preset, should_compress
+from func.encoder_tuning import encode_sample
+from func.media_probe import get_audio_size, probe_video
+
+# Slices encoded, spread across the video
+PREDICTION_SLICES = 3
+# Seconds of every slice
+PREDICTION_SLICE_SECONDS = 4
+# Minimum predicted saving to compress, a prediction close to the input size isn't worth the encode
+PREDICTION_MIN_SAVING = 0.05
+
+
+async def encode_slices(input_file: Path, sample_file: Path, duration: float, crf: int, preset: str,
+                        threads: int) -> list | None:
+    """
+    Encode the slices, evenly spread between the start and the end of the video.
+    :return: the measures of the slices, None if ffmpeg failed
+    """
+    measures = []
+    try:
+        for index in range(PREDICTION_SLICES):
+            start = duration * (index + 1) / (PREDICTION_SLICES + 1)
+            measures.append(await encode_sample(
+                input_file, start, crf, preset, threads, sample_file, PREDICTION_SLICE_SECONDS))
+    except RuntimeError as e:
+        print(f"Error predicting the compression: {e}")
+        return None
+    finally:
+        sample_file.unlink(missing_ok=True)
+    return measures
+
+
+async def predict_compression(input_file: Path, output_file: Path, crf: int, threads: int,
+                              segmented: bool) -> dict | None:
+    """
+    Encode the slices with the arguments of the compression and extrapolate the output size and the
+    encode time to the whole video. The video is encoded again while the audio is copied, so its
+    bytes are added as they are. The raw prediction is corrected by the calibration of the history.
+    :param input_file:
+    :param output_file: the compressed file, the slices are written next to it
+    :param crf:
+    :param threads: the threads of an encode
+    :param segmented: if the video is compressed in segments, the encode time is calibrated apart
+    :return: the prediction, None if the video is too short or can't be encoded
+    """
+    from func.main import configuration, compression_history
+    info = await asyncio.to_thread(probe_video, input_file)
+    if info is None or info['duration'] < PREDICTION_SLICES * PREDICTION_SLICE_SECONDS * 2:
+        return None
+    duration = info['duration']
+    preset = get_preset(crf, threads or get_encode_threads(configuration))
+    measures = await encode_slices(
+        input_file, output_file.with_name(output_file.name + '.sample.mkv'), duration, crf, preset, threads)
+    if measures is None:
+        return None
+
+    encoded_seconds = PREDICTION_SLICES * PREDICTION_SLICE_SECONDS
+    video_size = sum(item['size'] for item in measures) / encoded_seconds * duration
+    raw_ratio = (video_size + get_audio_size(info, duration)) / get_file_size(input_file)
+    raw_seconds = sum(item['elapsed'] for item in measures) / encoded_seconds * duration
+    size_factor, time_factor = compression_history.get_calibration(segmented)
+    return {
+        'file': str(input_file),
+        'crf': crf,
+        'preset': preset,
+        'segmented': segmented,
+        'raw_ratio': raw_ratio,
+        'predicted_ratio': raw_ratio * size_factor,
+        'raw_seconds': raw_seconds,
+        'predicted_seconds': raw_seconds * time_factor,
+    }
+
+
+async def check_compression(input_file: Path, output_file: Path, crf: int, threads: int,
+                            segmented: bool) -> tuple:
+    """
+    Decide if a video is worth compressing from the prediction, from the estimated compression
+    ratio when the prediction isn't available.
+    :return: (True to compress, the prediction or None)
+    """
+    prediction = await predict_compression(input_file, output_file, crf, threads, segmented)
+    if prediction is None:
+        return should_compress(input_file.stat().st_size / (1024 * 1024), crf), None
+
+    print(f"Predicted output size: {prediction['predicted_ratio'] * 100:.0f}% of the input, "
+          f"encode time: {prediction['predicted_seconds']:.0f}s")
+    if prediction['predicted_ratio'] >= 1 - PREDICTION_MIN_SAVING:
+        print("Compression would not reduce the file size enough. Skipping compression.")
+        return False, prediction
+    return True, prediction
+
+
+def record_compression(prediction: dict | None, input_size: float, output_size: float, elapsed: float):
+    """
+    Record the actual result of a predicted compression in the history.
+    :param prediction:
+    :param input_size:
+    :param output_size:
+    :param elapsed: the seconds of the encode
+    """
+    from func.main import compression_history
+    if prediction is None or input_size <= 0:
+        return
+    compression_history.add({
+        **prediction,
+        'actual_ratio': output_size / input_size,
+        'actual_seconds': elapsed,
+        'time': time.time(),
+    })
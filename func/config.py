@@ -6,10 +6,12 @@ import os
 import sys
 from xmlrpc.client import MAXINT
 
+from classes.queue_policy import QUEUE_POLICIES, QueuePolicy
+from classes.range_journal import FSYNC_POLICIES, FSYNC_POLICY_INTERVAL
 from func.utils import check_folder_permissions, load_config
 
 
-def load_configuration():
+def load_configuration():  # pylint: disable=too-many-locals
     """
     Carica e restituisce la configurazione come un dizionario.
     """
@@ -42,9 +44,35 @@ def load_configuration():
     session_name = os.path.join(root_dir, config.get('session_name', 'session_name'))
     max_simultaneous_file_to_download = int(config.get('max_simultaneous_file_to_download', 2))
     max_download_size_request_limit_kb = int(config.get('max_download_size_request_limit_kb', MAXINT))
+    download_segments = max(1, int(config.get('download_segments', 1)))
+    download_stall_timeout = max(0, int(config.get('download_stall_timeout', 90)))
+    download_write_buffer_mb = max(1, int(config.get('download_write_buffer_mb', 32)))
+    download_fsync_policy = config.get('download_fsync_policy', FSYNC_POLICY_INTERVAL)
+    if download_fsync_policy not in FSYNC_POLICIES:
+        download_fsync_policy = FSYNC_POLICY_INTERVAL
+    download_fsync_interval = max(0, float(config.get('download_fsync_interval', 5)))
+    download_verify_hashes = config.get('download_verify_hashes', 0) == "1"
+    bandwidth_limit_kb = max(0, int(config.get('bandwidth_limit_kb', 0)))
+    bandwidth_limit_download_kb = max(0, int(config.get('bandwidth_limit_download_kb', 0)))
+    bandwidth_limit_chat_kb = max(0, int(config.get('bandwidth_limit_chat_kb', 0)))
+    bandwidth_pinned_weight = max(1, int(config.get('bandwidth_pinned_weight', 2)))
     enable_video_compression = config.get('enable_video_compression', 0) == "1"
     compression_ratio = max(0, min(int(config.get('compression_ratio', 28)), 51))
+    compression_while_downloading = config.get('compression_while_downloading', 0) == "1"
+    compression_threads = max(0, int(config.get('compression_threads', 0)))
+    compression_workers = max(0, int(config.get('compression_workers', 0)))
+    compression_segment_seconds = max(0, int(config.get('compression_segment_seconds', 0)))
+    compression_segment_workers = max(0, int(config.get('compression_segment_workers', 0)))
+    compression_target_fps = max(0, int(config.get('compression_target_fps', 0)))
     disk_space_limit_percentage = max(0, min(int(config.get('disk_space_limit_percentage', 98)), 100))
+    dedup_content_hash = config.get('dedup_content_hash', 0) == "1"
+    sender_pool_size = max(0, int(config.get('sender_pool_size', 2)))
+    download_queue_policy = config.get('download_queue_policy', QueuePolicy.name).strip().lower()
+    if download_queue_policy not in QUEUE_POLICIES:
+        download_queue_policy = QueuePolicy.name
+    concurrency_increase_interval = max(1, float(config.get('concurrency_increase_interval', 60)))
+    caption_edit_interval = max(0, float(config.get('caption_edit_interval', 3)))
+    caption_edits_per_second = max(0, float(config.get('caption_edits_per_second', 1)))
     group_chats = config.get('group_chats', [])
 
     # Verifica le cartelle di download
@@ -62,8 +90,30 @@ def load_configuration():
         'session_name': session_name,
         'max_simultaneous_file_to_download': max_simultaneous_file_to_download,
         'max_download_size_request_limit_kb': max_download_size_request_limit_kb,
+        'download_segments': download_segments,
+        'download_stall_timeout': download_stall_timeout,
+        'download_write_buffer_mb': download_write_buffer_mb,
+        'download_fsync_policy': download_fsync_policy,
+        'download_fsync_interval': download_fsync_interval,
+        'download_verify_hashes': download_verify_hashes,
+        'bandwidth_limit_kb': bandwidth_limit_kb,
+        'bandwidth_limit_download_kb': bandwidth_limit_download_kb,
+        'bandwidth_limit_chat_kb': bandwidth_limit_chat_kb,
+        'bandwidth_pinned_weight': bandwidth_pinned_weight,
         'enable_video_compression': enable_video_compression,
         'compression_ratio': compression_ratio,
+        'compression_while_downloading': compression_while_downloading,
+        'compression_threads': compression_threads,
+        'compression_workers': compression_workers,
+        'compression_segment_seconds': compression_segment_seconds,
+        'compression_segment_workers': compression_segment_workers,
+        'compression_target_fps': compression_target_fps,
+        'dedup_content_hash': dedup_content_hash,
+        'sender_pool_size': sender_pool_size,
+        'download_queue_policy': download_queue_policy,
+        'concurrency_increase_interval': concurrency_increase_interval,
+        'caption_edit_interval': caption_edit_interval,
+        'caption_edits_per_second': caption_edits_per_second,
         'group_chats': group_chats,
         'lock_download': lock_download,
         'disk_space_limit_percentage': disk_space_limit_percentage
@@ -77,6 +127,16 @@ class Config:
         self.disk_space_limit_percentage = 100
         self.max_simultaneous_file_to_download = None
         self.max_download_size_request_limit_kb = MAXINT
+        self.download_segments = 1
+        self.download_stall_timeout = 90
+        self.download_write_buffer_mb = 32
+        self.download_fsync_policy = FSYNC_POLICY_INTERVAL
+        self.download_fsync_interval = 5
+        self.download_verify_hashes = False
+        self.bandwidth_limit_kb = 0
+        self.bandwidth_limit_download_kb = 0
+        self.bandwidth_limit_chat_kb = 0
+        self.bandwidth_pinned_weight = 2
         self.compression_min_size_mb = 0
         self.session_name = None
         self.api_id = None
@@ -85,6 +145,18 @@ class Config:
         self.completed_folder = None
         self.enable_video_compression = False
         self.compression_ratio = 28
+        self.compression_while_downloading = False
+        self.compression_threads = 0
+        self.compression_workers = 0
+        self.compression_segment_seconds = 0
+        self.compression_segment_workers = 0
+        self.compression_target_fps = 0
+        self.dedup_content_hash = False
+        self.sender_pool_size = 2
+        self.download_queue_policy = 'fifo'
+        self.concurrency_increase_interval = 60
+        self.caption_edit_interval = 3
+        self.caption_edits_per_second = 1
         self.group_chats = []
         self.download_folder = None
         self.lock_download = False
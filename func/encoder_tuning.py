@@ -0,0 +1,194 @@
+"""
+Module for benchmarking the H.265 encoder on short samples of the local videos.
+
+"""
+import asyncio
+import contextlib
+import mimetypes
+import os
+import time
+from pathlib import Path
+
+from func.compression import (DEFAULT_ENCODE_THREADS, build_encoder_args, get_file_size, parse_float,
+                              run_ffmpeg)
+from func.media_probe import get_audio_size, probe_video
+
+# Presets measured, from the fastest to the one compressing the most
+BENCHMARK_PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow']
+# CRF values measured around the configured one
+BENCHMARK_CRF_STEPS = [-4, 0, 4]
+# Seconds of video encoded for every sample, taken from the middle of the file
+BENCHMARK_SAMPLE_SECONDS = 5
+# Number of local videos sampled, the largest ones
+BENCHMARK_FILES = 2
+# Codec of the compressed files, encoding them again wouldn't measure the compression of a source
+COMPRESSED_CODEC = 'hevc'
+
+
+def find_sample_files(folders: list, count: int) -> list:
+    """
+    Find the largest videos in the folders not already in H.265, e.g. the ones already compressed.
+    The videos are probed, blocking, to be called in a worker thread.
+    """
+    files = []
+    for folder in folders:
+        for root, _, names in os.walk(folder):
+            for name in names:
+                mime_type, _ = mimetypes.guess_type(name)
+                if mime_type is not None and mime_type.startswith('video/'):
+                    files.append(Path(root) / name)
+    files.sort(key=get_file_size, reverse=True)
+    samples = []
+    for file in files:
+        info = probe_video(file)
+        if info is not None and info['video_codec'] not in (None, COMPRESSED_CODEC):
+            samples.append(file)
+            if len(samples) == count:
+                break
+    return samples
+
+
+def get_benchmark_crfs(crf: int) -> list:
+    """
+    Get the CRF values measured around the configured one.
+    """
+    return sorted({max(0, min(crf + step, 51)) for step in BENCHMARK_CRF_STEPS})
+
+
+def get_benchmark_threads(config) -> list:
+    """
+    Get the threads measured: the ones of an encode and all the cores.
+    """
+    cores = os.cpu_count() or 1
+    return sorted({min(config.compression_threads or DEFAULT_ENCODE_THREADS, cores), cores})
+
+
+def get_children_cpu_time() -> float:
+    """
+    Get the CPU seconds used by the finished subprocesses, the wall time where the
+    resource module is missing (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return time.monotonic()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def encode_sample(input_file: Path, start: float, crf: int, preset: str, threads: int,
+                        output_file: Path, seconds: float = BENCHMARK_SAMPLE_SECONDS) -> dict:
+    """
+    Encode {seconds} of a video with the arguments used by the compression.
+    :return: dict with the encoded frames, the elapsed seconds, the CPU seconds and the output size
+    """
+    progress = {'frame': 0}
+
+    async def on_progress(progress_data):
+        progress['frame'] = parse_float(progress_data.get('frame'))
+        return False
+
+    cpu_time = get_children_cpu_time()
+    started = time.monotonic()
+    return_code, error_lines = await run_ffmpeg(
+        ['-y', '-ss', f"{start:.3f}", '-i', str(input_file), '-t', str(seconds),
+         '-map', '0:v:0', '-an', '-sn', *build_encoder_args(crf, preset, threads), '-f', 'matroska',
+         str(output_file)],
+        on_progress)
+    if return_code != 0:
+        raise RuntimeError(f"ffmpeg exited with {return_code}: {' '.join(error_lines)}")
+    return {
+        'frames': progress['frame'],
+        'elapsed': time.monotonic() - started,
+        'cpu_time': get_children_cpu_time() - cpu_time,
+        'size': get_file_size(output_file),
+    }
+
+
+@contextlib.asynccontextmanager
+async def hold_encoders():
+    """
+    Pause the compression queue and take every slot of the encode budget, so no other encode
+    runs during the measures: the running compressions and the streaming ones are waited for.
+    """
+    from func.main import configuration, compression_queue, encode_slots
+    from func.segmented_compression import get_segment_workers
+    compression_queue.pause()
+    held = 0
+    try:
+        await compression_queue.wait_idle()
+        for _ in range(get_segment_workers(configuration)):
+            await encode_slots.acquire()
+            held += 1
+        yield
+    finally:
+        for _ in range(held):
+            encode_slots.release()
+        compression_queue.resume()
+
+
+async def run_benchmark(files: list, crfs: list, presets: list, threads_list: list, output_file: Path,
+                        callback=None) -> list:
+    """
+    Encode a sample of every file with every preset, CRF and threads, one at a time and with the
+    other encodes held so the measures don't disturb each other. The results are averaged on the files.
+    :param files:
+    :param crfs:
+    :param presets:
+    :param threads_list:
+    :param output_file: the temporary file of the samples
+    :param callback: awaited with (encoded samples, total samples, preset, crf, threads)
+    :return: list of dict with preset, crf, threads, fps, speed, size_ratio, cpu_time
+    """
+    samples = []
+    for input_file in files:
+        info = await asyncio.to_thread(probe_video, input_file)
+        if info is not None and info['duration'] > BENCHMARK_SAMPLE_SECONDS:
+            # The bytes of the input in the sample, from the average bitrate, and the ones of the audio,
+            # copied by the compression while the sample has only the video
+            sample_size = get_file_size(input_file) * BENCHMARK_SAMPLE_SECONDS / info['duration']
+            samples.append((input_file, (info['duration'] - BENCHMARK_SAMPLE_SECONDS) / 2, sample_size,
+                            get_audio_size(info, BENCHMARK_SAMPLE_SECONDS)))
+    if not samples:
+        return []
+
+    results = []
+    total = len(samples) * len(crfs) * len(presets) * len(threads_list)
+    done = 0
+    try:
+        async with hold_encoders():
+            for threads in threads_list:
+                for crf in crfs:
+                    for preset in presets:
+                        if callback:
+                            await callback(done, total, preset, crf, threads)
+                        measures = []
+                        for input_file, start, sample_size, audio_size in samples:
+                            measure = await encode_sample(
+                                input_file, start, crf, preset, threads, output_file)
+                            measure['sample_size'] = sample_size
+                            measure['audio_size'] = audio_size
+                            measures.append(measure)
+                            done += 1
+                        results.append(summarize(preset, crf, threads, measures))
+    finally:
+        output_file.unlink(missing_ok=True)
+    return results
+
+
+def summarize(preset: str, crf: int, threads: int, measures: list) -> dict:
+    """
+    Average the measures of a preset, CRF and threads on the samples.
+    """
+    elapsed = sum(item['elapsed'] for item in measures) or 1
+    encoded_seconds = BENCHMARK_SAMPLE_SECONDS * len(measures)
+    return {
+        'preset': preset,
+        'crf': crf,
+        'threads': threads,
+        'fps': sum(item['frames'] for item in measures) / elapsed,
+        'speed': encoded_seconds / elapsed,
+        'size_ratio': sum(
+            (item['size'] + item['audio_size']) / item['sample_size'] for item in measures) / len(measures),
+        'cpu_time': sum(item['cpu_time'] for item in measures) / encoded_seconds,
+    }
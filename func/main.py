@@ -7,16 +7,30 @@ import asyncio
 import os
 import shutil
 import traceback
-from asyncio import CancelledError, create_task
 from pathlib import Path
 from typing import List
 
 # Moduli di terze parti
-import telethon
 from telethon import events
 from telethon.events import NewMessage
 from telethon.tl.types import Message, MessageMediaDocument
 
+from classes.bandwidth_governor import BandwidthGovernor
+from classes.caption_edit_scheduler import CaptionEditScheduler
+from classes.caption_mirror import CaptionMirror
+from classes.compression_history import CompressionHistory
+from classes.compression_queue import CompressionQueue
+from classes.concurrency_controller import ConcurrencyController
+from classes.disk_reservations import DiskReservations, get_device
+from classes.document_index import DocumentIndex
+from classes.download_scheduler import DownloadScheduler
+from classes.media_cache import MediaCache
+from classes.probe_cache import ProbeCache
+from classes.queue_policy import create_queue_policy, get_video_size
+from classes.sender_pool import SenderPool
+from classes.tuning_profile import TuningProfile
+from classes.message_prefetch import MessagePrefetch
+from classes.download_stats import DownloadStatsRegistry
 from classes.command_handler import CommandHandler
 # Moduli locali
 from classes.object_data import ObjectData
@@ -27,17 +41,22 @@ from func.messages import t
 from classes.rules import Rules
 from func.save_video_data_action import acquire_video
 from func.telegram_client import (
-    create_telegram_client, download_with_retry,
+    create_telegram_client, download_with_retry, load_journal,
     send_service_message, get_user_id,
     get_video_data_by_message_id_reference, get_user_data, reassign_video_folder_completed)
+from run import root_dir
 from classes.string_builder import (
+    TYPE_CANCELLED,
     LINE_FOR_INFO_DATA,
     LINE_FOR_SHOW_LAST_ERROR)
 from func.utils import (
     add_line_to_text,
     get_inlist_video_object_by_message_id_reference,
-    remove_video_data, save_video_data
+    remove_video_data, save_video_data, is_waiting_duplicate, link_duplicate_video,
+    complete_video, unpin_reference_message, define_label
 )
+from func.compression import get_compression_workers
+from func.segmented_compression import get_segment_workers
 
 configuration = load_configuration()
 
@@ -48,6 +67,12 @@ client = create_telegram_client(
 # Initialize rules
 rules_object = Rules()
 
+caption_mirror = CaptionMirror()
+caption_edit_scheduler = CaptionEditScheduler(
+    caption_mirror,
+    configuration.caption_edit_interval,
+    configuration.caption_edits_per_second)
+
 command_handler = CommandHandler()
 
 all_messages: List[Message] = []
@@ -60,7 +85,26 @@ operation_status = OperationStatusObject({
     'rules_registered': {},
     'is_premium': False,
 })
-sem = asyncio.Semaphore(configuration.max_simultaneous_file_to_download)
+concurrency_controller = ConcurrencyController(
+    configuration.max_simultaneous_file_to_download,
+    configuration.concurrency_increase_interval)
+bandwidth_governor = BandwidthGovernor(
+    configuration.bandwidth_limit_kb * 1024,
+    configuration.bandwidth_limit_download_kb * 1024,
+    configuration.bandwidth_limit_chat_kb * 1024,
+    configuration.bandwidth_pinned_weight)
+download_stats = DownloadStatsRegistry()
+download_scheduler = DownloadScheduler(create_queue_policy(configuration.download_queue_policy))
+message_prefetch = MessagePrefetch()
+media_cache = MediaCache()
+sender_pool = SenderPool(client, configuration.sender_pool_size)
+disk_reservations = DiskReservations()
+compression_queue = CompressionQueue(get_compression_workers(configuration))
+encode_slots = asyncio.Semaphore(get_segment_workers(configuration))
+document_index = DocumentIndex(os.path.join(root_dir, 'documents_data', 'document_index.json'))
+probe_cache = ProbeCache(os.path.join(root_dir, 'documents_data', 'probe_cache.json'))
+compression_history = CompressionHistory(os.path.join(root_dir, 'documents_data', 'compression_history.json'))
+tuning_profile = TuningProfile(os.path.join(root_dir, 'documents_data', 'tuning_profile.json'))
 
 CHECK_INTERVAL = 3
 
@@ -73,7 +117,6 @@ def load_all_video_data() -> list:
            list: A list of tuples, where each tuple contains the file name and the
                ObjectData associated with the file.
        """
-    from run import root_dir
     # Percorso della cartella videos
     video_data_dir = os.path.join(root_dir, "videos_data")
 
@@ -96,30 +139,126 @@ def load_all_video_data() -> list:
     return all_data
 
 
-async def download_with_limit(video: ObjectData):
-    """Download a file with concurrency limit."""
+async def load_download_queue():
+    """
+    Load the videos not yet completed from videos_data and add them to the download queue,
+    their messages are fetched in bulk
+    """
+    from run import PERSONAL_CHAT_ID
+
+    filtered_data = [
+        item for item in load_all_video_data() if item[1] is not None and not item[1].completed
+    ]
+
+    operation_status.videos_data = sorted(
+        filtered_data, key=lambda item: (not item[1].pinned, item[1].video_id)
+    )
+
+    await message_prefetch.fetch(
+        PERSONAL_CHAT_ID, [video.message_id_reference for _, video in operation_status.videos_data])
+    protected_ids = {}
+    for _, video in operation_status.videos_data:
+        if video.is_forward_chat_protected is True:
+            protected_ids.setdefault(video.chat_name, []).append(video.video_id)
+    for chat_name, ids in protected_ids.items():
+        await message_prefetch.fetch(chat_name, ids)
+
+    for _, video in operation_status.videos_data:
+        if video.is_forward_chat_protected is True:
+            fetch_time, message = message_prefetch.peek(video.chat_name, video.video_id)
+        else:
+            fetch_time, message = message_prefetch.peek(PERSONAL_CHAT_ID, video.message_id_reference)
+        if message is not None:
+            media_cache.store(video, message.media, fetch_time)
+
+    download_scheduler.load(operation_status.videos_data)
+
+
+def admit_video(video_object: ObjectData) -> bool:
+    """
+    Reserve the disk space of a video before its download: the bytes still to download,
+    the estimated compressed file and the copy to the completed folder on another filesystem.
+    False delays the video until another download frees its space.
+    """
+    from func.compression import compression_ratio_calc
+    file_size = get_video_size(video_object)
+    if video_object.file_path is None or file_size == 0:
+        return True
+    download_folder = os.path.dirname(video_object.file_path)
+    completed_folder = video_object.video_completed_folder or configuration.completed_folder
+    required_size = file_size - load_journal(f"{video_object.file_path}.temp", file_size).written_bytes()
+    if configuration.enable_video_compression:
+        required_size += int(compression_ratio_calc(file_size, configuration.compression_ratio))
+    requirements = [(download_folder, required_size)]
+    if get_device(completed_folder) != get_device(download_folder):
+        requirements.append((completed_folder, file_size))
+    blocked_path = disk_reservations.reserve(
+        video_object.video_id, requirements, configuration.disk_space_limit_percentage)
+    if blocked_path is None:
+        return True
+    asyncio.create_task(add_line_to_text(video_object.message_id_reference,
+                                         t('download_waiting_disk_space', blocked_path), LINE_FOR_INFO_DATA))
+    return False
+
+
+async def process_video_download(video_object: ObjectData):
+    """Prepare a queued video and download it, the scheduler holds the download slot."""
 
-    # Inizializza il semaforo per gestire i download simultanei
     try:
-        async with sem:
-            # Send a status message before starting the download
-            await add_line_to_text(
-                getattr(video, "message_id_reference", None),
-                t("download_video"),
-                LINE_FOR_INFO_DATA,
-            )
+        # The same document is downloaded once, the other videos wait for it and link its file
+        if is_waiting_duplicate(video_object):
+            await add_line_to_text(video_object.message_id_reference,
+                                   t('duplicate_video_waiting'), LINE_FOR_INFO_DATA)
+            return False
+
+        video = await get_video_task(video_object)
+        if video is False:
+            return False
+
+        if await link_duplicate_video(video):
+            return True
 
-            # Start downloading the file with retry logic
-            await download_with_retry(client, video)
+        # Send a status message before starting the download
+        await add_line_to_text(
+            getattr(video, "message_id_reference", None),
+            t("download_video"),
+            LINE_FOR_INFO_DATA,
+        )
+
+        # Start downloading the file with retry logic
+        await download_with_retry(client, video)
     except Exception as e:  # pylint: disable=broad-except
-        print(f"Error downloading {video.file_name}: {e}")
-        await add_line_to_text(getattr(video, "message_id_reference", None), f"Error: {e}",
+        print(f"Error downloading {video_object.file_name}: {e}")
+        await add_line_to_text(getattr(video_object, "message_id_reference", None), f"Error: {e}",
                                LINE_FOR_SHOW_LAST_ERROR)
-        return video
+        return video_object
+    finally:
+        # A video waiting for the compression keeps the space of the compressed file
+        if not compression_queue.is_pending(video_object.video_id):
+            disk_reservations.release(video_object.video_id)
 
     return True
 
 
+async def run_compression(video: ObjectData) -> bool:
+    """
+    Compress a downloaded video and move it, on a worker of the compression queue.
+    As for a failed download, a failed video is tried again later: the queue calls
+    download_scheduler.requeue_later once the video has left it.
+    """
+    try:
+        await complete_video(video)
+        return True
+    except Exception as e:  # pylint: disable=broad-except
+        print(f"Error compressing {video.file_name}: {e}")
+        await unpin_reference_message(video)
+        await define_label(video.message_id_reference, TYPE_CANCELLED)
+        await add_line_to_text(video.message_id_reference, f"Error: {e}", LINE_FOR_SHOW_LAST_ERROR)
+        return False
+    finally:
+        disk_reservations.release(video.video_id)
+
+
 async def client_data():
     """
     Client data
@@ -175,22 +314,24 @@ async def get_video_task(video_object: ObjectData):
         remove_video_data_by_video_id(video_object.video_id)
         return False
 
-    reference_message = await client.get_messages(
-        PERSONAL_CHAT_ID, ids=video_object.message_id_reference
+    # The media keeps the time of the prefetch, its file reference isn't fresher than the message
+    fetch_time, reference_message = await message_prefetch.get_message(
+        PERSONAL_CHAT_ID, video_object.message_id_reference
     )
 
     if reference_message is None:
         remove_video_data(video_object)
         return False
+    caption_mirror.update(reference_message)
 
     if video_object.is_forward_chat_protected is not True:
         video_object.video_media = reference_message.media
+        media_cache.store(video_object, reference_message.media, fetch_time)
     else:
-        video_data = await client.get_messages(
-            video_object.chat_name, ids=video_object.video_id
-        )
-        if video_data is not None:
-            video_object.video_media = video_data.media
+        message_prefetch.take(video_object.chat_name, video_object.video_id)
+        video_media = await media_cache.get_media(video_object)
+        if video_media is not None:
+            video_object.video_media = video_media
         else:  # if reference not exists when is forward chat protected, remove video json from folder
             await reference_message.delete()
             remove_video_data(video_object)
@@ -203,21 +344,17 @@ async def get_video_task(video_object: ObjectData):
 
     await reassign_video_folder_completed(video_object)
 
-    try:
-        if LOG_IN_PERSONAL_CHAT is True:
-            await reference_message.edit(default_video_message(video_object))
-    except telethon.errors.rpcerrorlist.MessageNotModifiedError:
-        # Ignora l'errore se il messaggio non è stato modificato
-        pass
+    if LOG_IN_PERSONAL_CHAT is True:
+        caption_edit_scheduler.schedule(video_object.message_id_reference,
+                                        default_video_message(video_object))
 
-    # Queue the download task with the limit on simultaneous downloads
     return video_object
 
 
 async def main():  # pylint: disable=unused-argument, too-many-statements
     """Main function to manage the Telegram client and download files."""
     from func.save_video_data_action import save_video_data_action
-    from run import root_dir, PERSONAL_CHAT_ID
+    from run import PERSONAL_CHAT_ID
 
     rules_object.load_rules(Path(root_dir), True)
     operation_status.videos_data = []
@@ -271,9 +408,12 @@ async def main():  # pylint: disable=unused-argument, too-many-statements
                         PERSONAL_CHAT_ID, t('rule_deleted', rule_data.file_name))
 
             for message_id in event.deleted_ids:
+                caption_edit_scheduler.forget(message_id)
                 video_object = get_inlist_video_object_by_message_id_reference(message_id)
                 if video_object is not None:
                     remove_video_data(video_object)
+                    download_scheduler.remove(video_object.video_id)
+                    await compression_queue.remove(video_object.video_id)
                 await remove_rules(message_id)
             if operation_status.can_delete_rules is True:
                 rules_object.reload_rules()
@@ -295,8 +435,19 @@ async def main():  # pylint: disable=unused-argument, too-many-statements
                     if new_video_data is not None:
                         await reassign_video_folder_completed(new_video_data)
                         operation_status.videos_data.append((file_name, new_video_data))
+                        download_scheduler.enqueue(new_video_data)
             return
 
+        async def tg_reference_edited_handler(event):
+            """
+            Keep the caption mirror in sync with the edits of the reference messages
+            """
+            caption_mirror.update_if_known(event.message)
+
+        client.add_event_handler(
+            tg_reference_edited_handler, events.MessageEdited(chats=PERSONAL_CHAT_ID)
+        )
+
         for chat_name in configuration.group_chats:
             client.add_event_handler(
                 tg_message_handler, events.MessageEdited(chats=chat_name)
@@ -306,38 +457,24 @@ async def main():  # pylint: disable=unused-argument, too-many-statements
                 tg_new_message_handler, events.NewMessage(chats=chat_name)
             )
 
-        while True:
-            filtered_data = [
-                item for item in load_all_video_data() if not item[1].completed
-            ]
-
-            sorted_data = sorted(
-                filtered_data, key=lambda item: (not item[1].pinned, item[1].video_id)
-            )
-
-            operation_status.videos_data = sorted_data
-
-            if operation_status.quit_program is True:
-                break
-            if operation_status.start_download is True:
-                # Name of a file, File object content
-                tasks = []
-                for _, video_data in operation_status.videos_data or []:  # type: [str, ObjectData]
-                    task_video_data = await get_video_task(video_data)
-                    if task_video_data is not False:
-                        task = create_task(download_with_limit(task_video_data))
-                        tasks.append(task)
-
-                # Execute all queued tasks concurrently
-                try:
-                    await asyncio.gather(*tasks, return_exceptions=True)
-                    if configuration.lock_download is True:
-                        operation_status.start_download = False
-                        operation_status.interrupt = True
-                        await send_service_message(PERSONAL_CHAT_ID, t('download_stopped'))
-
-                except CancelledError:
-                    print(t('cancel_download'))
+        async def on_download_idle():
+            """
+            Every queued video is processed
+            """
+            if configuration.lock_download is True and operation_status.start_download is True:
+                operation_status.start_download = False
+                operation_status.interrupt = True
+                await send_service_message(PERSONAL_CHAT_ID, t('download_stopped'))
+
+        await load_download_queue()
+        sender_pool.warm_task = asyncio.create_task(sender_pool.warm(media_cache.get_dc_ids()))
+        download_scheduler.start(on_download_idle, admit_video)
+        compression_queue.start(run_compression, download_scheduler.requeue_later)
+        media_cache.start_refresher(
+            lambda: download_scheduler.get_head(concurrency_controller.max_limit * 2))
+
+        # The downloads are started by the scheduler, here only the quit command is awaited
+        while operation_status.quit_program is not True:
             await asyncio.sleep(CHECK_INTERVAL)
 
     except KeyboardInterrupt:
@@ -348,5 +485,10 @@ async def main():  # pylint: disable=unused-argument, too-many-statements
         traceback.print_exc()
 
     finally:
+        await download_scheduler.stop()
+        await compression_queue.stop()
+        await media_cache.stop_refresher()
+        await sender_pool.close()
+        await caption_edit_scheduler.flush_all()
         await client.disconnect()
         print("Disconnected from Telegram.")
@@ -0,0 +1,120 @@
+"""
+Module for probing the video files with ffprobe, the results are cached by file.
+
+"""
+import json
+import subprocess
+from pathlib import Path
+
+from func.compression import parse_float
+
+
+def run_ffprobe(args: list) -> dict | None:
+    """
+    Run ffprobe with JSON output.
+    :param args: the ffprobe arguments, the input file last
+    :return: the parsed output, None on error
+    """
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'error', '-print_format', 'json', *args],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+        )
+        return json.loads(result.stdout.decode('utf-8', errors='replace') or '{}')
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        print(f"Error probing {args[-1]}: {e}")
+        return None
+
+
+def parse_frame_rate(value) -> float:
+    """
+    Parse a frame rate of ffprobe, e.g. 30000/1001.
+    """
+    numerator, _, denominator = str(value or '').partition('/')
+    if parse_float(denominator or 1) == 0:
+        return 0
+    return parse_float(numerator) / parse_float(denominator or 1)
+
+
+def summarize_probe(data: dict) -> dict:
+    """
+    Keep the values used by the program from the format and the streams probed.
+    """
+    probe_format = data.get('format', {})
+    streams = data.get('streams', [])
+    video = next((
+        stream for stream in streams
+        if stream.get('codec_type') == 'video' and not stream.get('disposition', {}).get('attached_pic')
+    ), {})
+    return {
+        'duration': parse_float(probe_format.get('duration')) or parse_float(video.get('duration')),
+        'start_time': parse_float(probe_format.get('start_time')),
+        'bit_rate': int(parse_float(probe_format.get('bit_rate'))),
+        'format_name': probe_format.get('format_name'),
+        'video_codec': video.get('codec_name'),
+        'width': video.get('width', 0),
+        'height': video.get('height', 0),
+        'video_bit_rate': int(parse_float(video.get('bit_rate'))),
+        'frame_rate': parse_frame_rate(video.get('avg_frame_rate')),
+        'audio_codecs': [
+            stream.get('codec_name') for stream in streams if stream.get('codec_type') == 'audio'
+        ],
+    }
+
+
+def probe_video(input_file: Path) -> dict | None:
+    """
+    Get the format and the streams of a video: duration, start time, bitrate, codec, resolution and
+    frame rate. ffprobe runs once for every version of the file, blocking, to be called in a worker thread.
+    :param input_file:
+    :return: None if the file can't be probed
+    """
+    from func.main import probe_cache
+    info = probe_cache.get(input_file, 'info')
+    if info is None:
+        data = run_ffprobe(['-show_format', '-show_streams', str(input_file)])
+        if data is None:
+            return None
+        info = summarize_probe(data)
+        probe_cache.set(input_file, 'info', info)
+    return info
+
+
+def get_audio_size(info: dict, seconds: float) -> float:
+    """
+    Get the bytes of the streams other than the video in {seconds}, from the bitrates probed.
+    They are copied by the compression, 0 if the bitrate of the video isn't known.
+    """
+    if 0 < info['video_bit_rate'] < info['bit_rate']:
+        return (info['bit_rate'] - info['video_bit_rate']) / 8 * seconds
+    return 0
+
+
+def get_cached_info(input_file: Path) -> dict | None:
+    """
+    Get the probed values of a video only if already cached, without running ffprobe.
+    """
+    from func.main import probe_cache
+    return probe_cache.get(input_file, 'info')
+
+
+def get_keyframes(input_file: Path) -> list:
+    """
+    Get the times of the keyframes of the first video stream, from the packets so no frame is decoded.
+    The times are relative to the start of the file, as -ss expects them. Cached as the other values,
+    blocking, to be called in a worker thread.
+    """
+    from func.main import probe_cache
+    keyframes = probe_cache.get(input_file, 'keyframes')
+    if keyframes is not None:
+        return keyframes
+    info = probe_video(input_file)
+    data = run_ffprobe(['-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', str(input_file)])
+    if info is None or data is None:
+        return []
+    keyframes = sorted(
+        parse_float(packet['pts_time']) - info['start_time'] for packet in data.get('packets', [])
+        if 'K' in packet.get('flags', '') and packet.get('pts_time') not in (None, 'N/A')
+    )
+    probe_cache.set(input_file, 'keyframes', keyframes)
+    return keyframes
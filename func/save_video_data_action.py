@@ -9,6 +9,7 @@ from telethon.tl.patched import Message
 from telethon.tl.types import DocumentAttributeFilename, DocumentAttributeVideo, MessageMediaDocument, Channel
 
 from classes.attribute_object import AttributeObject
+from classes.document_index import get_document_key
 from classes.object_data import ObjectData
 from classes.string_builder import ACQUIRED_TYPES, LINE_FOR_TARGET_FOLDER
 from func.utils import (sanitize_filename, default_video_message, remove_markdown,
@@ -64,6 +65,8 @@ async def acquire_video(message: Union[MessageMediaDocument, Message]) -> Tuple[
 
     if video_data and save_video_data(video_data, ObjectData(**video_data), get_video_data_keys()):
         print(f"Video saved: {video_data['original_video_name']}")
+        from func.main import document_index
+        document_index.add(video_data["document_key"], video_data["video_id"])
         if video_data["is_forward_chat_protected"] is not True:
             await video.delete()
 
@@ -125,7 +128,7 @@ async def process_video(video: Union[Message, MessageMediaDocument]):
     Process a video message and return the video data dictionary.
     Will recreate the video message and save the video data to a JSON file.
     """
-    from func.main import rules_object
+    from func.main import rules_object, caption_mirror
     video_data = initialize_video_data(video)
 
     video_name = await get_video_name(video)
@@ -183,6 +186,7 @@ async def process_video(video: Union[Message, MessageMediaDocument]):
 
     message = await send_video_to_chat(video_data, video)
     video_data["message_id_reference"] = message.id if message else video.id
+    caption_mirror.update(message)
 
     return video_data
 
@@ -197,6 +201,7 @@ def initialize_video_data(video: Union[Message, MessageMediaDocument]):
         "completed": False,
         "video_attribute": None,
         "is_forward_chat_protected": False,
+        "document_key": get_document_key(getattr(video, 'document', None)),
     }
 
 
@@ -336,5 +341,6 @@ def get_video_data_keys():
         "message_id_reference",
         "video_name_cleaned",
         "is_forward_chat_protected",
-        "video_completed_folder"
+        "video_completed_folder",
+        "document_key"
     ]
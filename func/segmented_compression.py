@@ -0,0 +1,303 @@
+"""
+Module for compressing a video split in segments at the keyframes, encoded at the same time.
+
+"""
+import asyncio
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+from classes.compression_checkpoint import load_work_file
+from func.compression import (CONCAT_FILE_NAME, COMPRESSION_STATE_COMPRESSED,
+                              COMPRESSION_STATE_COMPRESSION_FAILED,
+                              COMPRESSION_STATE_COMPRESSION_FAILED_NOT_OUTPUT_FILE,
+                              COMPRESSION_STATE_NOT_COMPRESSED,
+                              COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE,
+                              DEFAULT_ENCODE_THREADS, concat_video, get_encoder_args, get_file_size,
+                              get_out_time, get_source_key, get_video_duration, is_valid_input_file,
+                              notify_progress, parse_float, run_ffmpeg)
+from func.compression_predictor import check_compression, record_compression
+from func.media_probe import get_keyframes
+
+# File with the segments of a compression and the ones already encoded
+PLAN_FILE_NAME = 'plan.json'
+
+
+def get_segment_workers(config) -> int:
+    """
+    Get the number of encodes running at the same time: the segments, the compressions after
+    the download and the ones while downloading, by default the cores divided by the threads of an encode.
+    :param config:
+    :return:
+    """
+    if config.compression_segment_workers > 0:
+        return config.compression_segment_workers
+    return max(1, (os.cpu_count() or 1) // (config.compression_threads or DEFAULT_ENCODE_THREADS))
+
+
+def get_segments_dir(output_file: Path) -> Path:
+    """
+    Get the folder of the segments of a compression, next to the compressed file.
+    """
+    return output_file.with_name(output_file.name + '.segments')
+
+
+def plan_segments(duration: float, keyframes: list, segment_seconds: int) -> list:
+    """
+    Split a video at the first keyframe after every {segment_seconds}, the last segment
+    is not shorter than half of it.
+    :return: list of [start, end] in seconds
+    """
+    bounds = [0.0]
+    for keyframe in keyframes:
+        if keyframe - bounds[-1] >= segment_seconds and duration - keyframe >= segment_seconds / 2:
+            bounds.append(keyframe)
+    bounds.append(duration)
+    return [[start, end] for start, end in zip(bounds, bounds[1:])]
+
+
+class SegmentPlan:
+    """
+    The segments of a compression saved in its folder: every encoded segment is recorded,
+    so an interrupted compression continues from the segments still to encode.
+    """
+
+    def __init__(self, segments_dir: Path, source: list, crf: int, segments: list, done: list | None = None):
+        self.segments_dir = segments_dir
+        self.source = source
+        self.crf = crf
+        self.segments = segments
+        self.done = set(done or [])
+
+    @classmethod
+    def load(cls, segments_dir: Path, source: list, crf: int):
+        """
+        Load the plan of a previous run, None if missing or made for another file or CRF.
+        """
+        data = load_work_file(segments_dir / PLAN_FILE_NAME, source, crf)
+        if data is None:
+            return None
+        plan = cls(segments_dir, source, crf, data['segments'], data.get('done'))
+        # A segment is done only if its file is still there
+        plan.done = {index for index in plan.done if plan.get_segment_path(index).exists()}
+        return plan
+
+    def save(self):
+        """
+        Atomically replace the plan file.
+        """
+        plan_path = self.segments_dir / PLAN_FILE_NAME
+        temp_path = f"{plan_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'source': self.source, 'crf': self.crf, 'segments': self.segments,
+                       'done': sorted(self.done)}, f)
+        os.replace(temp_path, plan_path)
+
+    def get_segment_path(self, index: int) -> Path:
+        """
+        Get the file of a segment, Matroska holds the raw HEVC stream until the concat.
+        """
+        return self.segments_dir / f"segment_{index:05d}.mkv"
+
+    def get_duration(self, index: int) -> float:
+        """
+        Get the duration of a segment.
+        """
+        start, end = self.segments[index]
+        return end - start
+
+    def mark_done(self, index: int):
+        """
+        Record an encoded segment.
+        """
+        self.done.add(index)
+        self.save()
+
+
+class SegmentedCompression:
+    """
+    Compression of the segments of a video: the segments still to encode wait for a slot of
+    the encode budget shared by all the compressions, the progress of the running ones is
+    summed to the encoded ones for the callback.
+    """
+
+    def __init__(self, input_file: Path, plan: SegmentPlan, callback=None):
+        self.input_file = input_file
+        self.plan = plan
+        self.callback = callback
+        self.file_size = get_file_size(input_file)
+        self.duration = sum(plan.get_duration(index) for index in range(len(plan.segments)))
+        # Progress of the running segments: index -> (encoded time, size, fps, speed)
+        self.running = {}
+        self.exceeded = False
+
+    def get_encoded_size(self) -> float:
+        """
+        Get the size of the encoded segments and of the running ones.
+        """
+        return sum(get_file_size(self.plan.get_segment_path(index)) for index in self.plan.done) \
+            + sum(size for _, size, _, _ in self.running.values())
+
+    async def report(self):
+        """
+        Pass the overall progress to the callback.
+        """
+        encoded_time = sum(self.plan.get_duration(index) for index in self.plan.done) \
+            + sum(out_time for out_time, _, _, _ in self.running.values())
+        fps = sum(item[2] for item in self.running.values())
+        speed = sum(item[3] for item in self.running.values())
+        progress = min(100.0, encoded_time / self.duration * 100) if self.duration > 0 else 0
+        remaining_time_value = (self.duration - encoded_time) / speed if speed > 0 else 0
+        await notify_progress(
+            self.callback, progress, self.get_encoded_size(), remaining_time_value, fps, speed)
+
+    async def encode_segment(self, index: int, encode_slots: asyncio.Semaphore, threads: int):
+        """
+        Encode a segment when a slot of the budget is free.
+        Seeking before -i jumps to the keyframe where the segment starts without decoding what comes before,
+        only the video is encoded, the audio is copied from the input by the concat.
+        """
+        async with encode_slots:
+            if self.exceeded:
+                return
+            start, end = self.plan.segments[index]
+            args = ['-y', '-ss', f"{start:.6f}", '-i', str(self.input_file)]
+            if index < len(self.plan.segments) - 1:
+                args += ['-t', f"{end - start:.6f}"]
+            args += ['-map', '0:v:0', '-an', '-sn', *get_encoder_args(self.plan.crf, threads),
+                     str(self.plan.get_segment_path(index))]
+
+            async def on_progress(progress_data):
+                self.running[index] = (
+                    get_out_time(progress_data),
+                    parse_float(progress_data.get('total_size')),
+                    parse_float(progress_data.get('fps')),
+                    parse_float(progress_data.get('speed', '').rstrip('x')))
+                await self.report()
+                # Stop all the segments as soon as the output is larger than the input
+                self.exceeded = self.exceeded or self.get_encoded_size() >= self.file_size
+                return self.exceeded
+
+            try:
+                return_code, error_lines = await run_ffmpeg(args, on_progress)
+            finally:
+                self.running.pop(index, None)
+            if return_code is None:
+                return
+            if return_code != 0:
+                raise RuntimeError(
+                    f"ffmpeg exited with {return_code} on segment {index}: {' '.join(error_lines)}")
+            self.plan.mark_done(index)
+
+    async def encode(self, encode_slots: asyncio.Semaphore, threads: int):
+        """
+        Encode the segments not encoded yet, a failed segment stops the others.
+        """
+        tasks = [
+            asyncio.create_task(self.encode_segment(index, encode_slots, threads))
+            for index in range(len(self.plan.segments)) if index not in self.plan.done
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def concat(self, output_file: Path) -> tuple:
+        """
+        Join the encoded segments without encoding them again, with the audio of the input.
+        :return: (return code, the last lines of the errors)
+        """
+        entries = [(self.plan.get_segment_path(index), None) for index in range(len(self.plan.segments))]
+        return await concat_video(
+            entries, self.plan.segments_dir / CONCAT_FILE_NAME, self.input_file, output_file)
+
+
+async def create_plan(input_file: Path, segments_dir: Path, crf: int, segment_seconds: int) -> SegmentPlan:
+    """
+    Split the video at the keyframes, the work of a previous plan is removed.
+    """
+    source = get_source_key(input_file)
+    shutil.rmtree(segments_dir, ignore_errors=True)
+    segments_dir.mkdir(parents=True)
+    duration = await asyncio.to_thread(get_video_duration, input_file)
+    keyframes = await asyncio.to_thread(get_keyframes, input_file)
+    plan = SegmentPlan(segments_dir, source, crf, plan_segments(duration, keyframes, segment_seconds))
+    plan.save()
+    return plan
+
+
+async def join_segments(compression: SegmentedCompression, output_file: Path, prediction: dict | None,
+                        started: float) -> int:
+    """
+    Join the encoded segments in the compressed file and remove them.
+    The result of a predicted compression is recorded, with the time since {started}.
+    """
+    return_code, error_lines = await compression.concat(output_file)
+    if return_code != 0:
+        print(f"ffmpeg concat exited with {return_code}: {' '.join(error_lines)}")
+        return COMPRESSION_STATE_COMPRESSION_FAILED
+
+    # Verify the final file
+    if not output_file.exists() or output_file.stat().st_size == 0:
+        print("Compression failed: Output file not created or is empty.")
+        return COMPRESSION_STATE_COMPRESSION_FAILED_NOT_OUTPUT_FILE
+    shutil.rmtree(compression.plan.segments_dir, ignore_errors=True)
+    record_compression(
+        prediction, compression.file_size, output_file.stat().st_size, time.monotonic() - started)
+    if output_file.stat().st_size >= compression.file_size:
+        output_file.unlink()
+        return COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE
+    print(f"Compression successfully completed! File saved: {output_file}")
+    return COMPRESSION_STATE_COMPRESSED
+
+
+async def compress_video_segmented(
+        input_file: Path,
+        output_file: Path,
+        crf: int = 28,
+        min_size_mb: int = 50,
+        callback=None
+) -> int:
+    """
+    Compress a video file to H.265 splitting it at the keyframes: the segments are encoded at the same time
+    within the encode budget and joined by the concat demuxer, so a long file uses all the cores.
+    Takes the same arguments and returns the same states as compress_video_h265.
+    """
+    from func.main import configuration, encode_slots
+
+    # Pre-compression checks
+    if not is_valid_input_file(input_file, min_size_mb):
+        return COMPRESSION_STATE_NOT_COMPRESSED
+
+    segments_dir = get_segments_dir(output_file)
+    threads = configuration.compression_threads or DEFAULT_ENCODE_THREADS
+    try:
+        # The plan of an interrupted compression is continued, otherwise the result is predicted first
+        plan = SegmentPlan.load(segments_dir, get_source_key(input_file), crf)
+        prediction = None
+        if plan is None:
+            async with encode_slots:
+                compress, prediction = await check_compression(input_file, output_file, crf, threads, True)
+            if not compress:
+                return COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE
+            plan = await create_plan(input_file, segments_dir, crf, configuration.compression_segment_seconds)
+        else:
+            print(f"Resuming compression: {len(plan.done)}/{len(plan.segments)} segments already encoded")
+
+        started = time.monotonic()
+        compression = SegmentedCompression(input_file, plan, callback)
+        await compression.encode(encode_slots, threads)
+        if compression.exceeded:
+            shutil.rmtree(segments_dir, ignore_errors=True)
+            return COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE
+
+        return await join_segments(compression, output_file, prediction, started)
+
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # The encoded segments are kept for the next attempt
+        print(f"Error during compression: {e}")
+        return COMPRESSION_STATE_COMPRESSION_FAILED
@@ -2,23 +2,30 @@
 Module for interacting with Telegram API to download files with progress tracking and retry logic.
 """
 import json
-import time
 import os
 import asyncio
 import collections
 from pathlib import Path
 from xmlrpc.client import MAXINT
 
-from telethon import TelegramClient
-from telethon.errors import FloodError
+from telethon import TelegramClient, utils
+from telethon.client.downloads import MIN_CHUNK_SIZE, MAX_CHUNK_SIZE
+from telethon.errors import FloodError, FileReferenceExpiredError
+from telethon.tl.functions.upload import GetFileHashesRequest
 from telethon.tl.patched import Message
 from tqdm import tqdm
 
 from classes.attribute_object import AttributeObject
+from classes.buffered_writer import BufferedFileWriter
 from classes.custom_flood_error import CustomFloodError
+from classes.disk_reservations import get_device
+from classes.download_stall_error import DownloadStallError
+from classes.download_stats import DownloadStats
+from classes.hash_verifier import HashVerifier
 from classes.object_data import ObjectData
+from classes.range_journal import RangeJournal
+from classes.stream_transcoder import StreamTranscoder
 from classes.string_builder import TYPE_CANCELLED, TYPE_ACQUIRED, TYPE_DOWNLOADING
-from classes.tqdm_object import TqdmObject
 from func.messages import t
 from func.save_video_data_action import change_target_folder
 from func.utils import (
@@ -26,13 +33,6 @@ from func.utils import (
     LINE_FOR_SHOW_LAST_ERROR, get_video_data_path, define_label, detect_remaining_size_in_disk_by_path)
 
 
-def calculate_download_speed(current: int, time_elapsed: float, last_current: int):
-    """Calculate download speed."""
-    if time_elapsed <= 0:
-        return 0
-    return (current - last_current) / time_elapsed
-
-
 async def edit_service_message(message: Message, text, time_to_expire=10):
     """
     Edit service message, self-destruct after {time_to_expire} seconds
@@ -93,166 +93,472 @@ def format_time(seconds: float) -> str:
     return f"{int(hours):02}:{int(minutes):02}:{int(seconds):02}"
 
 
-tqdm_config = TqdmObject({
-    'last_current': 0,
-    'last_update_time': 0
-})
+SEGMENT_MIN_SIZE = 16 * 1024 * 1024
+# Maximum number of times the ranges failing the hash verification are downloaded again
+MAX_VERIFY_RETRIES = 3
+# Stalled streams restarted in a download before it fails
+MAX_STALL_RETRIES = 10
+# Seconds added to the flood waits slept by Telethon inside a request before a stream is considered stalled
+STALL_FLOOD_MARGIN = 10
+# Seconds between two updates of the download status message
+DOWNLOAD_MESSAGE_INTERVAL = 3
 
 
 async def progress_tracking(
         progress: int,
         file_size: int,
         video: ObjectData,
-        temp_file_path: str,
-        attempt: int,
-        retry_attempts: int
+        temp_file_path: str
 ):
     """
     Track the download progress and update the status message.
     """
+    from func.main import bandwidth_governor, download_stats
 
     await add_line_to_text(video.message_id_reference, '', LINE_FOR_SHOW_LAST_ERROR, False)
 
+    bandwidth_governor.register(video.video_id, video.chat_id, video.pinned is True)
+    stats = download_stats.start(video.video_id, file_size, progress, video.chat_id)
     # Initialize the progress bar
-    with tqdm(total=file_size, initial=progress,
-              desc=f"Downloading {video.video_id} - {video.file_name} -"
-                   f" {video.video_name_cleaned}",
-              unit='B', unit_scale=True, unit_divisor=1024) as pbar:
-        # Download the media to the temp file using iter_download
-        await download_with_rate_limit(
-            pbar,
-            video,
-            progress,
-            file_size,
-            temp_file_path,
-            attempt,
-            retry_attempts)
+    try:
+        with tqdm(total=file_size, initial=progress,
+                  desc=f"Downloading {video.video_id} - {video.file_name} -"
+                       f" {video.video_name_cleaned}",
+                  unit='B', unit_scale=True, unit_divisor=1024) as pbar:
+            # Download the media to the temp file using iter_download
+            await download_with_rate_limit(
+                pbar,
+                stats,
+                video,
+                file_size,
+                temp_file_path)
+    finally:
+        bandwidth_governor.unregister(video.video_id)
+        download_stats.stop(video.video_id)
 
 
 async def progress_callback(
         video: ObjectData,
         pbar: tqdm,
-        current: int,
-        total: int,
-        speed_samples: collections.deque
+        stats: DownloadStats
 ):
     """
     Callback function to update the progress bar and status message.
     :param video:
     :param pbar:
-    :param current:
-    :param total:
-    :param speed_samples:
+    :param stats: statistics of the download, already updated with the last chunk
     :return:
     """
 
-    if total is not None:
+    if is_interrupted() is True:
+        print(t('download_stopped'))
+        await add_line_to_text(video.message_id_reference,
+                               t('download_stopped'),
+                               LINE_FOR_INFO_DATA, True)
+        raise KeyboardInterrupt(t('download_stopped'))
 
-        if is_interrupted() is True:
-            print(t('download_stopped'))
-            await add_line_to_text(video.message_id_reference,
-                                   t('download_stopped'),
-                                   LINE_FOR_INFO_DATA, True)
-            raise KeyboardInterrupt(t('download_stopped'))
+    # Update the status message every DOWNLOAD_MESSAGE_INTERVAL seconds
+    if stats.should_report(DOWNLOAD_MESSAGE_INTERVAL):
+        await update_download_message(video.message_id_reference,
+                                      stats.percent(),
+                                      format_time(stats.time_remaining()))
 
-        percent_complete: float = (current / total) * 100
-        current_time: float = time.time()
+    # Update the progress bar
+    pbar.update(stats.bytes_done - pbar.n)
 
-        # Calculate time elapsed
-        time_elapsed: float = current_time - tqdm_config.last_update_time
 
-        # Calculate download speed
-        download_speed: float | int = calculate_download_speed(
-            current,
-            time_elapsed,
-            tqdm_config.last_current
-        )
+async def download_with_rate_limit(  # pylint: disable=too-many-locals, too-many-statements
+        pbar: tqdm,
+        stats: DownloadStats,
+        video: ObjectData,
+        file_size: int,
+        temp_file_path: str
+):
+    """
+    Download the ranges of the media still missing in the preallocated temp file using
+    iter_download, large files are split in ranges fetched by concurrent streams.
+    With the hash verification enabled the data is written only once verified
+    :param pbar:
+    :param stats:
+    :param video:
+    :param file_size:
+    :param temp_file_path:
+    :return:
+    """
+    from func.main import (
+        client, operation_status, configuration, bandwidth_governor, concurrency_controller)
+    from func.main import sender_pool, disk_reservations, download_stats, compression_queue
 
-        # Add the current speed to the speed sample buffer
-        speed_samples.append(download_speed)
+    request_size = get_request_size(get_download_request_kb())
+    journal = load_journal(temp_file_path, file_size)
 
-        # Calculate average speed for a more accurate estimate
-        average_speed: float = (sum(speed_samples) / len(speed_samples)
-                                if speed_samples else 0)
-        time_remaining: float = ((total - current) / average_speed
-                                 if average_speed > 0 else float('inf'))
+    if operation_status.interrupt is True:
+        return
 
-        # Update the status message every 3 seconds
-        if current_time - tqdm_config.last_update_time >= 3:
-            time_remaining_formatted = format_time(time_remaining)
-            await update_download_message(video.message_id_reference,
-                                          percent_complete,
-                                          time_remaining_formatted)
-            tqdm_config.last_update_time = current_time
-            tqdm_config.last_current = current
+    directory = os.path.dirname(temp_file_path)
+    Path(directory).mkdir(parents=True, exist_ok=True)
+
+    missing_ranges = journal.missing_ranges()
+    remaining = sum(end - start for start, end in missing_ranges)
+    streams = configuration.download_segments if remaining >= SEGMENT_MIN_SIZE else 1
+    # Filled once the block size of the hash verification is known
+    pieces = collections.deque()
+
+    writer = create_file_writer(temp_file_path)
+    transcoder = await create_stream_transcoder(video, file_size, temp_file_path, journal.ranges)
+
+    def mark_written(offset, length):
+        journal.mark_written(offset, length)
+        if transcoder is not None:
+            transcoder.mark_written(offset, length)
+
+    async def write_chunk(offset, data):
+        if transcoder is not None:
+            transcoder.offer(offset, data)
+        await writer.write(offset, data, mark_written)
+
+    verifier = None
+    if configuration.download_verify_hashes is True:
+        verifier = HashVerifier(create_hash_fetcher(client, sender_pool, video.video_media),
+                                file_size, write_chunk)
+
+    stalls = 0
+
+    async def fetch_ranges():
+        nonlocal stalls
+        while pieces:
+            start, end = pieces.popleft()
+            offset = start
+            # A smaller power of two keeps the pieces aligned to the request size
+            piece_request_size = concurrency_controller.get_request_size(request_size)
+            download_iter = iter_media_range(
+                client, sender_pool, video.video_media, start, end, piece_request_size,
+                configuration.download_stall_timeout)
+            try:
+                async for chunk in download_iter:
+                    if operation_status.interrupt is True:
+                        return
+                    concurrency_controller.on_success()
+                    chunk = chunk[:end - offset]
+                    if verifier is not None:
+                        await verifier.submit(offset, chunk)
+                    else:
+                        await write_chunk(offset, chunk)
+                    offset += len(chunk)
+                    disk_reservations.consume(video.video_id, len(chunk))
+                    stats.add_bytes(len(chunk))
+                    if journal.should_commit():
+                        await journal.commit(writer)
+                    await progress_callback(video, pbar, stats)
+                    await bandwidth_governor.consume(video.video_id, len(chunk))
+                    # Stop requesting chunks while another download is in flood wait
+                    await concurrency_controller.wait_pause()
+            except DownloadStallError as e:
+                # The stream is restarted from the last chunk handed to the writer
+                stalls += 1
+                download_stats.add_stall(video.video_id)
+                print(t('download_stalled', video.file_name, e.message))
+                if stalls > MAX_STALL_RETRIES:
+                    raise
+                pieces.append((offset, end))
+
+    tasks = []
+    succeeded = False
+    try:
+        # The journal is stored before the preallocation, a full size temp file without
+        # journal is considered completed
+        await journal.commit(writer, final=True)
+        await writer.preallocate(file_size)
+        if verifier is not None:
+            await verifier.start()
+            # A block is verified and written only when all its bytes are downloaded again
+            missing_ranges = align_ranges(missing_ranges, verifier.block_size, file_size)
+        pieces.extend(split_ranges(missing_ranges, streams, request_size))
+        retries = 0
+        while pieces:
+            tasks = [asyncio.create_task(fetch_ranges()) for _ in range(min(streams, len(pieces)))]
+            await asyncio.gather(*tasks)
+            if verifier is None or operation_status.interrupt is True:
+                break
+            await verifier.drain()
+            # Only the blocks not matching their hash are downloaded again
+            failed_ranges = verifier.take_failed()
+            if failed_ranges and retries >= MAX_VERIFY_RETRIES:
+                raise OSError(t('hash_verification_failed', video.file_name))
+            retries += 1
+            pieces.extend(failed_ranges)
+        # An interrupted stream returns without giving back its piece, so the queue can be empty anyway
+        succeeded = not pieces and operation_status.interrupt is not True
+    except FloodError as e:
+        print(e)
+        seconds = get_flood_wait_seconds(e)
+        concurrency_controller.on_flood(seconds, concurrency_controller.get_request_size(request_size))
+        raise CustomFloodError(e.message, seconds=seconds) from e
+    except Exception as e:  # pylint: disable=broad-except
+        print(e)
+        raise
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if verifier is not None:
+            await verifier.close()
+        try:
+            await journal.commit(writer, final=True)
+        finally:
+            await writer.close()
+            if transcoder is not None and not succeeded:
+                await transcoder.cancel()
 
-        # Update the progress bar
-        pbar.update(current - pbar.n)
-        pbar.total = total
-        pbar.n = current
+    if transcoder is not None and succeeded:
+        # The last bytes are encoded on the compression queue, the download slot is freed now
+        compression_queue.add_stream(video.video_id, transcoder)
 
 
-async def download_with_rate_limit(
-        pbar: tqdm,
-        video: ObjectData,
-        progress: int,
-        file_size: int,
-        temp_file_path: str,
-        attempt: int,
-        retry_attempts: int
-):
+async def create_stream_transcoder(video: ObjectData, file_size: int, temp_file_path: str, written: list):
     """
-    Download the media to the temp file using iter_download
-    :param retry_attempts:
-    :param attempt:
-    :param pbar:
+    Start the compression while downloading, if enabled, the file is worth compressing and a slot
+    of the encode budget is free: the download never waits for the encoders, without a free slot
+    the file is compressed after the download
     :param video:
-    :param progress:
     :param file_size:
     :param temp_file_path:
+    :param written: the ranges already on the temp file
+    :return: StreamTranscoder or None
+    """
+    from func.main import configuration, compression_queue, encode_slots
+    from func.compression import should_compress, get_encoder_args
+    from func.utils import get_converted_file_path
+    # The transcoder of a previous download of the same file is never finished
+    await compression_queue.discard_stream(video.video_id)
+    if not configuration.enable_video_compression or not configuration.compression_while_downloading:
+        return None
+    file_size_mb = file_size / (1024 * 1024)
+    if file_size_mb < configuration.compression_min_size_mb \
+            or not should_compress(file_size_mb, configuration.compression_ratio):
+        return None
+    if encode_slots.locked():
+        return None
+    await encode_slots.acquire()
+    transcoder = StreamTranscoder(
+        temp_file_path, str(get_converted_file_path(video)), file_size,
+        get_encoder_args(configuration.compression_ratio), written, encode_slots)
+    transcoder.start()
+    return transcoder
+
+
+async def finish_stream_compression(video: ObjectData):
+    """
+    Wait for the compression while downloading to encode the last bytes, on the compression queue
+    :param video:
+    :return: the compression state, None if the file must be compressed after the download
+    """
+    from func.main import compression_queue
+    from func.compression import (
+        COMPRESSION_STATE_COMPRESSED, COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE)
+    transcoder = compression_queue.take_stream(video.video_id)
+    if transcoder is None or not await transcoder.finish():
+        return None
+    if os.path.getsize(transcoder.output_path) >= transcoder.file_size:
+        transcoder.remove_output()
+        return COMPRESSION_STATE_NOT_COMPRESSED_EXCEED_COMPRESSION_SIZE
+    return COMPRESSION_STATE_COMPRESSED
+
+
+def iter_media_range(client: TelegramClient, sender_pool, media, start: int, end: int, request_size: int,
+                     stall_timeout: float = 0):
+    """
+    Iterate the chunks of the range [start, end) of a media, through the sender pool when the
+    file is on another data center, otherwise with iter_download
+    :param client:
+    :param sender_pool:
+    :param media:
+    :param start:
+    :param end:
+    :param request_size:
+    :param stall_timeout: seconds without chunks before DownloadStallError is raised, 0 waits forever
+    :return:
+    """
+    if stall_timeout:
+        # A flood wait up to flood_sleep_threshold is slept inside the request, it is not a stall
+        stall_timeout = max(stall_timeout, client.flood_sleep_threshold + STALL_FLOOD_MARGIN)
+    dc_id, location = utils.get_input_location(media)
+    if sender_pool.is_enabled(dc_id) and start % MIN_CHUNK_SIZE == 0:
+        return sender_pool.iter_file(dc_id, location, start, end, request_size, stall_timeout)
+    return watch_stalls(client.iter_download(
+        media, offset=start,
+        request_size=request_size, chunk_size=request_size,
+        limit=-(-(end - start) // request_size)), start, stall_timeout)
+
+
+async def watch_stalls(download_iter, start: int, stall_timeout: float):
+    """
+    Iterate a download stream, raising DownloadStallError when no chunk arrives within the timeout,
+    the abandoned stream gives back its connection
+    :param download_iter:
+    :param start:
+    :param stall_timeout:
+    :return:
+    """
+    offset = start
+    while True:
+        try:
+            chunk = await asyncio.wait_for(anext(download_iter), stall_timeout or None)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError as e:
+            if hasattr(download_iter, 'close'):
+                await download_iter.close()
+            raise DownloadStallError(f"no data for {stall_timeout}s at {offset}", offset=offset) from e
+        offset += len(chunk)
+        yield chunk
+
+
+def create_hash_fetcher(client: TelegramClient, sender_pool, media):
+    """
+    Create the function requesting the hashes of a media, on the data center of the file
+    :param client:
+    :param sender_pool:
+    :param media:
+    :return: async callable returning the FileHash list starting at an offset
+    """
+    dc_id, location = utils.get_input_location(media)
+
+    async def fetch_hashes(offset: int) -> list:
+        request = GetFileHashesRequest(location, offset)
+        if sender_pool.is_enabled(dc_id):
+            async with sender_pool.sender(dc_id) as sender:
+                return await sender_pool.call(sender, request)
+        if dc_id is None or dc_id == client.session.dc_id:
+            return await client(request)
+        # pylint: disable=protected-access
+        sender = await client._borrow_exported_sender(dc_id)
+        try:
+            return await client._call(sender, request)
+        finally:
+            await client._return_exported_sender(sender)
+
+    return fetch_hashes
+
+
+def get_flood_wait_seconds(error: FloodError) -> int:
+    """
+    Get the seconds to wait requested by a flood error
+    :param error:
     :return:
     """
-    from func.main import client, operation_status, configuration
+    seconds = getattr(error, 'seconds', None)
+    if isinstance(seconds, int):
+        return seconds + 1
+    message = error.message or ''
+    if message.startswith("FLOOD_PREMIUM_WAIT_"):
+        return int(message.replace("FLOOD_PREMIUM_WAIT_", "")) + 1
+    return 10
 
-    kb_download = min(256, configuration.max_download_size_request_limit_kb)
+
+def create_file_writer(temp_file_path: str) -> BufferedFileWriter:
+    """
+    Create the off-loop writer of a temp file
+    :param temp_file_path:
+    :return:
+    """
+    from func.main import configuration
+    return BufferedFileWriter(
+        temp_file_path,
+        max_pending=configuration.download_write_buffer_mb * 1024 * 1024)
+
+
+def get_download_request_kb() -> int:
+    """
+    Get the size in kilobytes of a single download request
+    :return:
+    """
+    from func.main import operation_status, configuration
 
     if operation_status.is_premium is True:
-        kb_download = configuration.max_download_size_request_limit_kb \
+        return configuration.max_download_size_request_limit_kb \
             if configuration.max_download_size_request_limit_kb != -1 else MAXINT
+    return min(256, configuration.max_download_size_request_limit_kb)
 
-    # Buffer to store speed data samples
-    speed_samples = collections.deque(maxlen=20)
 
-    try:
-        download_iter = client.iter_download(
-            video.video_media, offset=progress,
-            request_size=kb_download * 1024)
-        if operation_status.interrupt is True:
-            return
+def get_request_size(kb_download: int) -> int:
+    """
+    Normalize the request size in bytes to a value accepted by upload.getFile,
+    a power of two multiple of 4 KB not greater than 512 KB
+    :param kb_download:
+    :return:
+    """
+    request_size = MIN_CHUNK_SIZE
+    while request_size * 2 <= min(kb_download * 1024, MAX_CHUNK_SIZE):
+        request_size *= 2
+    return request_size
 
-        directory = os.path.dirname(temp_file_path)
-        Path(directory).mkdir(parents=True, exist_ok=True)
 
-        if not os.path.exists(temp_file_path):
-            with open(temp_file_path, 'wb'):
-                pass
+def get_journal_path(temp_file_path: str) -> str:
+    """
+    Get the path of the range journal of a temp file
+    :param temp_file_path:
+    :return:
+    """
+    return f"{temp_file_path}.journal"
 
-        with open(temp_file_path, 'ab') as f:
-            async for chunk in download_iter:
-                if operation_status.interrupt is True:
-                    return
-                f.write(chunk)
-                await progress_callback(video, pbar, f.tell(), file_size, speed_samples)
-                sleep_time = 0.5 + (2 - 0.5) * (min(1 - attempt, 0) / retry_attempts)
-                await asyncio.sleep(sleep_time)
 
-            await asyncio.sleep(5)
-    except FloodError as e:
-        print(e)
-        raise CustomFloodError(e.message) from e
-    except Exception as e:  # pylint: disable=broad-except
-        print(e)
-        raise
+def load_journal(temp_file_path: str, file_size: int) -> RangeJournal:
+    """
+    Load the range journal of a temp file, a temp file without journal was written
+    sequentially so its size is the downloaded part
+    :param temp_file_path:
+    :param file_size:
+    :return:
+    """
+    from func.main import configuration
+    journal_path = get_journal_path(temp_file_path)
+    ranges = RangeJournal.load_ranges(journal_path, file_size)
+    if ranges is None and os.path.exists(temp_file_path):
+        ranges = [[0, min(os.path.getsize(temp_file_path), file_size)]]
+    return RangeJournal(
+        journal_path, file_size, ranges,
+        configuration.download_fsync_policy,
+        configuration.download_fsync_interval)
+
+
+def align_ranges(ranges: list, block_size: int, file_size: int) -> list:
+    """
+    Extend the ranges to the blocks containing them, the overlapping ones are merged
+    :param ranges:
+    :param block_size:
+    :param file_size:
+    :return:
+    """
+    aligned = []
+    for start, end in ranges:
+        start -= start % block_size
+        end = min(-(-end // block_size) * block_size, file_size)
+        if aligned and start <= aligned[-1][1]:
+            aligned[-1][1] = max(aligned[-1][1], end)
+        else:
+            aligned.append([start, end])
+    return aligned
+
+
+def split_ranges(ranges: list, parts: int, request_size: int) -> list:
+    """
+    Split the ranges to download in pieces for {parts} concurrent streams,
+    the inner boundaries are aligned to the request size
+    :param ranges:
+    :param parts:
+    :param request_size:
+    :return:
+    """
+    total = sum(end - start for start, end in ranges)
+    piece_size = -(-total // max(1, parts))
+    pieces = []
+    for start, end in ranges:
+        while start < end:
+            piece_end = -(-(start + piece_size) // request_size) * request_size
+            pieces.append([start, min(piece_end, end)])
+            start = min(piece_end, end)
+    return pieces
 
 
 async def get_user_id():
@@ -325,28 +631,17 @@ async def download_with_retry(client: TelegramClient, video: ObjectData,
                               retry_attempts: int = 20):  # pylint: disable=too-many-statements
     """Download a file with retry attempts in case of failure."""
     from run import PERSONAL_CHAT_ID
+    from func.main import media_cache
 
-    # Here checks for video data, because if video is stored during the iteration, it will expire
-    video_message_data = await client.get_messages(
-        PERSONAL_CHAT_ID,
-        ids=video.message_id_reference
-    )  # type: Message
+    # The media is fetched again only if its file reference is stale
+    video.video_media = await media_cache.get_media(video)
 
-    if video_message_data is None:
+    if video.video_media is None:
         print(t('download_stopped'))
         return
 
-    if video.is_forward_chat_protected is not True:
-        video.video_media = video_message_data.media
-    else:
-        video_data = \
-            await client.get_messages(video.chat_name, ids=video.video_id)  # type: Message
-        video.video_media = video_data.media
-
     attempt = 0
     progress = 0
-    tqdm_config.last_current = 0
-    tqdm_config.last_update_time = time.time()
     file_size = video.video_media.document.size
     temp_file_path = f"{video.file_path}.temp"
 
@@ -361,9 +656,8 @@ async def download_with_retry(client: TelegramClient, video: ObjectData,
             # At this point the folder must be existed
             await check_completed_folder_exist(video)
             # Start to pin the message
-            await video_message_data.pin()
-            if os.path.exists(temp_file_path):
-                progress = os.path.getsize(temp_file_path)
+            await client.pin_message(PERSONAL_CHAT_ID, video.message_id_reference)
+            progress = load_journal(temp_file_path, file_size).written_bytes()
 
             # Check if the disk space limit is exceeded for the completed folder
             if await check_valid_disk_space_limit(
@@ -381,7 +675,7 @@ async def download_with_retry(client: TelegramClient, video: ObjectData,
 
             # Download the file with progress tracking
             await define_label(video.message_id_reference, TYPE_DOWNLOADING)
-            await progress_tracking(progress, file_size, video, temp_file_path, attempt, retry_attempts)
+            await progress_tracking(progress, file_size, video, temp_file_path)
             # Wait 3 seconds before to get temp file size
             await asyncio.sleep(3)
             await define_label(video.message_id_reference, TYPE_ACQUIRED)
@@ -394,8 +688,9 @@ async def download_with_retry(client: TelegramClient, video: ObjectData,
                 break
 
         except CustomFloodError as e:
+            from func.main import concurrency_controller
             attempt += 1
-            wait_time = await attempt_message(e, attempt, retry_attempts, video)
+            await attempt_message(e, attempt, retry_attempts, video)
             if attempt == retry_attempts:
                 await define_label(video.message_id_reference, TYPE_CANCELLED)
                 await add_line_to_text(
@@ -404,12 +699,22 @@ async def download_with_retry(client: TelegramClient, video: ObjectData,
                     LINE_FOR_SHOW_LAST_ERROR,
                     True
                 )
-            await video_message_data.unpin()
-            await asyncio.sleep(wait_time)
+            await client.unpin_message(PERSONAL_CHAT_ID, video.message_id_reference)
+            # The pause is shared by every download
+            await concurrency_controller.wait_pause()
+
+        except FileReferenceExpiredError:
+            attempt += 1
+            print(t('file_reference_expired', video.file_name))
+            media_cache.invalidate(video)
+            video.video_media = await media_cache.fetch(video)
+            if video.video_media is None:
+                print(t('download_stopped'))
+                break
 
         except (OSError, IOError) as e:
             print(f"File system error: {str(e)}")
-            await video_message_data.unpin()
+            await client.unpin_message(PERSONAL_CHAT_ID, video.message_id_reference)
             await define_label(video.message_id_reference, TYPE_CANCELLED)
             await add_line_to_text(video.message_id_reference, t('file_system_error', str(e)),
                                    LINE_FOR_SHOW_LAST_ERROR)
@@ -417,7 +722,7 @@ async def download_with_retry(client: TelegramClient, video: ObjectData,
 
         except Exception as error:  # pylint: disable=broad-exception-caught
             print(f"Unexpected error: {str(error)}")
-            await video_message_data.unpin()
+            await client.unpin_message(PERSONAL_CHAT_ID, video.message_id_reference)
             await define_label(video.message_id_reference, TYPE_CANCELLED)
             await add_line_to_text(video.message_id_reference, f"Unexpected error: {str(error)}",
                                    LINE_FOR_SHOW_LAST_ERROR)
@@ -426,13 +731,13 @@ async def download_with_retry(client: TelegramClient, video: ObjectData,
 
 async def check_valid_disk_space_limit(video: ObjectData, file_size: int, target_folder_path: str) -> bool:
     """
-    Check if the disk space limit is exceeded
+    Check if the disk space limit is exceeded, counting the space reserved by the other downloads
     :param video:
     :param file_size:
     :param target_folder_path:
     :return:
     """
-    from func.main import configuration
+    from func.main import configuration, disk_reservations
     from func.utils import is_valid_folder
 
     if not os.path.exists(target_folder_path) and is_valid_folder(target_folder_path) is True:
@@ -440,7 +745,7 @@ async def check_valid_disk_space_limit(video: ObjectData, file_size: int, target
 
     disk_info_target = detect_remaining_size_in_disk_by_path(
         target_folder_path,
-        file_size,
+        file_size + disk_reservations.get_reserved(get_device(target_folder_path), video.video_id),
         configuration.disk_space_limit_percentage)
     if disk_info_target['exceeds_threshold'] is True:
         await define_label(video.message_id_reference, TYPE_CANCELLED)
@@ -475,12 +780,26 @@ async def validate_download(temp_file_path, file_size, video):
     else:
         temp_file_size = 0
 
+    # The temp file is preallocated, so it is complete only when the journal covers every byte
+    journal_ranges = RangeJournal.load_ranges(get_journal_path(temp_file_path), file_size)
+    if journal_ranges is not None:
+        journal = RangeJournal(get_journal_path(temp_file_path), file_size, journal_ranges)
+        if not journal.is_complete():
+            return False
+        journal.remove()
+
     if os.path.exists(video.file_path) and not is_file_corrupted(video.file_path, file_size):
         await download_complete_action(video)
         return True
 
     if abs(temp_file_size - file_size) <= tolerance:
-        os.rename(temp_file_path, video.file_path)
+        from func.main import compression_queue
+        transcoder = compression_queue.streams.get(video.video_id)
+        if transcoder is not None:
+            # The transcoder may still be reading the temp file
+            await transcoder.move_input(video.file_path)
+        else:
+            os.rename(temp_file_path, video.file_path)
         print(f"Downloaded video to: {video.file_path}")
         if os.path.exists(video.file_path) and not is_file_corrupted(video.file_path, file_size):
             await download_complete_action(video)
@@ -505,12 +824,8 @@ async def attempt_message(error_message, attempt, retry_attempts, video):
     :return:
     """
     wait_time = 10  # Add a buffer time for safety
-    if isinstance(error_message, CustomFloodError):
-        message = error_message.message
-        if message is not None:
-            wait_time = int(
-                message.replace("FLOOD_PREMIUM_WAIT_", "")
-            ) + 1 if message.startswith("FLOOD_PREMIUM_WAIT_") else 10
+    if isinstance(error_message, CustomFloodError) and error_message.seconds is not None:
+        wait_time = error_message.seconds
     print(
         f"Rate limit exceeded. Waiting for some {wait_time} seconds before retrying..."
         f" Remaining attempts: {attempt} on {retry_attempts}")
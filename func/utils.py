@@ -2,7 +2,9 @@
 Utility functions for file handling, including permission checks, file moving,
 logging, and corruption checking.
 """
+import asyncio
 import glob
+import hashlib
 import json
 import mimetypes
 import os
@@ -12,7 +14,7 @@ import re
 from pathlib import Path
 from typing import Union
 
-from telethon.errors import MessageNotModifiedError
+from telethon.errors import MessageIdInvalidError
 from telethon.tl.patched import Message
 from telethon.tl.types import MessageMediaDocument
 
@@ -92,18 +94,7 @@ async def move_file(src: Path, dest: Path, cb=None) -> bool:
     print an error message and return False.
     """
     try:
-        dest_file_name = dest.name
-        dest_file_name_without_ext = dest.stem
-
-        if dest_file_name.endswith('.mpv'):
-            dest_file_name = os.path.splitext(dest_file_name)[0] + '.mp4'
-
-        base_dest_dir = dest.parent
-
-        dest_dir = base_dest_dir / dest_file_name_without_ext
-        dest_dir.mkdir(parents=True, exist_ok=True)
-
-        final_dest = dest_dir / dest_file_name
+        final_dest = get_final_destination(dest)
 
         shutil.move(str(src), str(final_dest))
         print(t('video_saved_and_moved', final_dest))
@@ -126,6 +117,133 @@ async def move_file(src: Path, dest: Path, cb=None) -> bool:
         return False
 
 
+def get_final_destination(dest: Path) -> Path:
+    """
+    Get the path where a completed file is stored, in a folder named as the file.
+    """
+    dest_file_name = dest.name
+    dest_file_name_without_ext = dest.stem
+
+    if dest_file_name.endswith('.mpv'):
+        dest_file_name = os.path.splitext(dest_file_name)[0] + '.mp4'
+
+    dest_dir = dest.parent / dest_file_name_without_ext
+    dest_dir.mkdir(parents=True, exist_ok=True)
+
+    return dest_dir / dest_file_name
+
+
+def link_or_copy(src: Path, dest: Path) -> None:
+    """
+    Hardlink {src} to {dest}, copy it if the link is not possible (e.g. another file system).
+    The link is made on a temporary name and then replaces {dest}, which is untouched on error.
+    """
+    temp_path = dest.with_name(dest.name + '.link')
+    temp_path.unlink(missing_ok=True)
+    try:
+        try:
+            os.link(src, temp_path)
+        except OSError:
+            shutil.copy2(src, temp_path)
+        os.replace(temp_path, dest)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def replace_with_link(src: Path, dest: Path) -> bool:
+    """
+    Replace {dest} with a hardlink to {src}, a file with the same content.
+    A copy would save no space, so nothing is done if the link is not possible.
+    :return: True if linked
+    """
+    temp_path = dest.with_name(dest.name + '.link')
+    temp_path.unlink(missing_ok=True)
+    try:
+        os.link(src, temp_path)
+    except OSError as e:
+        print(f"Can't link {dest} to {src}, kept as it is: {e}")
+        return False
+    try:
+        os.replace(temp_path, dest)
+    finally:
+        temp_path.unlink(missing_ok=True)
+    return True
+
+
+async def link_file(src: Path, dest: Path, cb=None) -> bool:
+    """
+    Link an already completed file to the destination path, like move_file without moving it.
+    """
+    try:
+        final_dest = get_final_destination(dest)
+        await asyncio.to_thread(link_or_copy, src, final_dest)
+        print(t('video_linked', final_dest))
+        if cb is not None:
+            await cb(src, final_dest, True)
+        return True
+    except (shutil.Error, OSError):
+        print(t('error_move_file', os.path.basename(src)))
+        if cb is not None:
+            await cb(src, None, False)
+        return False
+
+
+def hash_file(file_path: str | Path) -> str:
+    """
+    Get the sha256 of a file.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_original_document(video: ObjectData) -> dict | None:
+    """
+    Get the index entry of the first video with the same document, None if this video is
+    the first one or the first one is gone without completing.
+    """
+    from func.main import document_index
+    entry = document_index.get(video.document_key)
+    if entry is None or entry['video_id'] == video.video_id:
+        return None
+    if entry['completed_path'] is None:
+        return entry if video_data_file_exists_by_video_id(str(entry['video_id'])) else None
+    return entry if os.path.exists(entry['completed_path']) else None
+
+
+def is_waiting_duplicate(video: ObjectData) -> bool:
+    """
+    Check if the same document is being downloaded by another video.
+    """
+    entry = get_original_document(video)
+    return entry is not None and entry['completed_path'] is None
+
+
+async def link_duplicate_video(video: ObjectData) -> bool:
+    """
+    Complete a video linking the completed file of the same document, instead of downloading it.
+    :return: True if the video was linked
+    """
+    from func.main import document_index
+    entry = get_original_document(video)
+    if entry is None or entry['completed_path'] is None:
+        # The first video is gone, this one becomes the owner of the document
+        document_index.add(video.document_key, video.video_id)
+        return False
+
+    await add_line_to_text(video.message_id_reference, t('duplicate_video_linked', entry['video_id']),
+                           LINE_FOR_INFO_DATA)
+
+    async def cb_link_file(src, target, result):  # pylint: disable=unused-argument
+        await completed_file_action(video, target, result)
+
+    await link_file(Path(entry['completed_path']), get_completed_file_path(video), cb_link_file)
+    await unpin_reference_message(video)
+    return True
+
+
 def is_file_corrupted(file_path: str, total_file_size: int) -> bool:
     """
     Check if a file is corrupted by comparing its actual size with the size
@@ -154,25 +272,107 @@ def get_inlist_video_object_by_message_id_reference(message_id_reference: str) -
     return None
 
 
-async def download_complete_action(video: ObjectData) -> None:
+def get_completed_file_path(video: ObjectData) -> Path:
     """
-    Download complete action.
+    Get the destination of the completed file of a video.
     """
-    from func.config import load_configuration
-    config = load_configuration()
-
     mime_type, _ = mimetypes.guess_type(video.file_path)
     extension = mimetypes.guess_extension(mime_type) if mime_type else ''
     if video.video_completed_folder is None:
         raise OSError(t('error_video_completed_folder_none'), video.message_id_reference)
 
     completed_folder = video.video_completed_folder
-    completed_file_path = os.path.join(completed_folder, video.video_name_cleaned + extension)
+    return Path(os.path.join(completed_folder, video.video_name_cleaned + extension))
+
+
+async def completed_file_action(video: ObjectData, target: Path | None, result: bool) -> None:
+    """
+    Update the video data and the reference message once the completed file is in place,
+    the file is registered in the document index.
+    """
+    if result:
+        await index_completed_file(video, target)
+        complete_data_file(video)
+        await add_line_to_text(video.message_id_reference, t('download_complete', str(target)[:55]),
+                               LINE_FOR_INFO_DATA)
+        await define_label(video.message_id_reference, TYPE_COMPLETED)
+        if video.is_forward_chat_protected is not True:
+            remove_video_data(video)
+    else:
+        await add_line_to_text(video.message_id_reference, t('error_move_file', str(target)[:55]),
+                               LINE_FOR_SHOW_LAST_ERROR)
+        await define_label(video.message_id_reference, TYPE_ERROR)
+
+
+async def index_completed_file(video: ObjectData, target: Path):
+    """
+    Register the completed file in the document index, with the content hash enabled an
+    identical file already completed on the same file system replaces it with a hardlink.
+    """
+    from func.main import configuration, document_index
+    content_hash = None
+    if configuration.dedup_content_hash is True:
+        content_hash = await asyncio.to_thread(hash_file, target)
+        same_content_path = document_index.get_path_by_hash(content_hash)
+        if same_content_path is not None and Path(same_content_path) != Path(target):
+            try:
+                await asyncio.to_thread(replace_with_link, Path(same_content_path), Path(target))
+            except OSError as e:
+                print(f"Error on linking {target} to {same_content_path}: {e}")
+    document_index.set_completed(video.document_key, str(target), content_hash)
+
+
+async def unpin_reference_message(video: ObjectData):
+    """
+    Unpin the reference message of a video.
+    """
+    from func.main import client
+    try:
+        await client.unpin_message(PERSONAL_CHAT_ID, video.message_id_reference)
+    except MessageIdInvalidError:
+        pass
+
+
+def get_converted_file_path(video: ObjectData) -> Path:
+    """
+    Get the path of the compressed file of a video, next to the downloaded one.
+    """
+    file_path = Path(str(video.file_path))
+    return file_path.with_name(file_path.stem + "_converted" + file_path.suffix)
+
+
+async def download_complete_action(video: ObjectData) -> None:
+    """
+    Download complete action, the videos to compress are handed to the compression queue
+    so the download slot is freed.
+    """
+    from func.config import load_configuration
+    config = load_configuration()
+
+    if config.enable_video_compression:
+        from func.main import compression_queue
+        compression_queue.submit(video)
+        await add_line_to_text(video.message_id_reference,
+                               t('compression_queued', compression_queue.get_position(video.video_id) or 1),
+                               LINE_FOR_INFO_DATA)
+        return
+
+    await complete_video(video)
+
+
+async def complete_video(video: ObjectData) -> None:
+    """
+    Compress the downloaded video if enabled and move it to the completed folder.
+    """
+    from func.config import load_configuration
+    config = load_configuration()
 
     file_path_source = Path(str(video.file_path))
-    file_path_dest = Path(str(completed_file_path))
+    file_path_dest = get_completed_file_path(video)
 
-    async def compression_message(progress, current_size, remaining_time):
+    async def compression_message(progress, current_size, remaining_time, fps, speed):
+        from func.main import compression_queue
+        compression_queue.set_progress(video.video_id, progress, fps, speed)
         compressed_file_size = format_bytes(int(current_size))
         num_blocks = int(progress // 20)
         progress_bar = '■' * num_blocks + '░' * (5 - num_blocks)
@@ -183,7 +383,9 @@ async def download_complete_action(video: ObjectData) -> None:
             t('trace_compress_action',
               progress_bar_display,
               compressed_file_size,
-              format_time(remaining_time)),
+              format_time(remaining_time),
+              f"{fps:.1f}",
+              f"{speed:.2f}"),
             LINE_FOR_INFO_DATA)
 
     if config.enable_video_compression:
@@ -193,19 +395,25 @@ async def download_complete_action(video: ObjectData) -> None:
             video.message_id_reference,
             t('start_compress_file', str(file_path_source)[:44]),
             LINE_FOR_INFO_DATA)
-        file_path_c = Path(str(video.file_path))
-        converted_file_path = file_path_c.with_name(
-            file_path_c.stem + "_converted" + file_path_c.suffix)
+        converted_file_path = get_converted_file_path(video)
         from func.compression import (
             compress_video_h265
         )
+        from func.segmented_compression import compress_video_segmented
         await define_label(video.message_id_reference, TYPE_COMPRESSING)
-        compressing_state = await compress_video_h265(
-            file_path_source,
-            converted_file_path,
-            config.compression_ratio,
-            config.compression_min_size_mb,
-            compression_message)
+        # The compression while downloading produces the converted file once its last bytes are encoded
+        from func.telegram_client import finish_stream_compression
+        compressing_state = await finish_stream_compression(video)
+        if compressing_state is None:
+            compress = compress_video_h265
+            if config.compression_segment_seconds > 0:
+                compress = compress_video_segmented
+            compressing_state = await compress(
+                file_path_source,
+                converted_file_path,
+                config.compression_ratio,
+                config.compression_min_size_mb,
+                compression_message)
 
         file_path_source = \
             await compression_action(compressing_state, video, file_path_source, converted_file_path)
@@ -216,25 +424,12 @@ async def download_complete_action(video: ObjectData) -> None:
 
     print(t('ready_to_move', video.video_name_cleaned))
 
-    async def cb_move_file(src, target, result):
-        if result:
-            complete_data_file(video)
-            await add_line_to_text(video.message_id_reference, t('download_complete', str(target)[:55]),
-                                   LINE_FOR_INFO_DATA)
-            await define_label(video.message_id_reference, TYPE_COMPLETED)
-            if video.is_forward_chat_protected is not True:
-                remove_video_data(video)
-        else:
-            await add_line_to_text(video.message_id_reference, t('error_move_file', str(target)[:55]),
-                                   LINE_FOR_SHOW_LAST_ERROR)
-            await define_label(video.message_id_reference, TYPE_ERROR)
+    async def cb_move_file(src, target, result):  # pylint: disable=unused-argument
+        await completed_file_action(video, target, result)
 
     await move_file(file_path_source, file_path_dest, cb_move_file)
     # Unpin message on complete
-    from func.main import client
-    video_message = await client.get_messages(PERSONAL_CHAT_ID, ids=video.message_id_reference)
-    if video_message is not None:
-        await video_message.unpin()
+    await unpin_reference_message(video)
 
 def format_time(seconds):
     """
@@ -313,9 +508,10 @@ def remove_video_data(video_object: ObjectData) -> None:
     """
     Remove the video data file based on the video object.
     """
-    from func.main import operation_status
+    from func.main import operation_status, document_index
     if video_object is None:
         return
+    document_index.remove(video_object.document_key, video_object.video_id)
     if os.path.isfile(get_video_data_full_path(video_object)):
         os.remove(str(get_video_data_full_path(video_object)))
         # Removes from videos_data
@@ -455,47 +651,39 @@ async def add_line_to_text(
     """
     Add a new line to the text of the reference message.
     """
-    from run import LOG_IN_PERSONAL_CHAT
-    from func.main import client
-    # Divide il testo in righe
-    if isinstance(message_id, str):
-        message_id = int(message_id)
-
-    message = await client.get_messages(PERSONAL_CHAT_ID, ids=message_id)  # get realtime info
-    text = message.text
-
-    builder = StringBuilder(text)
     new_line = new_line.replace('\n', ' ')
-    builder.edit_in_line(new_line, line_number, with_default_icon)
-
-    # Unisce di nuovo le righe in una singola stringa
-    if LOG_IN_PERSONAL_CHAT is True and message is not None:
-        try:
-            await message.edit(builder.string)
-        except (MessageNotModifiedError, PermissionError) as er:
-            print(er.message)
+    await edit_reference_message(
+        message_id,
+        lambda builder: builder.edit_in_line(new_line, line_number, with_default_icon))
 
 
 async def define_label(message_id: str, label) -> None:
     """
     Add a new line to the text of the reference message.
     """
-    from run import LOG_IN_PERSONAL_CHAT
-    from func.main import client
+    await edit_reference_message(message_id, lambda builder: builder.define_label(label))
 
-    message = await client.get_messages(PERSONAL_CHAT_ID, ids=message_id)  # get realtime info
-    text = message.text
 
-    # Divide il testo in righe
-    builder = StringBuilder(text)
-    builder.define_label(label)
+async def edit_reference_message(message_id: str | int, edit_builder) -> None:
+    """
+    Edit the text of the reference message, the change is merged with the ones not yet sent
+    and the caption edit scheduler sends the result.
+    :param message_id:
+    :param edit_builder: callable that changes the StringBuilder of the current text
+    :return:
+    """
+    from func.main import caption_edit_scheduler
 
-    # Unisce di nuovo le righe in una singola stringa
-    if LOG_IN_PERSONAL_CHAT is True and message is not None:
-        try:
-            await message.edit(builder.string)
-        except (MessageNotModifiedError, PermissionError) as er:
-            print(er.message)
+    if isinstance(message_id, str):
+        message_id = int(message_id)
+
+    text = await caption_edit_scheduler.get_text(message_id)
+    if text is None:
+        return
+
+    builder = StringBuilder(text)
+    edit_builder(builder)
+    caption_edit_scheduler.schedule(message_id, builder.string)
 
 
 async def get_video_status_label(message_reference: int | Union[Message, MessageMediaDocument]):
@@ -504,16 +692,15 @@ async def get_video_status_label(message_reference: int | Union[Message, Message
     :param message_reference:
     :return:
     """
-    from func.main import client
+    from func.main import caption_edit_scheduler
 
     if isinstance(message_reference, int):
-        message = await client.get_messages(PERSONAL_CHAT_ID, ids=message_reference)
+        text = await caption_edit_scheduler.get_text(message_reference)
     elif isinstance(message_reference, (Message, MessageMediaDocument)):
-        message = message_reference
+        text = message_reference.text
     else:
         return None
 
-    text = message.text
     string_object = StringBuilder(text)
     return string_object.get_label()
 